@@ -0,0 +1,5 @@
+#!/bin/bash
+# Lets the db-replica service of docker-compose.yaml stream the changes of the primary.
+# Like every init script of the postgres image, it only runs when the database volume is first created
+set -e
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -42,6 +43,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that the timings cover the other middlewares too
+    'simulations.instrumentation.QueryTimingMiddleware',
+    'simulations.routing.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -76,17 +80,101 @@ WSGI_APPLICATION = 'origenai.wsgi.application'
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
 
+# Connections are kept open between requests (CONN_MAX_AGE seconds, "none" for no limit)
+# and checked before being reused, rather than opening a new one for every request.
+# With pgbouncer in transaction pooling mode (DB_PGBOUNCER=1) server side cursors and prepared
+# statements can't be used, and the statement timeout has to be set in pgbouncer instead.
+
+DB_PGBOUNCER = os.environ.get("DB_PGBOUNCER", "0") == "1"
+DB_CONN_MAX_AGE = os.environ.get("DB_CONN_MAX_AGE", "60")
+# in milliseconds, 0 for no timeout
+DB_STATEMENT_TIMEOUT = int(os.environ.get("DB_STATEMENT_TIMEOUT", 0))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql_psycopg2',
-        'NAME': 'origenai',
-        'USER': 'colinkingswood',
-        'PASSWORD': 'testpassword',
-        'HOST': 'db',  # Matches the service name in docker-compose.yml
-        'PORT': '5432',
+        'NAME': os.environ.get("DB_NAME", 'origenai'),
+        'USER': os.environ.get("DB_USER", 'colinkingswood'),
+        'PASSWORD': os.environ.get("DB_PASSWORD", 'testpassword'),
+        'HOST': os.environ.get("DB_HOST", 'db'),  # Matches the service name in docker-compose.yml
+        'PORT': os.environ.get("DB_PORT", '5432'),
+        'CONN_MAX_AGE': None if DB_CONN_MAX_AGE.lower() == "none" else int(DB_CONN_MAX_AGE),
+        'CONN_HEALTH_CHECKS': True,
+        'DISABLE_SERVER_SIDE_CURSORS': DB_PGBOUNCER,
+        'OPTIONS': {} if DB_PGBOUNCER else {'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'},
     }
 }
 
+# Read replica: when DB_REPLICA_HOST is set (a streaming replica of the database, with the same name and
+# credentials), the GET endpoints read from it and everything else goes to the primary, see simulations/routing.py.
+# After a write a client reads from the primary for DB_READ_YOUR_WRITES seconds, so that the replication lag
+# doesn't hide what it has just written (0 to turn it off)
+DB_REPLICA_HOST = os.environ.get("DB_REPLICA_HOST")
+if DB_REPLICA_HOST:
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': DB_REPLICA_HOST,
+        'PORT': os.environ.get("DB_REPLICA_PORT", DATABASES['default']['PORT']),
+        # the tests read from the test database
+        'TEST': {'MIRROR': 'default'},
+    }
+DB_READ_ALIAS = 'replica' if 'replica' in DATABASES else 'default'
+DB_READ_YOUR_WRITES = int(os.environ.get("DB_READ_YOUR_WRITES", 5))
+
+# number of simulations per partition of lossdata, when it is partitioned (see simulations/partitions.py)
+LOSSDATA_PARTITION_SIZE = int(os.environ.get("LOSSDATA_PARTITION_SIZE", 1000))
+
+# "sync" serves the endpoints of simulations/api.py with django's database connections,
+# "async" serves the ones of simulations/api_async.py with an asyncpg connection pool,
+# which needs an ASGI server (e.g. uvicorn origenai.asgi:application)
+API_MODE = os.environ.get("API_MODE", "sync")
+
+# The simulation and machine lists are serialised to JSON by postgres (json_build_object) rather than
+# from python objects, which is faster and lighter for long lists (see bench_listing --database)
+JSON_FROM_DATABASE = os.environ.get("JSON_FROM_DATABASE", "0") == "1"
+
+ASYNC_DB_POOL = {
+    'MIN_SIZE': int(os.environ.get("ASYNC_DB_POOL_MIN_SIZE", 2)),
+    'MAX_SIZE': int(os.environ.get("ASYNC_DB_POOL_MAX_SIZE", 10)),
+    # idle connections above MIN_SIZE are closed after this many seconds
+    'MAX_INACTIVE_LIFETIME': float(os.environ.get("ASYNC_DB_POOL_MAX_INACTIVE_LIFETIME", 300)),
+}
+
+# The live event streams (simulations/events.py) LISTEN on a connection of their own, which has to go to
+# postgres directly when the other connections go through pgbouncer (it can't keep a LISTEN), the DB_HOST
+# and DB_PORT are used otherwise
+EVENTS_DB_HOST = os.environ.get("EVENTS_DB_HOST")
+EVENTS_DB_PORT = os.environ.get("EVENTS_DB_PORT")
+# seconds between the keepalive comments sent on idle event streams
+EVENTS_HEARTBEAT = float(os.environ.get("EVENTS_HEARTBEAT", 15))
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Used for the machine list and the graphs of finished simulations.
+# Local memory by default (evicts the least recently used entries once MAX_ENTRIES is reached),
+# set REDIS_URL (e.g. redis://redis:6379/0, needs the redis package) to share it between workers.
+
+CACHE_TIMEOUT = int(os.environ.get("CACHE_TIMEOUT", 300))
+
+if os.environ.get("REDIS_URL"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ["REDIS_URL"],
+            'TIMEOUT': CACHE_TIMEOUT,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'TIMEOUT': CACHE_TIMEOUT,
+            'OPTIONS': {
+                'MAX_ENTRIES': int(os.environ.get("CACHE_MAX_ENTRIES", 1000)),
+            },
+        }
+    }
 
 
 # Password validation
@@ -14,9 +14,14 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
-from simulations.api import api
+
+if settings.API_MODE == "async":
+    from simulations.api_async import api
+else:
+    from simulations.api import api
 
 urlpatterns = [
     path("api/", api.urls),
@@ -1,21 +1,38 @@
+import base64
+import codecs
+import csv
+import json
 import logging
 from datetime import datetime
+from decimal import Decimal
 from enum import Enum
-from typing import List, Optional
+from operator import itemgetter
+from typing import List, Optional, Union
 
-from django.http import JsonResponse
-from django.urls import reverse
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
 from ninja import NinjaAPI, Router, Schema, Query
-from django.db import connections
-from psycopg2.extras import RealDictCursor
-from pydantic import condecimal, BaseModel, HttpUrl
+from ninja.responses import NinjaJSONEncoder
+from django.db import connections, transaction
+from pydantic import condecimal, Field, ValidationError
+
+from simulations.cache import (MACHINES_CACHE_KEY, cached_response, graph_cache_key, invalidate_graph,
+                               invalidate_machines)
+from simulations.connection_stats import SERVER_CONNECTIONS_SQL, connections_opened
+from simulations import repository
+from simulations.instrumentation import current_stats, metrics_text, serialising
+from simulations.repository import (SIMULATION_COLUMNS, SIMULATION_JSON_COLUMNS, SIMULATION_TABLES, fetch_batches,
+                                    open_streaming_cursor)
+from simulations.responses import (BINARY_GRAPH_CONTENT_TYPE, SimulationPage, SimulationResponse, binary_graph,
+                                   detail_link_parts, json_chunks, json_encoder, json_page, loss_point,
+                                   simulation_builder, streaming_json_response, wants_binary_graph)
 
 logger = logging.getLogger(__name__)
 
 api = NinjaAPI()
 router = Router()
 
-
 @api.get("/hello")
 def hello(request):
     """
@@ -26,6 +43,33 @@ def hello(request):
     return {"msg": "Hello World"}
 
 
+@api.get("/db/stats")
+def db_stats(request):
+    """
+    Connection numbers, to size the connections under load
+    :return: the settings of this worker's connections, how many it opened
+        and the connections the database server has by state
+    """
+    try:
+        server_connections = dict(repository.fetch_all(SERVER_CONNECTIONS_SQL))
+        return {"mode": "sync",
+                "conn_max_age": connections['default'].settings_dict["CONN_MAX_AGE"],
+                "connections_opened": connections_opened(),
+                "server_connections": server_connections}
+
+    except Exception as e:
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.get("/metrics")
+def metrics(request):
+    """
+    Histograms of the request, SQL and serialisation times and of the number of queries
+    of each endpoint, since this worker started, in the Prometheus text format
+    """
+    return HttpResponse(metrics_text(), content_type="text/plain; version=0.0.4")
+
+
 class CreateMachineSchema(Schema):
     name: str
     location: str
@@ -37,19 +81,14 @@ def add_machine(request, data: CreateMachineSchema):
     Add a machine
     """
     try:
-        insert_sql = "INSERT INTO machine (name, location) values (%s,%s) RETURNING id"
-        insert_values = (data.name, data.location)
-        conn = connections['default']  # I ran into problems with tests and transactions, hence doing it this way
-        with conn.cursor() as cur:
-            cur.execute(insert_sql, insert_values)
-            new_id = cur.fetchone()[0]
-            logger.info(f"New machine added id: {new_id}")
+        new_id = repository.add_machine(data.name, data.location)
+        logger.info(f"New machine added id: {new_id}")
+        invalidate_machines()
         return {"OK": True, "message": "created new machine",  "id": new_id}
 
     except Exception as e:
         # could be more specific with error trapping, but for the purpose of a technical test
         # I will just catch a standard exception
-        conn.rollback()
         logger.error(str(e))
         return JsonResponse({"OK": False, "error": str(e)}, status=400)
 
@@ -61,66 +100,301 @@ class UpdateMachineSchema(Schema):
 
 
 @api.put("/machines/{machine_id}/change")
-def update_machines(request, data: UpdateMachineSchema):
-    ## This would work similar to add_machine)_ above,
-    # though the machine id would be included, and an update query would be issued rather than an insert
-    # the spec said not to repeat too much code
-    pass
+def update_machines(request, machine_id: int, data: UpdateMachineSchema):
+    """
+    Change the name and location of a machine
+    """
+    try:
+        if repository.update_machine(machine_id, data.name, data.location) is None:
+            return JsonResponse({"OK": False, "error": f"machine {machine_id} not found"}, status=404)
+        invalidate_machines()
+        return {"OK": True, "message": "updated machine", "id": machine_id}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
 
 
 @api.get("/machines")
 def machines(request):
     """
     Get the list of machines
+    The list is cached until a machine is added or changed, and has an ETag
+    so that clients can use If-None-Match
     :param request:
     :return: A list of machines
     """
+    def build():
+        if settings.JSON_FROM_DATABASE:
+            return repository.machines_json().encode(), "application/json"
+        results = repository.list_machines()
+        with serialising(current_stats()):
+            return json_encoder.encode([result._asdict() for result in results]).encode(), "application/json"
+
     try:
-        get_machines_sql = "SELECT * FROM machine ORDER BY ID"
-        conn = connections['default']
-        conn.ensure_connection()
-        with conn.connection.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(get_machines_sql)
-            results = cur.fetchall()
-        return results
+        return cached_response(request, MACHINES_CACHE_KEY, build)
 
     except Exception as e:
         # could be more specific with error trapping, but for the purpose of a technical test
         # I will just catch a standard exception
         return JsonResponse({"OK": False, "error": str(e)}, status=400)
 
+class GraphFormat(str, Enum):
+    JSON = 'json'
+    BINARY = 'binary'
+
+
+DEFAULT_GRAPH_PAGE_SIZE = 10000
+MAX_GRAPH_PAGE_SIZE = 100000
+
+
+class GraphFilter(Schema):
+    points: Optional[int] = Field(None, ge=2)
+    from_seconds: Optional[int] = Field(None, alias="from")
+    to_seconds: Optional[int] = Field(None, alias="to")
+    format: Optional[GraphFormat] = None
+    # resume cursors, to only get the points added since the last poll
+    after_seconds: Optional[int] = None
+    # with after_seconds, the id of the last point, as several points can have the same seconds
+    after_id: Optional[int] = None
+    since_id: Optional[int] = None
+    limit: Optional[int] = Field(None, ge=1, le=MAX_GRAPH_PAGE_SIZE)
+
+
+# resume cursor parameter -> (the columns the rows are ordered by and compared to, the parameters
+# giving their values, and their positions in the rows)
+graph_cursors = {
+    "after_seconds": (("seconds", "id"), ("after_seconds", "after_id"), (1, 0)),
+    "since_id": (("id",), ("since_id",), (0,)),
+}
+
+
+def graph_window(simulation_id, filters):
+    """:return: the WHERE clause restricting the graph to the requested window of seconds, and its values"""
+    where_sql = "WHERE simulation_id = %s "
+    placeholder_vars = [simulation_id]
+    if filters.from_seconds is not None:
+        where_sql += "AND seconds >= %s "
+        placeholder_vars.append(filters.from_seconds)
+    if filters.to_seconds is not None:
+        where_sql += "AND seconds <= %s "
+        placeholder_vars.append(filters.to_seconds)
+    return where_sql, placeholder_vars
+
+
+def loss_data_query(simulation_id, filters):
+    """
+    Build the SQL for a convergence graph, restricted to the requested window of seconds.
+    If a number of points is requested, the series is split into points / 2 buckets of
+    consecutive rows and only the lowest and highest loss of each bucket is kept, so the
+    size of the result is bounded however long the simulation ran. This is done in the
+    database so that only the downsampled rows are transferred.
+    :return: the SQL string and its placeholder values
+    """
+    where_sql, placeholder_vars = graph_window(simulation_id, filters)
+
+    if not filters.points:
+        return f"SELECT seconds, loss FROM lossdata {where_sql}ORDER BY seconds ASC", placeholder_vars
+
+    downsample_sql = f"""
+        WITH buckets AS (
+            SELECT seconds, loss, ntile(%s) OVER (ORDER BY seconds) AS bucket
+            FROM lossdata {where_sql}
+        ), ranked AS (
+            SELECT seconds, loss,
+                   row_number() OVER (PARTITION BY bucket ORDER BY loss ASC, seconds ASC) AS lowest,
+                   row_number() OVER (PARTITION BY bucket ORDER BY loss DESC, seconds ASC) AS highest
+            FROM buckets
+        )
+        SELECT seconds, loss FROM ranked WHERE lowest = 1 OR highest = 1 ORDER BY seconds ASC
+        """
+    return downsample_sql, [filters.points // 2] + placeholder_vars
+
+
+def graph_cursor(filters):
+    """
+    :return: the (parameter, values of its columns) of the resume cursor of the request, or None for the whole graph.
+        after_seconds can be given without after_id (e.g. by a client that only kept the seconds of its last point),
+        then only the seconds are compared
+    """
+    given = [name for name in graph_cursors if getattr(filters, name) is not None]
+    if filters.after_id is not None and filters.after_seconds is None:
+        raise ValueError("after_id can only be given with after_seconds")
+    if not given:
+        return None
+    if len(given) > 1:
+        raise ValueError("give either after_seconds or since_id")
+    if filters.points or filters.format == GraphFormat.BINARY:
+        raise ValueError("after_seconds and since_id can't be used with points or the binary format")
+    name = given[0]
+    columns, parameters, positions = graph_cursors[name]
+    values = [getattr(filters, parameter) for parameter in parameters]
+    return name, [value for value in values if value is not None]
+
+
+def incremental_graph_query(simulation_id, filters, cursor):
+    """
+    Build the SQL for the points after a resume cursor, in the order of the cursor's columns.
+    after_seconds is a range scan of the (simulation_id, seconds, id) index, since_id of (simulation_id, id),
+    the latter also gets the points added late with fewer seconds than the last one.
+    :return: the SQL string, its placeholder values and the maximum number of points
+    """
+    name, values = cursor
+    columns, parameters, positions = graph_cursors[name]
+    where_sql, placeholder_vars = graph_window(simulation_id, filters)
+    limit = filters.limit or DEFAULT_GRAPH_PAGE_SIZE
+    compared = ", ".join(columns[:len(values)])
+    # one more row than the limit, to know if there are more
+    incremental_sql = f"""SELECT id, seconds, loss FROM lossdata {where_sql}
+                          AND ({compared}) > ({", ".join(["%s"] * len(values))})
+                          ORDER BY {", ".join(f"{column} ASC" for column in columns)} LIMIT %s"""
+    return incremental_sql, placeholder_vars + values + [limit + 1], limit
+
+
+def graph_increment(rows, cursor, limit):
+    """
+    :param rows: the (id, seconds, loss) rows selected by the incremental_graph_query() SQL
+    :return: the points, with the values of the cursor to give to get the points after them,
+        and whether there are more already
+    """
+    name, values = cursor
+    columns, parameters, positions = graph_cursors[name]
+    points = rows[:limit]
+    if points:
+        values = [points[-1][position] for position in positions]
+    increment = {"points": [{"seconds": row[1], "loss": row[2]} for row in points]}
+    for parameter, value in zip(parameters, values + [None] * (len(parameters) - len(values))):
+        increment[parameter] = value
+    increment["more"] = len(rows) > limit
+    return increment
+
+
+def binary_graph_query(loss_data_sql):
+    """
+    Wrap the SQL of loss_data_query() to get the graph as one row: the number of points,
+    and the seconds and losses as arrays of big-endian int32 and float32, for binary_graph()
+    """
+    return f"""SELECT count(*) AS count,
+                      string_agg(int4send(seconds), ''::bytea ORDER BY seconds) AS seconds,
+                      string_agg(float4send(loss::float4), ''::bytea ORDER BY seconds) AS losses
+               FROM ({loss_data_sql}) points"""
+
+
 @api.get("simulations/{simulation_id}/graph")
-def convergence_graph(request, simulation_id: int):
+def convergence_graph(request, simulation_id: int, filters: Query[GraphFilter] = None):
     """
     Get the convergence graph for a specific simulation
+    Use `points` to get a downsampled series of at most that many points,
+    and `from` / `to` to only get part of the run (in seconds)
+    The points are streamed as a JSON array, or as NDJSON with `Accept: application/x-ndjson`
+    `format=binary` (or `Accept: application/vnd.origenai.graph`) gets them as arrays of
+    int32 seconds and float32 losses instead, see responses.binary_graph()
+    The graph of a finished simulation doesn't change, so it is cached (with an ETag) instead
+    To poll a running simulation, give `after_seconds` and `after_id` (of the last point the client has)
+    or `since_id` to only get the points added since, as {"points": [...], "after_seconds": ..., "after_id": ..., "more": ...}
+    with the values to give in the next poll (at most `limit` points at a time)
     :return:
     """
 
     try:
-        get_loss_data_sql = "SELECT seconds, loss FROM lossdata WHERE simulation_id = (%s) ORDER BY seconds ASC"
-        conn = connections['default']
-        conn.ensure_connection()
-        with conn.connection.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(get_loss_data_sql, (simulation_id,))
-            results = cur.fetchall()
-        return results
+        cursor = graph_cursor(filters)
+        if cursor is not None:
+            incremental_sql, placeholder_vars, limit = incremental_graph_query(simulation_id, filters, cursor)
+            return JsonResponse(graph_increment(repository.fetch_all(incremental_sql, placeholder_vars), cursor, limit),
+                                encoder=NinjaJSONEncoder)
+
+        get_loss_data_sql, placeholder_vars = loss_data_query(simulation_id, filters)
+        binary = wants_binary_graph(request, filters)
+        key = graph_cache_key(request, simulation_id)
+
+        def build():
+            if binary:
+                count, seconds, losses = repository.fetch_one(binary_graph_query(get_loss_data_sql), placeholder_vars)
+                with serialising(current_stats()):
+                    return binary_graph(count, seconds, losses), BINARY_GRAPH_CONTENT_TYPE
+            cur = open_streaming_cursor(get_loss_data_sql, placeholder_vars)
+            chunks, content_type = json_chunks(request, fetch_batches(cur, transform=loss_point))
+            return "".join(chunks).encode(), content_type
+
+        if cache.get(key) is None and repository.simulation_state(simulation_id) != State.FINISHED:
+            if binary:
+                body, content_type = build()
+                return HttpResponse(body, content_type=content_type)
+            cur = open_streaming_cursor(get_loss_data_sql, placeholder_vars)
+            return streaming_json_response(request, fetch_batches(cur, transform=loss_point))
+
+        return cached_response(request, key, build)
 
     except Exception as e:
         return JsonResponse({"OK": False, "error": str(e)}, status=400)
 
+MAX_PREVIEW_POINTS = 1000
+
+
+class PreviewMode(str, Enum):
+    LAST = 'last'
+    DOWNSAMPLED = 'downsampled'
+
+
+class DetailFilter(Schema):
+    # a preview of the graph of at most that many points: the last ones, or the whole graph downsampled
+    preview: Optional[int] = Field(None, ge=2, le=MAX_PREVIEW_POINTS)
+    preview_mode: PreviewMode = PreviewMode.LAST
+
+
+def detail_query(simulation_id, filters):
+    """
+    Build the SQL of the detail of a simulation: the simulation with the summary of its loss data, its machine,
+    and with a preview the seconds and losses of its points as two arrays, so that a detail page is one query
+    :return: the SQL string and its placeholder values
+    """
+    if not filters.preview:
+        return repository.SIMULATION_DETAIL_SQL, [simulation_id]
+
+    if filters.preview_mode == PreviewMode.DOWNSAMPLED:
+        preview_sql, preview_vars = loss_data_query(simulation_id, GraphFilter(points=filters.preview))
+    else:
+        preview_sql = "SELECT seconds, loss FROM lossdata WHERE simulation_id = %s ORDER BY seconds DESC LIMIT %s"
+        preview_vars = [simulation_id, filters.preview]
+    # the aggregates always give a row, NULL arrays when there are no points
+    detail_sql = f"""SELECT detail.*, preview.seconds AS preview_seconds, preview.losses AS preview_losses
+                     FROM ({repository.SIMULATION_DETAIL_SQL}) detail CROSS JOIN (
+                         SELECT array_agg(seconds ORDER BY seconds) AS seconds, array_agg(loss ORDER BY seconds) AS losses
+                         FROM ({preview_sql}) points
+                     ) preview"""
+    return detail_sql, [simulation_id] + preview_vars
+
+
+def simulation_detail_response(row):
+    """
+    :param row: the row of the detail_query() SQL, as a dictionary
+    :return: the simulation with its machine, and the points of the preview as "graph" if one was requested
+    """
+    detail = dict(row)
+    machine_name, machine_location = detail.pop("machine_name"), detail.pop("machine_location")
+    detail["machine"] = ({"id": detail["machine_id"], "name": machine_name, "location": machine_location}
+                         if detail["machine_id"] is not None else None)
+    if "preview_seconds" in detail:
+        seconds, losses = detail.pop("preview_seconds") or [], detail.pop("preview_losses") or []
+        detail["graph"] = [{"seconds": point_seconds, "loss": loss} for point_seconds, loss in zip(seconds, losses)]
+    return detail
+
+
 @api.get("/simulations/{simulation_id}/detail", url_name="simulation_detail")
-def simulation_detail(request, simulation_id: int):
-    """ Get detail for one simulation"""
-
-    get_machines_sql = ("SELECT * FROM simulation a "
-                        "LEFT JOIN machine m ON m.simulation_id = s.id "
-                        "WHERE id = (%s)")
-    conn = connections['default']
-    conn.ensure_connection()
-    with conn.connection.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(get_machines_sql, (simulation_id,))
-        results = cur.fetchone()
-    return results
+def simulation_detail(request, simulation_id: int, filters: Query[DetailFilter] = None):
+    """
+    Get detail for one simulation, with its machine and optionally a preview of its graph
+    (`preview` points, the last ones or with `preview_mode=downsampled` the whole graph downsampled)
+    """
+    try:
+        detail_sql, placeholder_vars = detail_query(simulation_id, filters)
+        result = repository.fetch_one(detail_sql, placeholder_vars)
+        if result is None:
+            return JsonResponse({"OK": False, "error": f"simulation {simulation_id} not found"}, status=404)
+        return simulation_detail_response(result._asdict())
+
+    except Exception as e:
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
 
 
 class State(str, Enum):
@@ -138,21 +412,174 @@ class CreateSimulationSchema(Schema):
 @api.post("simulations/add")
 def add_simulation(request, data:CreateSimulationSchema):
     try:
-        insert_sql = """INSERT INTO simulation (name, state, machine_id, date_updated) 
-                        VALUES (%s, %s, (SELECT id FROM machine WHERE name = %s), NOW())
-                         RETURNING id
-                        """
-        insert_values = (data.name, data.state, data.machine_name)
-        conn = connections['default']
-        with conn.cursor() as cur:
-            cur.execute(insert_sql, insert_values)
-            new_id = cur.fetchone()[0]
-            return {"OK": True,
-                    "message": "created new simulation", "id": new_id}
+        new_id = repository.add_simulation(data.name, data.state, data.machine_name)
+        return {"OK": True,
+                "message": "created new simulation", "id": new_id}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+MAX_BULK_SIZE = 1000
+
+
+class SimulationTransitionSchema(Schema):
+    id: int
+    state: State
+    machine_name: str = None
+
+
+def check_bulk_size(items):
+    if len(items) > MAX_BULK_SIZE:
+        raise ValueError(f"at most {MAX_BULK_SIZE} items can be sent at once")
+
+
+def unique_items(items, key, key_name):
+    """
+    Split the items of a bulk request into the ones to run and the repeats of an earlier item
+    :return: the items to run, and the error result of each repeat by position
+    """
+    seen = set()
+    unique = []
+    repeats = {}
+    for position, item in enumerate(items):
+        if key(item) in seen:
+            repeats[position] = {key_name: key(item), "OK": False, "error": f"{key_name} {key(item)} is repeated"}
+        else:
+            seen.add(key(item))
+            unique.append(item)
+    return unique, repeats
+
+
+def merged_results(count, repeats, results):
+    """:return: the results of the items run and of the repeats, in the order of the request"""
+    results = iter(results)
+    return [repeats[position] if position in repeats else next(results) for position in range(count)]
+
+
+def created_results(simulations, rows):
+    """
+    :param rows: the rows of repository.add_simulations() for the simulations
+    :return: the result of each simulation
+    """
+    results = []
+    for simulation, (new_id, unknown_machine) in zip(simulations, rows):
+        if new_id is not None:
+            results.append({"name": simulation.name, "OK": True, "id": new_id})
+        elif unknown_machine:
+            results.append({"name": simulation.name, "OK": False,
+                            "error": f"machine {simulation.machine_name} not found"})
+        else:
+            results.append({"name": simulation.name, "OK": False,
+                            "error": f"simulation {simulation.name} already exists"})
+    return results
+
+
+def transition_results(transitions, rows):
+    """
+    :param rows: the rows of repository.transition_simulations() for the transitions
+    :return: the result of each transition
+    """
+    results = []
+    for transition, (previous_state, state, machine_id, date_updated, unknown_machine) in zip(transitions, rows):
+        if state is not None:
+            results.append({"id": transition.id, "OK": True, "state": state,
+                            "machine_id": machine_id, "date_updated": date_updated})
+        elif previous_state is None:
+            results.append({"id": transition.id, "OK": False, "error": f"simulation {transition.id} not found"})
+        elif unknown_machine:
+            results.append({"id": transition.id, "OK": False,
+                            "error": f"machine {transition.machine_name} not found"})
+        else:
+            results.append({"id": transition.id, "OK": False,
+                            "error": f"simulation {transition.id} can't go from {previous_state} "
+                                     f"to {transition.state.value}"})
+    return results
+
+
+@api.post("simulations/bulk")
+def add_simulations(request, data: List[CreateSimulationSchema]):
+    """
+    Create many simulations at once (up to 1000), with a single insert.
+    Unlike simulations/add, a simulation whose machine doesn't exist isn't created
+    :return: the result of each simulation, in order, with its id if it was created
+        or the error if its name is taken or its machine doesn't exist
+    """
+    try:
+        check_bulk_size(data)
+        simulations, repeats = unique_items(data, lambda simulation: simulation.name, "name")
+        rows = repository.add_simulations([(simulation.name, simulation.state.value, simulation.machine_name)
+                                           for simulation in simulations])
+        results = merged_results(len(data), repeats, created_results(simulations, rows))
+        logger.info(f"Added {sum(result['OK'] for result in results)} simulations")
+        return {"OK": True,
+                "message": "created simulations", "results": results}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.put("simulations/state")
+def transition_simulations(request, data: List[SimulationTransitionSchema]):
+    """
+    Change the state of many simulations at once (up to 1000), with a single update.
+    A simulation goes from pending to running and from running to finished, and can be
+    given a machine (by name) at the same time. date_updated is set by the trigger of the table
+    :return: the result of each change, in order, with the new state, machine and date_updated
+        or the error if the simulation or the machine doesn't exist or the change isn't allowed
+    """
+    try:
+        check_bulk_size(data)
+        transitions, repeats = unique_items(data, lambda transition: transition.id, "id")
+        rows = repository.transition_simulations([(transition.id, transition.state.value, transition.machine_name)
+                                                  for transition in transitions])
+        return {"OK": True,
+                "message": "changed simulations",
+                "results": merged_results(len(data), repeats, transition_results(transitions, rows))}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+MAX_CLAIM = 100
+
+
+class ClaimSchema(Schema):
+    machine_name: str
+    count: int = Field(1, ge=1, le=MAX_CLAIM)
+    # only the simulations created for this machine, not the ones for any machine
+    assigned_only: bool = False
+
+
+def claimed_simulations(rows):
+    """
+    :param rows: the (id, name, state, date_created, date_updated, machine_id) rows of CLAIM_SIMULATIONS_SQL
+    :return: the claimed simulations, oldest first
+    """
+    fields = ("id", "name", "state", "date_created", "date_updated", "machine_id")
+    return [dict(zip(fields, row)) for row in sorted(rows, key=itemgetter(3, 0))]
+
+
+@api.post("simulations/claim")
+def claim_simulations(request, data: ClaimSchema):
+    """
+    For the workers of the machines: claim the next pending simulations (the oldest first, up to `count`),
+    which become running on the machine. The simulations created for a machine can only be claimed by it,
+    the ones created without one by any machine. Many workers can claim at the same time, they never get
+    the same simulation and don't wait for each other
+    :return: the claimed simulations, an empty list if there are none pending
+    """
+    try:
+        rows = repository.claim_simulations(data.machine_name, data.count, data.assigned_only)
+        if not rows and not repository.machine_exists(data.machine_name):
+            return JsonResponse({"OK": False, "error": f"machine {data.machine_name} not found"}, status=404)
+        return {"OK": True, "simulations": claimed_simulations(rows)}
 
     except Exception as e:
         logger.error(str(e))
-        conn.rollback()
         return JsonResponse({"OK": False, "error": str(e)}, status=400)
 
 
@@ -166,95 +593,496 @@ class SortFields(str, Enum):
 
 
 # dictionary lookup  to avoid SQL injection
+# sort key -> (SQL expression, result field, direction)
+# date_updated can be null, so it sorts as -infinity to keep the order total for paging
+sort_columns = {
+    "name": ("name", "name", "ASC"),
+    "-name": ("name", "name", "DESC"),
+    "created": ("date_created", "date_created", "ASC"),
+    "-created": ("date_created", "date_created", "DESC"),
+    "updated": ("COALESCE(date_updated, '-infinity')", "date_updated", "ASC"),
+    "-updated": ("COALESCE(date_updated, '-infinity')", "date_updated", "DESC"),
+}
+
+# the cursor value is sent as text and cast in SQL, so that any database driver accepts it
+keyset_placeholders = {
+    "name": "%s",
+    "date_created": "%s::text::timestamptz",
+    "date_updated": "%s::text::timestamptz",
+}
+
+# the id is always the tiebreaker, so that the order is stable between pages
 sort_to_sql = {
-    "name": "ORDER BY name ASC",
-    "-name": "ORDER BY name DESC",
-    "created": "ORDER BY date_created ASC",
-    "-created": "ORDER BY date_created DESC",
-    "updated": "ORDER BY date_updated ASC",
-    "-updated": "ORDER BY date_updated DESC"
+    sort: f"ORDER BY {column} {direction}, id {direction}"
+    for sort, (column, field, direction) in sort_columns.items()
 }
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class SearchMode(str, Enum):
+    CONTAINS = 'contains'
+    PREFIX = 'prefix'
+
 
 class SearchSortFilter(Schema):
     sort: Optional[str] = None
     state: Optional[str] = None
+    limit: Optional[int] = Field(None, ge=1, le=MAX_PAGE_SIZE)
+    cursor: Optional[str] = None
+    # the simulations with the text in their name (case insensitive), anywhere in it or at its start
+    search: Optional[str] = Field(None, min_length=1, max_length=30)
+    search_mode: SearchMode = SearchMode.CONTAINS
+    machine: Optional[str] = None
+    # the ranges of dates are from (included) to (excluded)
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+    updated_from: Optional[datetime] = None
+    updated_to: Optional[datetime] = None
 
 
-class SimulationResponse(BaseModel):
-    id: int
-    name: str
-    state: str
-    date_created: datetime
-    date_updated: Optional[datetime]
-    machine_id: Optional[int]
-    link: str   # this should use HTTPUrl, but it gives me an error
+# date filter -> SQL condition, the dates are sent as text and cast like the cursor values
+date_filters = {
+    "created_from": "date_created >= %s::text::timestamptz",
+    "created_to": "date_created < %s::text::timestamptz",
+    "updated_from": "date_updated >= %s::text::timestamptz",
+    "updated_to": "date_updated < %s::text::timestamptz",
+}
+
+
+def like_pattern(search, mode):
+    """
+    :return: the ILIKE pattern matching the names containing (or starting with) the text searched,
+        with the wildcards it may contain escaped so they match themselves
+    """
+    escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"{escaped}%" if mode == SearchMode.PREFIX else f"%{escaped}%"
+
+
+def encode_cursor(sort, row):
+    """
+    Make the opaque cursor pointing after this simulation, it holds the sort key,
+    the value of the sorted column and the id of the row
+    """
+    value = None
+    if sort in sort_columns:
+        value = row[sort_columns[sort][1]]
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif value is None:
+            value = "-infinity"
+    cursor = json.dumps({"sort": sort, "value": value, "id": row["id"]})
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_cursor(cursor, sort):
+    """
+    :return: the sort value and id the cursor points after
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if position["sort"] != sort:
+            raise ValueError("the sort order changed")
+        return position["value"], int(position["id"])
+    except Exception as e:
+        raise ValueError(f"invalid cursor: {e}")
 
 
-@api.get("/simulations", response=List[SimulationResponse])
+def simulation_list_query(filters, columns=SIMULATION_COLUMNS, column_vars=()):
+    """
+    Build the SQL for the simulation list.
+    If a page is asked for (with a limit or a cursor) it selects one more row than the
+    limit, to know if there is a next page, see simulation_page()
+    :param columns: the columns selected, and column_vars the values of their placeholders
+    :return: the SQL string, its placeholder values, the sort key and the page size (None when not paging)
+    """
+    get_machines_sql = f"SELECT {columns} FROM {SIMULATION_TABLES} "
+    where_sql = []
+    placeholder_vars = list(column_vars)
+    if filters.state:
+        where_sql.append("state = %s")
+        placeholder_vars.append(filters.state)
+    if filters.search:
+        # the trigram index of migration 7 finds the names matching anywhere, not only at the start
+        where_sql.append("name ILIKE %s")
+        placeholder_vars.append(like_pattern(filters.search, filters.search_mode))
+    if filters.machine:
+        where_sql.append("machine_id = (SELECT id FROM machine WHERE name = %s)")
+        placeholder_vars.append(filters.machine)
+    for name, condition in date_filters.items():
+        if getattr(filters, name) is not None:
+            where_sql.append(condition)
+            placeholder_vars.append(getattr(filters, name).isoformat())
+
+    sort = filters.sort if filters.sort in sort_columns else None
+    paginate = filters.limit is not None or filters.cursor is not None
+    if filters.cursor:
+        value, last_id = decode_cursor(filters.cursor, sort)
+        if sort:
+            column, field, direction = sort_columns[sort]
+            comparison = ">" if direction == "ASC" else "<"
+            where_sql.append(f"({column}, id) {comparison} ({keyset_placeholders[field]}, %s)")
+            placeholder_vars.extend([value, last_id])
+        else:
+            where_sql.append("id > %s")
+            placeholder_vars.append(last_id)
+
+    if where_sql:
+        get_machines_sql += " WHERE " + " AND ".join(where_sql) + " "
+
+    if sort:
+        get_machines_sql += sort_to_sql[sort]
+    elif paginate:
+        get_machines_sql += "ORDER BY id ASC"
+
+    if not paginate:
+        return get_machines_sql, placeholder_vars, sort, None
+
+    limit = filters.limit or DEFAULT_PAGE_SIZE
+    get_machines_sql += " LIMIT %s"
+    placeholder_vars.append(limit + 1)
+    return get_machines_sql, placeholder_vars, sort, limit
+
+
+def simulation_page(results, sort, limit, build_simulation):
+    """
+    :param results: the rows selected by the simulation_list_query() SQL
+    :return: the page of simulations with the cursor of the next one
+    """
+    items = [build_simulation(result) for result in results[:limit]]
+    next_cursor = encode_cursor(sort, items[-1]) if len(results) > limit else None
+    return {"items": items,
+            "limit": limit,
+            "next": next_cursor}
+
+
+def simulation_json_query(request, filters):
+    """
+    Build the SQL for the simulation list with the simulations as JSON text made by postgres,
+    see simulation_list_query() and repository.SIMULATION_JSON_COLUMNS
+    """
+    return simulation_list_query(filters, SIMULATION_JSON_COLUMNS, detail_link_parts(request))
+
+
+def simulation_json_page(results, sort, limit):
+    """
+    :param results: the (json, id, name, date_created, date_updated) rows of the simulation_json_query() SQL,
+        as dictionaries
+    :return: the JSON text of the page of simulations with the cursor of the next one
+    """
+    items = results[:limit]
+    next_cursor = encode_cursor(sort, items[-1]) if len(results) > limit else None
+    return json_page([item["json"] for item in items], limit, next_cursor)
+
+
+@api.get("/simulations", response=Union[List[SimulationResponse], SimulationPage])
 def simulations(request, filters: Query[SearchSortFilter] = None):
     """
     List of machines, filterable and sortable
+    The list is streamed as it is read from the database,
+    as a JSON array or as NDJSON with `Accept: application/x-ndjson`
+    If a `limit` or a `cursor` is given, one page of at most `limit` simulations is returned
+    with the cursor of the `next` page. The pages use the sort order (keyset pagination)
+    rather than an offset, so every page costs the same to get.
     :param response:
     :param request:
     :return:A list of simulation objects as json
     """
 
     try:
-        get_machines_sql = "SELECT * FROM simulation "
-        placeholder_vars = []
-        if filters.state:
-            get_machines_sql += " WHERE state = %s "
-            placeholder_vars.append(filters.state)
+        if settings.JSON_FROM_DATABASE:
+            return simulations_json(request, filters)
+
+        get_machines_sql, placeholder_vars, sort, limit = simulation_list_query(filters)
+
+        # the rows are built straight into the response, with the link added
+        build_simulation = simulation_builder(request)
+
+        if limit is None:
+            cur = open_streaming_cursor(get_machines_sql, placeholder_vars)
+            return streaming_json_response(request, fetch_batches(cur, transform=build_simulation))
+
+        results = repository.fetch_all(get_machines_sql, placeholder_vars)
+        with serialising(current_stats()):
+            return JsonResponse(simulation_page(results, sort, limit, build_simulation), encoder=NinjaJSONEncoder)
+
+    except Exception as e:
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+def simulations_json(request, filters):
+    """
+    The simulation list with the JSON made by postgres, only joined together here,
+    so the rows never become python objects
+    """
+    get_machines_sql, placeholder_vars, sort, limit = simulation_json_query(request, filters)
+    if limit is None:
+        cur = open_streaming_cursor(get_machines_sql, placeholder_vars)
+        return streaming_json_response(request, fetch_batches(cur, transform=itemgetter(0)), encode=str)
+
+    results = [row._asdict() for row in repository.fetch_all(get_machines_sql, placeholder_vars)]
+    with serialising(current_stats()):
+        return HttpResponse(simulation_json_page(results, sort, limit), content_type="application/json")
+
 
-        if filters.sort:
-            get_machines_sql += sort_to_sql.get(filters.sort, "")
+DEFAULT_COMPARED = 100
+MAX_COMPARED = 1000
+# the percentiles of the losses of the simulations given for each bucket of a comparison
+COMPARISON_PERCENTILES = (10, 25, 50, 75, 90)
 
-        conn = connections['default']
-        conn.ensure_connection()
-        with conn.connection.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(get_machines_sql, placeholder_vars)
-            results = cur.fetchall()
-            for result in results:
 
-                # add the clickable link
-                current_scheme = request.scheme  # 'http' or 'https'
-                current_domain = request.get_host()  # Domain or IP
+class ComparisonFilter(Schema):
+    ids: List[int] = Field(None)
+    state: Optional[State] = None
+    machine: Optional[str] = None
+    # the most recent simulations matching the filters are compared
+    limit: Optional[int] = Field(None, ge=1, le=MAX_COMPARED)
+    buckets: int = Field(100, ge=1, le=10000)
+    bucket_seconds: Optional[int] = Field(None, ge=1)
+    from_seconds: Optional[int] = Field(None, alias="from")
+    to_seconds: Optional[int] = Field(None, alias="to")
+
+
+def comparison_queries(filters):
+    """
+    Build the SQL comparing the loss curves of the simulations selected by the filters.
+    The ranking query gives the simulations with the summary of their loss data, ranked by final loss.
+    The buckets query splits the seconds into buckets (of bucket_seconds, or so that the longest run
+    has `buckets` of them), averages the loss of each simulation in each bucket, and then aggregates
+    these averages across the simulations, so a simulation with more points doesn't weigh more.
+    :return: the SQL of the ranking and its placeholder values, and the SQL of the buckets and its values
+    """
+    where_sql = []
+    placeholder_vars = []
+    if filters.ids:
+        if len(filters.ids) > MAX_COMPARED:
+            raise ValueError(f"at most {MAX_COMPARED} simulations can be compared")
+        where_sql.append("simulation.id = ANY(%s)")
+        placeholder_vars.append(filters.ids)
+    if filters.state:
+        where_sql.append("state = %s")
+        placeholder_vars.append(filters.state.value)
+    if filters.machine:
+        where_sql.append("machine_id = (SELECT id FROM machine WHERE name = %s)")
+        placeholder_vars.append(filters.machine)
+    selected_sql = f"""SELECT {SIMULATION_COLUMNS} FROM {SIMULATION_TABLES}
+                       {"WHERE " + " AND ".join(where_sql) if where_sql else ""}
+                       ORDER BY simulation.date_created DESC, simulation.id DESC LIMIT %s"""
+    placeholder_vars.append(filters.limit or (len(filters.ids) if filters.ids else DEFAULT_COMPARED))
 
-                url = reverse("api-1.0.0:simulation_detail",
-                              kwargs={"simulation_id": result['id']})
-                full_url = f"{current_scheme}://{current_domain}{url}"
+    ranking_sql = f"""WITH selected AS ({selected_sql})
+                      SELECT selected.*, rank() OVER (ORDER BY final_loss ASC NULLS LAST) AS rank
+                      FROM selected ORDER BY rank, id"""
 
-                result.update({"link": full_url})
+    window_sql = ""
+    window_vars = []
+    if filters.from_seconds is not None:
+        window_sql += "AND lossdata.seconds >= %s "
+        window_vars.append(filters.from_seconds)
+    if filters.to_seconds is not None:
+        window_sql += "AND lossdata.seconds <= %s "
+        window_vars.append(filters.to_seconds)
+    percentiles = ", ".join(str(percentile / 100) for percentile in COMPARISON_PERCENTILES)
+    buckets_sql = f"""
+        WITH selected AS ({selected_sql}),
+        width AS (
+            SELECT COALESCE(%s, GREATEST(ceil(max(last_seconds)::numeric / %s::int)::int, 1)) AS seconds FROM selected
+        ), curves AS (
+            SELECT lossdata.simulation_id, lossdata.seconds / width.seconds AS bucket, avg(lossdata.loss) AS loss
+            FROM selected JOIN lossdata ON lossdata.simulation_id = selected.id {window_sql}
+                CROSS JOIN width
+            GROUP BY lossdata.simulation_id, bucket
+        )
+        SELECT bucket * width.seconds AS seconds, width.seconds AS bucket_seconds, count(*) AS simulations,
+               round(avg(loss), 5) AS mean, round(min(loss), 5) AS min, round(max(loss), 5) AS max,
+               percentile_cont(ARRAY[{percentiles}]) WITHIN GROUP (ORDER BY loss::float8) AS percentiles
+        FROM curves CROSS JOIN width
+        GROUP BY bucket, width.seconds
+        ORDER BY bucket"""
+    buckets_vars = placeholder_vars + [filters.bucket_seconds, filters.buckets] + window_vars
+    return ranking_sql, placeholder_vars, buckets_sql, buckets_vars
 
-        return results
+
+def comparison(ranking, buckets):
+    """
+    :param ranking: the rows of the ranking query of comparison_queries(), as dictionaries
+    :param buckets: the rows of its buckets query, as dictionaries
+    :return: the simulations ranked by final loss, and the aggregates of their losses for each bucket of seconds
+    """
+    ranking_fields = ("id", "name", "state", "point_count", "min_loss", "final_loss", "last_seconds", "rank")
+    bucket_fields = ("seconds", "simulations", "mean", "min", "max")
+    return {
+        "simulations": [{field: row[field] for field in ranking_fields} for row in ranking],
+        "bucket_seconds": buckets[0]["bucket_seconds"] if buckets else None,
+        "buckets": [{**{field: row[field] for field in bucket_fields},
+                     **{f"p{percentile}": round(Decimal(value), 5)
+                        for percentile, value in zip(COMPARISON_PERCENTILES, row["percentiles"])}}
+                    for row in buckets],
+    }
+
+
+@api.get("/simulations/compare")
+def compare_simulations(request, filters: Query[ComparisonFilter] = None):
+    """
+    Compare the loss curves of several simulations in one request, rather than downloading all their graphs.
+    The simulations are given by `ids`, or are the most recent ones (up to `limit`, 100 by default)
+    with a `state` and/or on a `machine`
+    :return: the simulations ranked by final loss, and for each bucket of seconds (`buckets` of them over the
+        longest run, or `bucket_seconds` long, optionally only `from` / `to`) the number of simulations with
+        points in it and the mean, min, max and percentiles across them of their average loss in the bucket
+    """
+    try:
+        ranking_sql, ranking_vars, buckets_sql, buckets_vars = comparison_queries(filters)
+        ranking = [row._asdict() for row in repository.fetch_all(ranking_sql, ranking_vars)]
+        buckets = [row._asdict() for row in repository.fetch_all(buckets_sql, buckets_vars)]
+        return JsonResponse(comparison(ranking, buckets), encoder=NinjaJSONEncoder)
 
     except Exception as e:
         return JsonResponse({"OK": False, "error": str(e)}, status=400)
 
 
-class CreateLossData(Schema):
+class LossPoint(Schema):
     seconds: int
     loss: condecimal(max_digits=10, decimal_places=5)
+
+
+class CreateLossData(LossPoint):
     simulation_id: int
 
 
 @api.post("lossdata/add")
 def add_loss_data(request, data: CreateLossData):
     try:
-        insert_sql = """INSERT INTO lossdata (seconds, loss, simulation_id)
-                        VALUES (%s, %s, %s)
-                        RETURNING id
-                        """
-        insert_values = (data.seconds, data.loss, data.simulation_id)
-        conn = connections['default']
-        with conn.cursor() as cur:
-            cur.execute(insert_sql, insert_values)
-            new_id = cur.fetchone()[0]
-            return {"OK": True,
-                    "message": "created new loss data", "id": new_id}
+        new_id = repository.add_loss_point(data.simulation_id, data.seconds, data.loss)
+        invalidate_graph(data.simulation_id)
+        return {"OK": True,
+                "message": "created new loss data", "id": new_id}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+# bytes of a JSON array body read at a time
+JSON_READ_SIZE = 64 * 1024
+
+
+def _json_array_items(request):
+    """
+    Yield the items of the JSON array of the request body, parsed as the body is read, so that
+    it isn't held in memory (nor limited by DATA_UPLOAD_MAX_MEMORY_SIZE, like request.body is)
+    """
+    decoder = json.JSONDecoder()
+    # a read can end in the middle of a character
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    text, position, done = "", 0, False
+
+    def read_more():
+        nonlocal text, position, done
+        chunk = request.read(JSON_READ_SIZE)
+        done = not chunk
+        text, position = text[position:] + utf8.decode(chunk, final=done), 0
+
+    def next_char():
+        """:return: the next character that isn't whitespace, without consuming it, "" at the end of the body"""
+        nonlocal position
+        while True:
+            while position < len(text) and text[position].isspace():
+                position += 1
+            if position < len(text):
+                return text[position]
+            if done:
+                return ""
+            read_more()
+
+    if next_char() != "[":
+        raise ValueError("expected a JSON array of loss points")
+    position += 1
+    separator = None
+    while True:
+        char = next_char()
+        if char == "]":
+            position += 1
+            break
+        if separator:
+            if char != ",":
+                raise ValueError(f"invalid JSON array, expected ',' or ']' instead of {char!r}")
+            position += 1
+            next_char()
+        separator = ","
+        while True:
+            # an item that ends with the text read so far may go on in the next read (e.g. a number)
+            try:
+                item, end = decoder.raw_decode(text, position)
+                if end < len(text) or done:
+                    break
+            except json.JSONDecodeError:
+                if done:
+                    raise
+            read_more()
+        position = end
+        yield item
+    if next_char():
+        raise ValueError("unexpected data after the JSON array")
+
+
+def _raw_loss_points(request):
+    """
+    Yield the loss points from the request body as dictionaries.
+    JSON arrays are the default, NDJSON and CSV are read line by line,
+    so that batches of any size are never held in memory.
+    """
+    content_type = request.content_type
+    if content_type == "application/x-ndjson":
+        for line in request:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+    elif content_type == "text/csv":
+        reader = csv.reader(line.decode() for line in request)
+        for row in reader:
+            if not row or row == ["seconds", "loss"]:
+                # blank lines and the (optional) header row
+                continue
+            seconds, loss = row
+            yield {"seconds": seconds, "loss": loss}
+
+    else:
+        yield from _json_array_items(request)
+
+
+@api.post("/simulations/{simulation_id}/lossdata/bulk")
+def add_loss_data_bulk(request, simulation_id: int):
+    """
+    Add a batch of loss data points to a simulation.
+    The body is a JSON array of {"seconds", "loss"} objects, or the same
+    points as NDJSON (application/x-ndjson) or CSV (text/csv). Every point is
+    validated like lossdata/add, and the whole batch is written with a single
+    COPY in one transaction, so either all the points are stored or none.
+    :return: the number of points created
+    """
+    count = 0
+
+    def copy_lines():
+        nonlocal count
+        for raw_point in _raw_loss_points(request):
+            try:
+                point = LossPoint(**raw_point)
+            except ValidationError as e:
+                raise ValueError(f"invalid loss point {count + 1}: {e}")
+            count += 1
+            yield f"{point.seconds},{point.loss},{simulation_id}\n"
+
+    try:
+        with transaction.atomic(using='default'):
+            repository.copy_loss_points(repository.LineFile(copy_lines()))
+        logger.info(f"Added {count} loss data points to simulation {simulation_id}")
+        invalidate_graph(simulation_id)
+        return {"OK": True,
+                "message": "created loss data", "count": count}
 
     except Exception as e:
         logger.error(str(e))
-        conn.rollback()
         return JsonResponse({"OK": False, "error": str(e)}, status=400)
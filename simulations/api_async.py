@@ -0,0 +1,505 @@
+"""
+Async versions of the endpoints in simulations.api, for running under ASGI
+(set API_MODE=async, see origenai/urls.py).
+
+They use an asyncpg connection pool rather than django's connections, so a worker
+doesn't block while waiting on the database and can serve many requests at the same time.
+The SQL and the schemas are the ones of the sync endpoints, the queries are only
+converted to asyncpg's $1, $2... placeholders.
+"""
+import logging
+from operator import itemgetter
+from typing import List, Optional, Union
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from ninja import NinjaAPI, Query
+from ninja.responses import NinjaJSONEncoder
+from pydantic import ValidationError
+
+from simulations.api import (ClaimSchema, ComparisonFilter, CreateLossData, CreateMachineSchema,
+                             CreateSimulationSchema, DetailFilter, GraphFilter, LossPoint, SearchSortFilter,
+                             SimulationTransitionSchema, State, UpdateMachineSchema, _raw_loss_points,
+                             binary_graph_query, check_bulk_size, claimed_simulations, comparison, comparison_queries,
+                             created_results, detail_query, graph_cursor, graph_increment, incremental_graph_query,
+                             loss_data_query, merged_results, simulation_detail_response, simulation_json_page,
+                             simulation_json_query, simulation_list_query, simulation_page, transition_results,
+                             unique_items)
+from simulations.async_db import get_pool, routed_pool
+from simulations.cache import (MACHINES_CACHE_KEY, acache_entry, acached_entry, agraph_cache_key, ainvalidate_graph,
+                               ainvalidate_machines, etag_response)
+from simulations.connection_stats import SERVER_CONNECTIONS_SQL
+from simulations.events import event_stream, get_hub, open_streams
+from simulations.instrumentation import metrics_text
+from simulations.repository import (ADD_SIMULATIONS_SQL, CLAIM_SIMULATIONS_SQL, MACHINE_COLUMNS, MACHINES_JSON_SQL,
+                                    STREAM_BATCH_SIZE, TRANSITION_SIMULATIONS_SQL, numbered_placeholders)
+from simulations.responses import (BINARY_GRAPH_CONTENT_TYPE, SimulationPage, SimulationResponse, async_json_chunks,
+                                   binary_graph, json_encoder, loss_point, simulation_builder, streaming_json_response,
+                                   wants_binary_graph)
+
+logger = logging.getLogger(__name__)
+
+# the same url namespace as the sync api, only one of them is mounted
+api = NinjaAPI()
+
+async def fetch_batches(sql, placeholder_vars, transform=None):
+    """
+    Async generator of lists of rows, read from a server side cursor
+    on a connection that is held until all the rows have been fetched
+    :param transform: optional function applied to every row, they are turned into dictionaries otherwise
+    """
+    transform = transform or dict
+    alias, pool = await routed_pool()
+    async with pool.acquire() as conn:
+        if connections[alias].settings_dict.get("DISABLE_SERVER_SIDE_CURSORS"):
+            records = await conn.fetch(numbered_placeholders(sql), *placeholder_vars)
+            for start in range(0, len(records), STREAM_BATCH_SIZE):
+                yield [transform(record) for record in records[start:start + STREAM_BATCH_SIZE]]
+            return
+
+        # cursors only exist inside a transaction
+        async with conn.transaction():
+            cursor = await conn.cursor(numbered_placeholders(sql), *placeholder_vars)
+            while True:
+                records = await cursor.fetch(STREAM_BATCH_SIZE)
+                if not records:
+                    break
+                yield [transform(record) for record in records]
+
+
+async def started(batches):
+    """
+    Fetch the first batch straight away, so that SQL errors are raised in the view
+    rather than once the response has started
+    :return: an async generator of all the batches
+    """
+    try:
+        first = await batches.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def all_batches():
+        if first is not None:
+            yield first
+            async for rows in batches:
+                yield rows
+    return all_batches()
+
+
+@api.get("/hello")
+async def hello(request):
+    """
+    A simple endpoint to test connectivity
+    :param request:
+    :return: dictionary containg a welcome message
+    """
+    return {"msg": "Hello World"}
+
+
+@api.get("/db/stats")
+async def db_stats(request):
+    """
+    Connection numbers, to size the pool under load
+    :return: the size of this worker's pool, how many of its connections are idle,
+        the number of event streams it serves and the connections the database server has by state
+    """
+    try:
+        pool = await get_pool()
+        server_connections = dict(await pool.fetch(SERVER_CONNECTIONS_SQL))
+        return {"mode": "async",
+                "pool": {"min_size": pool.get_min_size(),
+                         "max_size": pool.get_max_size(),
+                         "size": pool.get_size(),
+                         "idle": pool.get_idle_size()},
+                "event_streams": open_streams(),
+                "server_connections": server_connections}
+
+    except Exception as e:
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.get("/metrics")
+async def metrics(request):
+    """
+    Histograms of the request and serialisation times of each endpoint,
+    since this worker started, in the Prometheus text format
+    """
+    return HttpResponse(metrics_text(), content_type="text/plain; version=0.0.4")
+
+
+@api.post("/machines/add")
+async def add_machine(request, data: CreateMachineSchema):
+    """
+    Add a machine
+    """
+    try:
+        insert_sql = "INSERT INTO machine (name, location) values (%s,%s) RETURNING id"
+        pool = await get_pool()
+        new_id = await pool.fetchval(numbered_placeholders(insert_sql), data.name, data.location)
+        logger.info(f"New machine added id: {new_id}")
+        await ainvalidate_machines()
+        return {"OK": True, "message": "created new machine", "id": new_id}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.put("/machines/{machine_id}/change")
+async def update_machines(request, machine_id: int, data: UpdateMachineSchema):
+    """
+    Change the name and location of a machine
+    """
+    try:
+        update_sql = "UPDATE machine SET name = %s, location = %s WHERE id = %s RETURNING id"
+        pool = await get_pool()
+        if await pool.fetchval(numbered_placeholders(update_sql), data.name, data.location, machine_id) is None:
+            return JsonResponse({"OK": False, "error": f"machine {machine_id} not found"}, status=404)
+        await ainvalidate_machines()
+        return {"OK": True, "message": "updated machine", "id": machine_id}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.get("/machines")
+async def machines(request):
+    """
+    Get the list of machines
+    The list is cached until a machine is added or changed, and has an ETag
+    so that clients can use If-None-Match
+    :param request:
+    :return: A list of machines
+    """
+    try:
+        entry = await acached_entry(MACHINES_CACHE_KEY)
+        if entry is None:
+            pool = await get_pool()
+            if settings.JSON_FROM_DATABASE:
+                body = (await pool.fetchval(MACHINES_JSON_SQL)).encode()
+            else:
+                get_machines_sql = f"SELECT {MACHINE_COLUMNS} FROM machine ORDER BY id"
+                results = [dict(record) for record in await pool.fetch(get_machines_sql)]
+                body = json_encoder.encode(results).encode()
+            entry = await acache_entry(MACHINES_CACHE_KEY, body, "application/json")
+        return etag_response(request, entry)
+
+    except Exception as e:
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.get("simulations/{simulation_id}/graph")
+async def convergence_graph(request, simulation_id: int, filters: Query[GraphFilter] = None):
+    """
+    Get the convergence graph for a specific simulation
+    Use `points` to get a downsampled series of at most that many points,
+    and `from` / `to` to only get part of the run (in seconds)
+    The points are streamed as a JSON array, or as NDJSON with `Accept: application/x-ndjson`
+    `format=binary` (or `Accept: application/vnd.origenai.graph`) gets them as arrays of
+    int32 seconds and float32 losses instead, see responses.binary_graph()
+    The graph of a finished simulation doesn't change, so it is cached (with an ETag) instead
+    To poll a running simulation, give `after_seconds` and `after_id` (of the last point the client has)
+    or `since_id` to only get the points added since, as {"points": [...], "after_seconds": ..., "after_id": ..., "more": ...}
+    with the values to give in the next poll (at most `limit` points at a time)
+    :return:
+    """
+    try:
+        cursor = graph_cursor(filters)
+        if cursor is not None:
+            incremental_sql, placeholder_vars, limit = incremental_graph_query(simulation_id, filters, cursor)
+            pool = await get_pool()
+            rows = await pool.fetch(numbered_placeholders(incremental_sql), *placeholder_vars)
+            return JsonResponse(graph_increment(rows, cursor, limit), encoder=NinjaJSONEncoder)
+
+        get_loss_data_sql, placeholder_vars = loss_data_query(simulation_id, filters)
+        key = await agraph_cache_key(request, simulation_id)
+        entry = await acached_entry(key)
+        if entry is None:
+            pool = await get_pool()
+            state = await pool.fetchval("SELECT state FROM simulation WHERE id = $1", simulation_id)
+            if wants_binary_graph(request, filters):
+                row = await pool.fetchrow(numbered_placeholders(binary_graph_query(get_loss_data_sql)),
+                                          *placeholder_vars)
+                body = binary_graph(row["count"], row["seconds"], row["losses"])
+                if state != State.FINISHED:
+                    return HttpResponse(body, content_type=BINARY_GRAPH_CONTENT_TYPE)
+                return etag_response(request, await acache_entry(key, body, BINARY_GRAPH_CONTENT_TYPE))
+
+            batches = await started(fetch_batches(get_loss_data_sql, placeholder_vars, transform=loss_point))
+            if state != State.FINISHED:
+                return streaming_json_response(request, batches)
+
+            chunks, content_type = async_json_chunks(request, batches)
+            entry = await acache_entry(key, "".join([chunk async for chunk in chunks]).encode(), content_type)
+        return etag_response(request, entry)
+
+    except Exception as e:
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.get("simulations/{simulation_id}/events")
+async def simulation_events(request, simulation_id: int, after: Optional[int] = None):
+    """
+    Server-sent events (text/event-stream) of a simulation as it runs: a `state` event with its
+    state, then a `lossdata` event with the new points (a JSON array, like the graph) whenever
+    some are added, and a `state` event whenever its state changes. The stream ends when it is finished.
+    The id of a `lossdata` event is the seconds of its last point. Browsers send it back in the
+    Last-Event-ID header when they reconnect, or give it as `after` (e.g. the last point of the graph)
+    to get the points added since then first.
+    """
+    hub = subscription = None
+    try:
+        last_event_id = request.headers.get("Last-Event-ID")
+        if last_event_id:
+            after = int(last_event_id)
+        hub = await get_hub()
+        # subscribed before reading the state and the points, so that nothing added meanwhile is missed
+        subscription = hub.subscribe(simulation_id)
+        pool = await get_pool()
+        state = await pool.fetchval("SELECT state FROM simulation WHERE id = $1", simulation_id)
+        if state is None:
+            hub.unsubscribe(subscription)
+            return JsonResponse({"OK": False, "error": f"simulation {simulation_id} not found"}, status=404)
+
+    except Exception as e:
+        if subscription is not None:
+            hub.unsubscribe(subscription)
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+    response = StreamingHttpResponse(event_stream(hub, subscription, state, after), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # nginx would otherwise buffer the events
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@api.get("/simulations/{simulation_id}/detail", url_name="simulation_detail")
+async def simulation_detail(request, simulation_id: int, filters: Query[DetailFilter] = None):
+    """
+    Get detail for one simulation, with its machine and optionally a preview of its graph
+    (`preview` points, the last ones or with `preview_mode=downsampled` the whole graph downsampled)
+    """
+    try:
+        detail_sql, placeholder_vars = detail_query(simulation_id, filters)
+        pool = await get_pool()
+        result = await pool.fetchrow(numbered_placeholders(detail_sql), *placeholder_vars)
+        if result is None:
+            return JsonResponse({"OK": False, "error": f"simulation {simulation_id} not found"}, status=404)
+        return simulation_detail_response(dict(result))
+
+    except Exception as e:
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.post("simulations/add")
+async def add_simulation(request, data: CreateSimulationSchema):
+    try:
+        insert_sql = """INSERT INTO simulation (name, state, machine_id, date_updated)
+                        VALUES (%s, %s, (SELECT id FROM machine WHERE name = %s), NOW())
+                         RETURNING id
+                        """
+        pool = await get_pool()
+        new_id = await pool.fetchval(numbered_placeholders(insert_sql), data.name, data.state.value, data.machine_name)
+        return {"OK": True,
+                "message": "created new simulation", "id": new_id}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.post("simulations/bulk")
+async def add_simulations(request, data: List[CreateSimulationSchema]):
+    """
+    Create many simulations at once (up to 1000), with a single insert.
+    Unlike simulations/add, a simulation whose machine doesn't exist isn't created
+    :return: the result of each simulation, in order, with its id if it was created
+        or the error if its name is taken or its machine doesn't exist
+    """
+    try:
+        check_bulk_size(data)
+        simulations, repeats = unique_items(data, lambda simulation: simulation.name, "name")
+        pool = await get_pool()
+        rows = await pool.fetch(numbered_placeholders(ADD_SIMULATIONS_SQL),
+                                [simulation.name for simulation in simulations],
+                                [simulation.state.value for simulation in simulations],
+                                [simulation.machine_name for simulation in simulations])
+        results = merged_results(len(data), repeats, created_results(simulations, rows))
+        logger.info(f"Added {sum(result['OK'] for result in results)} simulations")
+        return {"OK": True,
+                "message": "created simulations", "results": results}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.put("simulations/state")
+async def transition_simulations(request, data: List[SimulationTransitionSchema]):
+    """
+    Change the state of many simulations at once (up to 1000), with a single update.
+    A simulation goes from pending to running and from running to finished, and can be
+    given a machine (by name) at the same time. date_updated is set by the trigger of the table
+    :return: the result of each change, in order, with the new state, machine and date_updated
+        or the error if the simulation or the machine doesn't exist or the change isn't allowed
+    """
+    try:
+        check_bulk_size(data)
+        transitions, repeats = unique_items(data, lambda transition: transition.id, "id")
+        pool = await get_pool()
+        rows = await pool.fetch(numbered_placeholders(TRANSITION_SIMULATIONS_SQL),
+                                [transition.id for transition in transitions],
+                                [transition.state.value for transition in transitions],
+                                [transition.machine_name for transition in transitions])
+        return {"OK": True,
+                "message": "changed simulations",
+                "results": merged_results(len(data), repeats, transition_results(transitions, rows))}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.post("simulations/claim")
+async def claim_simulations(request, data: ClaimSchema):
+    """
+    For the workers of the machines: claim the next pending simulations (the oldest first, up to `count`),
+    which become running on the machine. The simulations created for a machine can only be claimed by it,
+    the ones created without one by any machine. Many workers can claim at the same time, they never get
+    the same simulation and don't wait for each other
+    :return: the claimed simulations, an empty list if there are none pending
+    """
+    try:
+        pool = await get_pool()
+        rows = await pool.fetch(numbered_placeholders(CLAIM_SIMULATIONS_SQL),
+                                data.machine_name, data.assigned_only, data.count)
+        if not rows and not await pool.fetchval("SELECT EXISTS (SELECT 1 FROM machine WHERE name = $1)",
+                                                data.machine_name):
+            return JsonResponse({"OK": False, "error": f"machine {data.machine_name} not found"}, status=404)
+        return {"OK": True, "simulations": claimed_simulations(rows)}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.get("/simulations", response=Union[List[SimulationResponse], SimulationPage])
+async def simulations(request, filters: Query[SearchSortFilter] = None):
+    """
+    List of machines, filterable and sortable
+    The list is streamed as it is read from the database,
+    as a JSON array or as NDJSON with `Accept: application/x-ndjson`
+    If a `limit` or a `cursor` is given, one page of at most `limit` simulations is returned
+    with the cursor of the `next` page. The pages use the sort order (keyset pagination)
+    rather than an offset, so every page costs the same to get.
+    :return:A list of simulation objects as json
+    """
+    try:
+        if settings.JSON_FROM_DATABASE:
+            return await simulations_json(request, filters)
+
+        get_machines_sql, placeholder_vars, sort, limit = simulation_list_query(filters)
+        build_simulation = simulation_builder(request)
+
+        if limit is None:
+            batches = await started(fetch_batches(get_machines_sql, placeholder_vars, transform=build_simulation))
+            return streaming_json_response(request, batches)
+
+        pool = await get_pool()
+        results = await pool.fetch(numbered_placeholders(get_machines_sql), *placeholder_vars)
+        return JsonResponse(simulation_page(results, sort, limit, build_simulation), encoder=NinjaJSONEncoder)
+
+    except Exception as e:
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+async def simulations_json(request, filters):
+    """
+    The simulation list with the JSON made by postgres, see api.simulations_json()
+    """
+    get_machines_sql, placeholder_vars, sort, limit = simulation_json_query(request, filters)
+    if limit is None:
+        batches = await started(fetch_batches(get_machines_sql, placeholder_vars, transform=itemgetter(0)))
+        return streaming_json_response(request, batches, encode=str)
+
+    pool = await get_pool()
+    results = [dict(record) for record in await pool.fetch(numbered_placeholders(get_machines_sql), *placeholder_vars)]
+    return HttpResponse(simulation_json_page(results, sort, limit), content_type="application/json")
+
+
+@api.get("/simulations/compare")
+async def compare_simulations(request, filters: Query[ComparisonFilter] = None):
+    """
+    Compare the loss curves of several simulations in one request, rather than downloading all their graphs.
+    The simulations are given by `ids`, or are the most recent ones (up to `limit`, 100 by default)
+    with a `state` and/or on a `machine`
+    :return: the simulations ranked by final loss, and for each bucket of seconds (`buckets` of them over the
+        longest run, or `bucket_seconds` long, optionally only `from` / `to`) the number of simulations with
+        points in it and the mean, min, max and percentiles across them of their average loss in the bucket
+    """
+    try:
+        ranking_sql, ranking_vars, buckets_sql, buckets_vars = comparison_queries(filters)
+        pool = await get_pool()
+        ranking = [dict(record) for record in await pool.fetch(numbered_placeholders(ranking_sql), *ranking_vars)]
+        buckets = [dict(record) for record in await pool.fetch(numbered_placeholders(buckets_sql), *buckets_vars)]
+        return JsonResponse(comparison(ranking, buckets), encoder=NinjaJSONEncoder)
+
+    except Exception as e:
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.post("lossdata/add")
+async def add_loss_data(request, data: CreateLossData):
+    try:
+        insert_sql = """INSERT INTO lossdata (seconds, loss, simulation_id)
+                        VALUES (%s, %s, %s)
+                        RETURNING id
+                        """
+        pool = await get_pool()
+        new_id = await pool.fetchval(numbered_placeholders(insert_sql), data.seconds, data.loss, data.simulation_id)
+        await ainvalidate_graph(data.simulation_id)
+        return {"OK": True,
+                "message": "created new loss data", "id": new_id}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
+
+
+@api.post("/simulations/{simulation_id}/lossdata/bulk")
+async def add_loss_data_bulk(request, simulation_id: int):
+    """
+    Add a batch of loss data points to a simulation.
+    The body is a JSON array of {"seconds", "loss"} objects, or the same
+    points as NDJSON (application/x-ndjson) or CSV (text/csv). Every point is
+    validated like lossdata/add, and the whole batch is written with a single
+    (binary) COPY in one transaction, so either all the points are stored or none.
+    :return: the number of points created
+    """
+    count = 0
+
+    def records():
+        nonlocal count
+        for raw_point in _raw_loss_points(request):
+            try:
+                point = LossPoint(**raw_point)
+            except ValidationError as e:
+                raise ValueError(f"invalid loss point {count + 1}: {e}")
+            count += 1
+            yield point.seconds, point.loss, simulation_id
+
+    try:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            await conn.copy_records_to_table("lossdata", records=records(),
+                                             columns=["seconds", "loss", "simulation_id"])
+        logger.info(f"Added {count} loss data points to simulation {simulation_id}")
+        await ainvalidate_graph(simulation_id)
+        return {"OK": True,
+                "message": "created loss data", "count": count}
+
+    except Exception as e:
+        logger.error(str(e))
+        return JsonResponse({"OK": False, "error": str(e)}, status=400)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class SimulationsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'simulations'
+
+    def ready(self):
+        from simulations.connection_stats import connect_signals
+        connect_signals()
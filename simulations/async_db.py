@@ -0,0 +1,80 @@
+"""
+The asyncpg connection pools of the async endpoints (simulations.api_async) and of the event streams
+(simulations.events), one per event loop and database (the primary, and the replica when reads go to it).
+"""
+import asyncio
+import weakref
+
+import asyncpg
+from django.conf import settings
+from django.db import connections
+
+from simulations import routing
+
+# the pools of each event loop by database alias, asyncpg connections can't be shared between loops
+_pools = weakref.WeakKeyDictionary()
+
+
+def connect_kwargs(alias=routing.PRIMARY):
+    # the settings of the django connection, so that tests get the test database
+    db = connections[alias].settings_dict
+    kwargs = {
+        "host": db["HOST"] or None,
+        "port": db["PORT"] or None,
+        "user": db["USER"] or None,
+        "password": db["PASSWORD"] or None,
+        "database": db["NAME"],
+        "server_settings": {"timezone": settings.TIME_ZONE},
+    }
+    if db.get("DISABLE_SERVER_SIDE_CURSORS"):
+        # pgbouncer (transaction pooling) can't keep prepared statements or startup settings
+        kwargs["statement_cache_size"] = 0
+    else:
+        kwargs["server_settings"]["statement_timeout"] = str(settings.DB_STATEMENT_TIMEOUT)
+    return kwargs
+
+
+async def get_pool(alias=None):
+    """
+    :param alias: the database, by default the one of the request (see simulations.routing)
+    :return: the connection pool to it of the running event loop, created on first use
+    """
+    alias, pool = await routed_pool(alias)
+    return pool
+
+
+async def routed_pool(alias=None):
+    """
+    Same as get_pool()
+    :return: the alias of the database the pool is connected to (the primary if the one asked for is down)
+        and the pool
+    """
+    alias = alias or routing.database_alias()
+    pools = _pools.setdefault(asyncio.get_running_loop(), {})
+    if alias not in pools:
+        # a future, so that concurrent first requests wait for the same pool
+        pools[alias] = asyncio.ensure_future(asyncpg.create_pool(
+            min_size=settings.ASYNC_DB_POOL["MIN_SIZE"],
+            max_size=settings.ASYNC_DB_POOL["MAX_SIZE"],
+            max_inactive_connection_lifetime=settings.ASYNC_DB_POOL["MAX_INACTIVE_LIFETIME"],
+            **connect_kwargs(alias)))
+    try:
+        return alias, await pools[alias]
+    except (OSError, asyncpg.PostgresError) as e:
+        # so that the next request tries again
+        pools.pop(alias, None)
+        if alias == routing.PRIMARY:
+            raise
+        return await routed_pool(routing.fall_back(alias, e))
+
+
+async def close_pool(alias=None):
+    """Close the pools of the running event loop, or only its pool to that database, if there are any"""
+    loop = asyncio.get_running_loop()
+    if alias is None:
+        pools = _pools.pop(loop, {})
+    else:
+        pools = {alias: _pools[loop].pop(alias)} if alias in _pools.get(loop, {}) else {}
+    for pool_task in pools.values():
+        if not pool_task.done() or pool_task.exception() is None:
+            await (await pool_task).close()
@@ -0,0 +1,257 @@
+"""
+Bulk loading of machines, simulations and loss data from large JSON, NDJSON or CSV files,
+used by the load_fixtures command to seed or restore a database.
+
+The files are read as a stream, so they don't have to fit in memory. The records are validated
+in batches with the schemas of the add endpoints, written to a temporary staging table with COPY,
+and then inserted from it in one statement, which resolves the machine and simulation names
+to their ids in SQL. Everything runs in the caller's transaction.
+"""
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel, TypeAdapter, ValidationError, create_model
+
+from simulations import repository
+from simulations.api import CreateMachineSchema, CreateSimulationSchema, LossPoint
+
+FORMATS = ("json", "ndjson", "csv")
+
+# file extension -> format
+EXTENSION_FORMATS = {
+    ".json": "json",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".csv": "csv",
+}
+
+DEFAULT_BATCH_SIZE = 10000
+
+# size of the reads of the JSON arrays
+READ_SIZE = 64 * 1024
+
+
+class SimulationRecord(CreateSimulationSchema):
+    date_created: Optional[datetime] = None
+    date_updated: Optional[datetime] = None
+
+
+class LossDataRecord(LossPoint):
+    """A loss point of the simulation with that id, or with that name (ids differ between databases)"""
+    simulation_id: Optional[int] = None
+    simulation_name: Optional[str] = None
+
+
+# schema: validates the records
+# columns: the fields of the records copied into the staging table
+# staging: the columns of the staging table
+# insert: the statement copying the staging table into the real one, skipping the existing names
+Dataset = namedtuple("Dataset", "schema columns staging insert")
+
+DATASETS = {
+    "machines": Dataset(
+        CreateMachineSchema,
+        ("name", "location"),
+        "name text, location text",
+        """INSERT INTO machine (name, location)
+           SELECT name, location FROM load_machines
+           ON CONFLICT (name) DO NOTHING"""),
+
+    # like simulations/add, a simulation whose machine doesn't exist has no machine
+    "simulations": Dataset(
+        SimulationRecord,
+        ("name", "state", "machine_name", "date_created", "date_updated"),
+        "name text, state text, machine_name text, date_created timestamptz, date_updated timestamptz",
+        """INSERT INTO simulation (name, state, machine_id, date_created, date_updated)
+           SELECT load.name, load.state, machine.id,
+                  COALESCE(load.date_created, CURRENT_TIMESTAMP), COALESCE(load.date_updated, CURRENT_TIMESTAMP)
+           FROM load_simulations load LEFT JOIN machine ON machine.name = load.machine_name
+           ON CONFLICT (name) DO NOTHING"""),
+
+    "lossdata": Dataset(
+        LossDataRecord,
+        ("seconds", "loss", "simulation_id", "simulation_name"),
+        "seconds integer, loss numeric(10, 5), simulation_id integer, simulation_name text",
+        """INSERT INTO lossdata (seconds, loss, simulation_id)
+           SELECT load.seconds, load.loss, COALESCE(load.simulation_id, simulation.id)
+           FROM load_lossdata load LEFT JOIN simulation ON simulation.name = load.simulation_name"""),
+}
+
+# the loss data whose simulation can't be found, checked before inserting it
+MISSING_SIMULATIONS_SQL = """
+    SELECT DISTINCT COALESCE(load.simulation_name, load.simulation_id::text) AS simulation
+    FROM load_lossdata load
+    WHERE NOT EXISTS (SELECT 1 FROM simulation
+                      WHERE simulation.id = load.simulation_id OR simulation.name = load.simulation_name)
+    LIMIT 5"""
+
+LOADED_SIMULATIONS_SQL = """
+    SELECT DISTINCT COALESCE(load.simulation_id, simulation.id) AS simulation_id
+    FROM load_lossdata load LEFT JOIN simulation ON simulation.name = load.simulation_name"""
+
+
+def file_format(path, requested=None):
+    """:return: the requested format, or the format given by the extension of the file"""
+    if requested:
+        return requested
+    for extension, extension_format in EXTENSION_FORMATS.items():
+        if path.endswith(extension):
+            return extension_format
+    raise ValueError(f"can't tell the format of {path}, give it with --format")
+
+
+def iter_json_array(file, read_size=READ_SIZE):
+    """
+    Yield the values of the JSON array in the file one at a time, reading it in chunks
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof = "", 0, False
+    expected = "["
+    while True:
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ValueError("unexpected end of the JSON array")
+            buffer, position = file.read(read_size), 0
+            eof = not buffer
+            continue
+
+        char = buffer[position]
+        if expected == "[":
+            if char != "[":
+                raise ValueError("expected a JSON array")
+            position += 1
+            expected = "first value"
+        elif expected == "separator" or (expected == "first value" and char == "]"):
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"expected ',' or ']' in the JSON array, got {char!r}")
+            position += 1
+            expected = "value"
+        else:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                end = None
+            # a value ending at the end of the buffer (e.g. a number) may continue in the next chunk
+            if end is None or (end == len(buffer) and not eof):
+                chunk = file.read(read_size)
+                buffer, position = buffer[position:] + chunk, 0
+                eof = not chunk
+                continue
+            yield value
+            position = end
+            expected = "separator"
+
+
+def read_records(file, records_format):
+    """
+    Yield the records of the file as dictionaries
+    :param records_format: json (an array of objects), ndjson (one object per line) or csv (with a header row)
+    """
+    if records_format == "json":
+        yield from iter_json_array(file)
+    elif records_format == "ndjson":
+        for line in file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+    elif records_format == "csv":
+        for row in csv.DictReader(file):
+            # empty cells are missing values
+            yield {field: value for field, value in row.items() if value != ""}
+    else:
+        raise ValueError(f"unknown format {records_format}")
+
+
+def batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_value(value):
+    # the enums (the simulation state) are copied as their value
+    return getattr(value, "value", value)
+
+
+def plain_model(schema):
+    """
+    A pydantic model with the fields of the ninja schema. Ninja wraps every object it validates
+    to read django models, which is most of the time spent validating plain dictionaries
+    """
+    fields = {name: (field.annotation, field) for name, field in schema.model_fields.items()}
+    return create_model(schema.__name__, __base__=BaseModel, **fields)
+
+
+def copy_chunks(dataset_name, records, batch_size, progress):
+    """
+    Validate the records in batches and yield each batch as CSV lines for COPY
+    :param progress: function called with the number of records validated so far
+    """
+    dataset = DATASETS[dataset_name]
+    validator = TypeAdapter(List[plain_model(dataset.schema)])
+    count = 0
+    for batch in batches(records, batch_size):
+        try:
+            validated = validator.validate_python(batch)
+        except ValidationError as e:
+            error = e.errors()[0]
+            index, *field = error["loc"]
+            where = f" ({'.'.join(map(str, field))})" if field else ""
+            raise ValueError(f"invalid {dataset_name} record {count + index + 1}{where}: {error['msg']}")
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        # None is written as an empty unquoted value, which COPY reads as NULL
+        writer.writerows([csv_value(getattr(record, column)) for column in dataset.columns] for record in validated)
+        count += len(validated)
+        yield out.getvalue()
+        progress(count)
+
+
+def load(cursor, dataset_name, file, records_format, batch_size=DEFAULT_BATCH_SIZE, progress=lambda count: None):
+    """
+    Load the records of the file into its table
+    :param dataset_name: machines, simulations or lossdata
+    :return: the number of records read, the number inserted (the machines and simulations
+        whose name already exists are skipped), and for the loss data the ids of the simulations loaded
+    """
+    dataset = DATASETS[dataset_name]
+    staging = f"load_{dataset_name}"
+    # from an earlier load in the same transaction. Only a temporary table, never a table of that name in public
+    cursor.execute(f"DROP TABLE IF EXISTS pg_temp.{staging}")
+    cursor.execute(f"CREATE TEMPORARY TABLE {staging} ({dataset.staging}) ON COMMIT DROP")
+
+    chunks = copy_chunks(dataset_name, read_records(file, records_format), batch_size, progress)
+    cursor.copy_expert(f"COPY {staging} ({', '.join(dataset.columns)}) FROM STDIN WITH (FORMAT csv)",
+                       repository.LineFile(chunks))
+    cursor.execute(f"SELECT count(*) AS records FROM {staging}")
+    records = cursor.fetchone()[0]
+
+    simulation_ids = []
+    if dataset_name == "lossdata":
+        cursor.execute(MISSING_SIMULATIONS_SQL)
+        missing = [row[0] for row in cursor.fetchall()]
+        if missing:
+            raise ValueError(f"loss data of unknown simulations: {', '.join(map(str, missing))}")
+        cursor.execute(LOADED_SIMULATIONS_SQL)
+        simulation_ids = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute(dataset.insert)
+    inserted = cursor.rowcount
+    cursor.execute(f"DROP TABLE {staging}")
+    return records, inserted, simulation_ids
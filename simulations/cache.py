@@ -0,0 +1,117 @@
+"""
+Response cache for the endpoints whose data rarely or never changes:
+the machine list, and the convergence graph of finished simulations.
+
+The responses are kept in the django cache (local memory by default, see CACHES in
+the settings) with an ETag, so clients sending If-None-Match get a 304 without a body.
+The local memory cache is per process, so use redis when running several workers,
+otherwise an invalidation only reaches the worker that made the change.
+The async views use the a... versions of these functions, so that they don't block
+the event loop while talking to redis.
+"""
+import hashlib
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+
+MACHINES_CACHE_KEY = "machines"
+
+
+def cached_entry(key):
+    """
+    :return: the cached (etag, body, content type) for the key, or None
+    """
+    return cache.get(key)
+
+
+async def acached_entry(key):
+    return await cache.aget(key)
+
+
+def _entry(body, content_type):
+    return quote_etag(hashlib.md5(body).hexdigest()), body, content_type
+
+
+def cache_entry(key, body, content_type):
+    """
+    Cache a response body with its ETag
+    :return: the cached (etag, body, content type)
+    """
+    entry = _entry(body, content_type)
+    cache.set(key, entry)
+    return entry
+
+
+async def acache_entry(key, body, content_type):
+    entry = _entry(body, content_type)
+    await cache.aset(key, entry)
+    return entry
+
+
+def etag_response(request, entry):
+    """
+    :return: the response for a cached entry, a 304 if the client already has it
+    """
+    etag, body, content_type = entry
+
+    if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+    if etag in if_none_match or "*" in if_none_match:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type=content_type)
+    response["ETag"] = etag
+    response["Vary"] = "Accept"
+    return response
+
+
+def cached_response(request, key, build):
+    """
+    Return the cached response body for the key, building and caching it if needed
+    :param build: function returning the body (bytes) and its content type
+    """
+    entry = cached_entry(key)
+    if entry is None:
+        entry = cache_entry(key, *build())
+    return etag_response(request, entry)
+
+
+def _graph_version(simulation_id):
+    # a random version rather than a counter, so that if it gets evicted
+    # the new one can't match graphs cached before the eviction
+    return cache.get_or_set(f"graph-version:{simulation_id}", uuid4().hex, timeout=None)
+
+
+def _graph_variant(request):
+    return hashlib.md5(f"{request.GET.urlencode()}|{request.headers.get('Accept', '')}".encode()).hexdigest()
+
+
+def graph_cache_key(request, simulation_id):
+    """
+    The key depends on the query parameters (downsampling, window...) and on
+    the Accept header (JSON array or NDJSON), as they give different bodies
+    """
+    return f"graph:{simulation_id}:{_graph_version(simulation_id)}:{_graph_variant(request)}"
+
+
+async def agraph_cache_key(request, simulation_id):
+    version = await cache.aget_or_set(f"graph-version:{simulation_id}", uuid4().hex, timeout=None)
+    return f"graph:{simulation_id}:{version}:{_graph_variant(request)}"
+
+
+def invalidate_graph(simulation_id):
+    """Forget every cached variant of the graph of this simulation"""
+    cache.set(f"graph-version:{simulation_id}", uuid4().hex, timeout=None)
+
+
+async def ainvalidate_graph(simulation_id):
+    await cache.aset(f"graph-version:{simulation_id}", uuid4().hex, timeout=None)
+
+
+def invalidate_machines():
+    cache.delete(MACHINES_CACHE_KEY)
+
+
+async def ainvalidate_machines():
+    await cache.adelete(MACHINES_CACHE_KEY)
@@ -0,0 +1,30 @@
+"""
+Numbers for sizing the database connections and the pool under load:
+how many connections this process has opened (with persistent connections
+this stops growing once every worker has one) and what the server sees.
+"""
+import threading
+
+from django.db.backends.signals import connection_created
+
+# connections per state (active, idle, idle in transaction...) for our database,
+# i.e. for all the workers and pools together
+SERVER_CONNECTIONS_SQL = """SELECT COALESCE(state, 'unknown'), count(*) FROM pg_stat_activity
+                            WHERE datname = current_database() GROUP BY 1"""
+
+_lock = threading.Lock()
+_connections_opened = 0
+
+
+def count_connection(sender, connection, **kwargs):
+    global _connections_opened
+    with _lock:
+        _connections_opened += 1
+
+
+def connections_opened():
+    return _connections_opened
+
+
+def connect_signals():
+    connection_created.connect(count_connection, dispatch_uid="origenai_count_connection")
@@ -37,4 +37,172 @@ $$ LANGUAGE plpgsql;
 
 CREATE TRIGGER update_date_updated_col BEFORE UPDATE ON simulation FOR EACH ROW EXECUTE PROCEDURE  update_date_updated_column();
 
-"""
\ No newline at end of file
+"""
+
+# table recording which schema versions have been applied to the database
+schema_version_ddl = """
+CREATE TABLE IF NOT EXISTS "schema_version" (
+    version integer NOT NULL PRIMARY KEY,
+    description varchar(200) NOT NULL,
+    date_applied timestamp with time zone NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# The schema versions, applied in order by the setup_database command.
+# Once a version has been deployed it shouldn't be changed, add a new version instead
+migrations = [
+    (1, "create the machine, simulation and lossdata tables", ddl),
+
+    (2, "indexes for the graph and simulation list queries", """
+-- convergence_graph: WHERE simulation_id = ? ORDER BY seconds
+CREATE INDEX IF NOT EXISTS lossdata_simulation_seconds_idx ON lossdata (simulation_id, seconds);
+
+-- simulations: the sort orders (with the id tiebreaker used for paging), with or without the state filter
+-- name is unique so already indexed, but paging compares (name, id)
+CREATE INDEX IF NOT EXISTS simulation_name_id_idx ON simulation (name, id);
+CREATE INDEX IF NOT EXISTS simulation_created_idx ON simulation (date_created, id);
+CREATE INDEX IF NOT EXISTS simulation_updated_idx ON simulation ((COALESCE(date_updated, '-infinity')), id);
+CREATE INDEX IF NOT EXISTS simulation_state_created_idx ON simulation (state, date_created, id);
+CREATE INDEX IF NOT EXISTS simulation_state_updated_idx ON simulation (state, (COALESCE(date_updated, '-infinity')), id);
+
+-- simulations of a machine (machine names are unique, so already indexed for add_simulation)
+CREATE INDEX IF NOT EXISTS simulation_machine_idx ON simulation (machine_id);
+"""),
+
+    (3, "simulation_stats summary of the loss data, kept up to date by triggers", """
+-- one row per simulation with loss data, so the listings don't have to scan lossdata
+CREATE TABLE IF NOT EXISTS "simulation_stats" (
+    simulation_id INT NOT NULL PRIMARY KEY,
+    point_count bigint NOT NULL,
+    min_loss numeric(10, 5),
+    final_loss numeric(10, 5),     -- the loss at last_seconds
+    last_seconds integer,
+    FOREIGN KEY (simulation_id) REFERENCES simulation(id) ON DELETE CASCADE
+);
+
+-- inserted points (one statement, COPY included) are added to the summary of their simulations
+CREATE OR REPLACE FUNCTION lossdata_stats_insert()
+RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO simulation_stats AS stats (simulation_id, point_count, min_loss, final_loss, last_seconds)
+    SELECT simulation_id, count(*), min(loss), (array_agg(loss ORDER BY seconds DESC))[1], max(seconds)
+    FROM new_rows
+    GROUP BY simulation_id
+    ON CONFLICT (simulation_id) DO UPDATE SET
+        point_count = stats.point_count + EXCLUDED.point_count,
+        min_loss = LEAST(stats.min_loss, EXCLUDED.min_loss),
+        final_loss = CASE WHEN EXCLUDED.last_seconds >= stats.last_seconds THEN EXCLUDED.final_loss
+                          ELSE stats.final_loss END,
+        last_seconds = GREATEST(stats.last_seconds, EXCLUDED.last_seconds);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- deleted points can't be taken out of a minimum, so the summaries of their simulations are recomputed
+CREATE OR REPLACE FUNCTION lossdata_stats_delete()
+RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM simulation_stats WHERE simulation_id IN (SELECT simulation_id FROM old_rows);
+    INSERT INTO simulation_stats (simulation_id, point_count, min_loss, final_loss, last_seconds)
+    SELECT simulation_id, count(*), min(loss), (array_agg(loss ORDER BY seconds DESC))[1], max(seconds)
+    FROM lossdata
+    WHERE simulation_id IN (SELECT simulation_id FROM old_rows)
+    GROUP BY simulation_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- TRUNCATE doesn't run the delete triggers
+CREATE OR REPLACE FUNCTION lossdata_stats_truncate()
+RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM simulation_stats;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER lossdata_stats_insert AFTER INSERT ON lossdata
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION lossdata_stats_insert();
+CREATE TRIGGER lossdata_stats_delete AFTER DELETE ON lossdata
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION lossdata_stats_delete();
+CREATE TRIGGER lossdata_stats_truncate AFTER TRUNCATE ON lossdata
+    FOR EACH STATEMENT EXECUTE FUNCTION lossdata_stats_truncate();
+
+-- the existing points, the triggers lock lossdata until this is committed so no insert is missed
+INSERT INTO simulation_stats (simulation_id, point_count, min_loss, final_loss, last_seconds)
+SELECT simulation_id, count(*), min(loss), (array_agg(loss ORDER BY seconds DESC))[1], max(seconds)
+FROM lossdata
+GROUP BY simulation_id
+ON CONFLICT (simulation_id) DO NOTHING;
+"""),
+
+    (4, "notifications of new loss data and state changes, for the live event streams", """
+-- one notification per simulation and insert statement (COPY included), with the range of ids inserted
+-- rather than the points, as a payload is limited to 8000 bytes. simulations/events.py reads the points
+CREATE OR REPLACE FUNCTION lossdata_notify()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('simulation_events', json_build_object(
+        'simulation_id', simulation_id, 'first_id', min(id), 'last_id', max(id))::text)
+    FROM new_rows
+    GROUP BY simulation_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION simulation_notify_state()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('simulation_events', json_build_object('simulation_id', NEW.id, 'state', NEW.state)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER lossdata_notify AFTER INSERT ON lossdata
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION lossdata_notify();
+CREATE TRIGGER simulation_notify_state AFTER UPDATE OF state ON simulation
+    FOR EACH ROW WHEN (OLD.state IS DISTINCT FROM NEW.state) EXECUTE FUNCTION simulation_notify_state();
+"""),
+
+    (5, "index for polling the graph with since_id", """
+-- convergence_graph?since_id=: WHERE simulation_id = ? AND id > ? ORDER BY id.
+-- The primary key of a partitioned lossdata is already (simulation_id, id)
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'lossdata'::regclass) THEN
+        CREATE INDEX IF NOT EXISTS lossdata_simulation_id_idx ON lossdata (simulation_id, id);
+    END IF;
+END
+$$;
+"""),
+
+    (6, "index of the pending simulations, for the workers claiming them", """
+-- claim_simulations: the oldest pending simulations first. Only the pending ones are in it, so it stays
+-- small and in memory however many simulations have run, and the claims skip the rows locked by other workers
+CREATE INDEX IF NOT EXISTS simulation_pending_idx ON simulation (date_created, id) WHERE state = 'pending';
+"""),
+
+    (7, "trigram index of the simulation names, for searching them", """
+-- simulations?search=: name ILIKE '%text%' (or 'text%'). A btree can't find a text in the middle of the names,
+-- the trigrams of the names can. pg_trgm is one of the extensions of postgres-contrib (in the postgres docker
+-- images), trusted so the database owner can add it. It is required: without it this version fails, and is
+-- applied by the next setup_database once the extension is installed
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        RAISE EXCEPTION 'the pg_trgm extension is not installed on the database server'
+            USING HINT = 'install the contrib extensions of postgres (e.g. the postgresql-contrib package)';
+    END IF;
+END
+$$;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS simulation_name_trgm_idx ON simulation USING gin (name gin_trgm_ops);
+"""),
+
+    (8, "the id in the index of the graph, for polling it with after_seconds", """
+-- convergence_graph?after_seconds=&after_id=: WHERE simulation_id = ? AND (seconds, id) > (?, ?) ORDER BY seconds, id.
+-- seconds isn't unique, so the polls resume after the id too. The index replaces the one on (simulation_id, seconds)
+DROP INDEX IF EXISTS lossdata_simulation_seconds_idx;
+CREATE INDEX lossdata_simulation_seconds_idx ON lossdata (simulation_id, seconds, id);
+"""),
+]
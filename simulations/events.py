@@ -0,0 +1,230 @@
+"""
+Live events of the simulations, new loss points and changes of state, for the
+server-sent event streams of the async API (see api_async.simulation_events).
+
+The triggers of schema version 4 send a notification on the simulation_events channel for
+every insert into lossdata and every change of state. Each event loop has one EventHub, with
+a single connection LISTENing to the channel for all the streams it serves: the new points
+of a simulation are read (from the primary) once per notification and handed to every stream watching it, so
+a hundred dashboards watching a run cost one listener and one query per insert,
+rather than a hundred clients polling the graph.
+"""
+import asyncio
+import json
+import logging
+import weakref
+from collections import defaultdict
+
+import asyncpg
+from django.conf import settings
+
+from simulations.api import State
+from simulations.async_db import connect_kwargs, get_pool
+from simulations.routing import PRIMARY
+from simulations.responses import json_encoder, loss_point
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "simulation_events"
+
+# events waiting to be sent to a stream. A stream falling further behind is closed,
+# its client reconnects with Last-Event-ID and catches up from the database
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+# the points of a notification (the ids inserted by one statement)
+NOTIFIED_POINTS_SQL = """SELECT seconds, loss FROM lossdata
+                         WHERE simulation_id = $1 AND id BETWEEN $2 AND $3 ORDER BY seconds"""
+POINTS_AFTER_SQL = """SELECT seconds, loss FROM lossdata
+                      WHERE simulation_id = $1 AND seconds > $2 ORDER BY seconds"""
+
+# put in the queue of a stream to end it
+CLOSED = None
+
+# one hub per event loop, like the pools
+_hubs = weakref.WeakKeyDictionary()
+
+
+class Subscription:
+    """The events of one simulation waiting to be sent to one stream"""
+
+    def __init__(self, simulation_id):
+        self.simulation_id = simulation_id
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def push(self, event):
+        """:return: False if the stream is too far behind, in which case it is closed"""
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            self.close()
+            return False
+
+    def close(self):
+        # what wasn't sent is dropped, the client gets it when it reconnects
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(CLOSED)
+
+
+class EventHub:
+    """
+    The LISTEN connection of an event loop, and the subscriptions of the streams it serves
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.loop = asyncio.get_running_loop()
+        self.subscriptions = defaultdict(set)
+        # the notifications are handled in order, one at a time, so the points are sent in order
+        self.notifications = asyncio.Queue()
+        self.dispatcher = asyncio.ensure_future(self.dispatch())
+
+    @classmethod
+    async def connect(cls):
+        kwargs = connect_kwargs()
+        kwargs["host"] = settings.EVENTS_DB_HOST or kwargs["host"]
+        kwargs["port"] = settings.EVENTS_DB_PORT or kwargs["port"]
+        connection = await asyncpg.connect(**kwargs)
+        hub = cls(connection)
+        await connection.add_listener(CHANNEL, hub.notified)
+        connection.add_termination_listener(hub.terminated)
+        return hub
+
+    def subscribe(self, simulation_id):
+        subscription = Subscription(simulation_id)
+        self.subscriptions[simulation_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.simulation_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.simulation_id]
+
+    def notified(self, connection, pid, channel, payload):
+        notification = json.loads(payload)
+        # nobody is watching most simulations
+        if notification["simulation_id"] in self.subscriptions:
+            self.notifications.put_nowait(notification)
+
+    async def dispatch(self):
+        while True:
+            notification = await self.notifications.get()
+            if notification["simulation_id"] not in self.subscriptions:
+                continue
+            try:
+                event = await self.event(notification)
+            except Exception as e:
+                logger.error(f"Can't read the event of {notification}: {e}")
+                continue
+            for subscription in list(self.subscriptions.get(notification["simulation_id"], ())):
+                if not subscription.push(event):
+                    self.unsubscribe(subscription)
+
+    async def event(self, notification):
+        """:return: the (event type, data) of a notification"""
+        if "state" in notification:
+            return "state", {"state": notification["state"]}
+        # the primary, the replica may not have the points yet
+        pool = await get_pool(PRIMARY)
+        records = await pool.fetch(NOTIFIED_POINTS_SQL, notification["simulation_id"],
+                                   notification["first_id"], notification["last_id"])
+        return "lossdata", [loss_point(record) for record in records]
+
+    def close_subscriptions(self):
+        for subscriptions in self.subscriptions.values():
+            for subscription in subscriptions:
+                subscription.close()
+        self.subscriptions.clear()
+
+    def terminated(self, connection):
+        # the streams end and their clients reconnect to a new hub, catching up with Last-Event-ID
+        logger.warning("The connection listening to the simulation events was lost")
+        _hubs.pop(self.loop, None)
+        self.dispatcher.cancel()
+        self.close_subscriptions()
+
+    async def close(self):
+        self.dispatcher.cancel()
+        self.close_subscriptions()
+        await self.connection.close()
+
+
+async def get_hub():
+    """
+    :return: the hub of the running event loop, connected on first use
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _hubs:
+        # a future, so that concurrent first streams wait for the same hub
+        _hubs[loop] = asyncio.ensure_future(EventHub.connect())
+    try:
+        return await _hubs[loop]
+    except Exception:
+        # so that the next stream tries again
+        _hubs.pop(loop, None)
+        raise
+
+
+async def close_hub():
+    """Close the hub of the running event loop, if there is one"""
+    hub_task = _hubs.pop(asyncio.get_running_loop(), None)
+    if hub_task is not None:
+        await (await hub_task).close()
+
+
+def open_streams():
+    """:return: the number of event streams served by the hub of the running event loop"""
+    hub_task = _hubs.get(asyncio.get_running_loop())
+    if hub_task is None or not hub_task.done() or hub_task.exception():
+        return 0
+    return sum(len(subscriptions) for subscriptions in hub_task.result().subscriptions.values())
+
+
+def server_sent_event(event_type, data, event_id=None):
+    event_id_line = f"id: {event_id}\n" if event_id is not None else ""
+    return f"event: {event_type}\n{event_id_line}data: {json_encoder.encode(data)}\n\n"
+
+
+async def event_stream(hub, subscription, state, after=None):
+    """
+    Async generator of the server-sent events of a simulation: its state, the points after
+    the `after` seconds already in the database, then the live events until it is finished.
+    The id of a lossdata event is the seconds of its last point. The points are expected to be
+    added in order, any point not after the last one sent is skipped.
+    """
+    last_seconds = after
+    try:
+        yield server_sent_event("state", {"state": state})
+        if after is not None:
+            pool = await get_pool(PRIMARY)
+            points = [loss_point(record) for record in
+                      await pool.fetch(POINTS_AFTER_SQL, subscription.simulation_id, after)]
+            if points:
+                last_seconds = points[-1]["seconds"]
+                yield server_sent_event("lossdata", points, last_seconds)
+
+        while state != State.FINISHED:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), settings.EVENTS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                # a comment, so that proxies don't close the idle connection and disconnects are noticed
+                yield ": keepalive\n\n"
+                continue
+            if event is CLOSED:
+                break
+
+            event_type, data = event
+            if event_type == "lossdata":
+                if last_seconds is not None:
+                    data = [point for point in data if point["seconds"] > last_seconds]
+                if data:
+                    last_seconds = data[-1]["seconds"]
+                    yield server_sent_event(event_type, data, last_seconds)
+            else:
+                state = data["state"]
+                yield server_sent_event(event_type, data)
+    finally:
+        hub.unsubscribe(subscription)
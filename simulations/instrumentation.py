@@ -0,0 +1,260 @@
+"""
+Timing of the raw SQL endpoints.
+
+The middleware keeps per request stats (number of queries, time spent in SQL, rows
+fetched and time spent serialising), which the cursors wrapped with track_cursor()
+and the response builders add to. At the end of the request they are:
+ - sent back in a Server-Timing header (for streamed responses, only what happened
+   before the response started, as the headers are sent first)
+ - logged as one JSON line
+ - added to per endpoint histograms, shown in the Prometheus text format by metrics_text()
+
+The histograms are per process. The asyncpg queries of the async endpoints aren't counted.
+"""
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+class RequestStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.serialisation_seconds = 0.0
+
+
+_current_stats = ContextVar("origenai_request_stats", default=None)
+
+
+def current_stats():
+    """
+    :return: the stats of the request being handled, or throw away ones outside a request
+        (management commands, tests calling the views directly)
+    """
+    return _current_stats.get() or RequestStats()
+
+
+class InstrumentedCursor:
+    """
+    Wraps a DB-API cursor (django's or psycopg2's) to count the queries,
+    the time they take and the rows fetched
+    """
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def _timed(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._stats.sql_seconds += time.perf_counter() - start
+
+    def execute(self, *args, **kwargs):
+        self._stats.queries += 1
+        return self._timed(self._cursor.execute, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._stats.queries += 1
+        return self._timed(self._cursor.executemany, *args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        self._stats.queries += 1
+        return self._timed(self._cursor.copy_expert, *args, **kwargs)
+
+    def fetchone(self):
+        row = self._timed(self._cursor.fetchone)
+        if row is not None:
+            self._stats.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._timed(self._cursor.fetchmany, *args, **kwargs)
+        self._stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._cursor.fetchall)
+        self._stats.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._cursor.close()
+
+
+def track_cursor(cursor):
+    """Count the queries of this cursor in the stats of the current request"""
+    return InstrumentedCursor(cursor, current_stats())
+
+
+@contextmanager
+def serialising(stats):
+    """Count the time spent in the block as serialisation"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.serialisation_seconds += time.perf_counter() - start
+
+
+class Histogram:
+    """Cumulative histogram, as Prometheus expects them"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+# metric name -> (help, bucket bounds, the stat it observes)
+METRICS = {
+    "origenai_request_duration_seconds": ("Time to handle the request", SECONDS_BUCKETS,
+                                          lambda stats, total: total),
+    "origenai_sql_duration_seconds": ("Time spent running SQL and fetching rows", SECONDS_BUCKETS,
+                                      lambda stats, total: stats.sql_seconds),
+    "origenai_serialisation_duration_seconds": ("Time spent serialising the response", SECONDS_BUCKETS,
+                                                lambda stats, total: stats.serialisation_seconds),
+    "origenai_sql_queries": ("Number of SQL queries per request", COUNT_BUCKETS,
+                             lambda stats, total: stats.queries),
+}
+
+_histograms_lock = threading.Lock()
+# (metric name, method, endpoint) -> Histogram
+_histograms = {}
+
+
+def record(method, endpoint, stats, total):
+    with _histograms_lock:
+        for name, (help_text, buckets, value) in METRICS.items():
+            key = (name, method, endpoint)
+            if key not in _histograms:
+                _histograms[key] = Histogram(buckets)
+            _histograms[key].observe(value(stats, total))
+
+
+def metrics_text():
+    """
+    :return: the histograms in the Prometheus text exposition format
+    """
+    lines = []
+    with _histograms_lock:
+        for name, (help_text, buckets, value) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, method, endpoint), histogram in sorted(_histograms.items()):
+                if metric != name:
+                    continue
+                labels = f'method="{method}",endpoint="{endpoint}"'
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+    return "\n".join(lines) + "\n"
+
+
+class QueryTimingMiddleware:
+    """
+    Collects the stats of every request, see the module docstring
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats()
+        _current_stats.set(stats)
+        return self.finish(request, self.get_response(request), stats)
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        _current_stats.set(stats)
+        return self.finish(request, await self.get_response(request), stats)
+
+    def finish(self, request, response, stats):
+        elapsed = time.perf_counter() - stats.start
+        response["Server-Timing"] = (
+            f'db;dur={stats.sql_seconds * 1000:.2f};desc="{stats.queries} queries, {stats.rows} rows", '
+            f'ser;dur={stats.serialisation_seconds * 1000:.2f}, '
+            f'total;dur={elapsed * 1000:.2f}')
+
+        if response.streaming:
+            # the rows are fetched and serialised while streaming, so only record once it is done
+            content = response.streaming_content
+            if response.is_async:
+                response.streaming_content = self._astream(content, request, response, stats)
+            else:
+                response.streaming_content = self._stream(content, request, response, stats)
+        else:
+            self.report(request, response, stats)
+        return response
+
+    def _stream(self, content, request, response, stats):
+        try:
+            yield from content
+        finally:
+            self.report(request, response, stats)
+
+    async def _astream(self, content, request, response, stats):
+        try:
+            async for chunk in content:
+                yield chunk
+        finally:
+            self.report(request, response, stats)
+
+    def report(self, request, response, stats):
+        total = time.perf_counter() - stats.start
+        match = request.resolver_match
+        endpoint = match.route if match else "unmatched"
+        record(request.method, endpoint, stats, total)
+        logger.info(json.dumps({
+            "event": "request",
+            "method": request.method,
+            "path": request.path,
+            "endpoint": endpoint,
+            "status": response.status_code,
+            "queries": stats.queries,
+            "rows": stats.rows,
+            "sql_ms": round(stats.sql_seconds * 1000, 2),
+            "serialisation_ms": round(stats.serialisation_seconds * 1000, 2),
+            "total_ms": round(total * 1000, 2),
+        }))
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from simulations import repository
+from simulations.partitions import archivable_partitions, is_partitioned
+
+
+class Command(BaseCommand):
+    help = ('Detaches (or drops) the partitions of lossdata whose simulations are all finished '
+            'and were last updated more than --days ago. The simulation_stats summaries are kept. '
+            'A detached partition is a plain table, which can be dumped (pg_dump -t) and dropped')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90,
+                            help='only archive simulations finished for at least this many days')
+        parser.add_argument('--drop', action='store_true', help='drop the partitions rather than detaching them')
+        parser.add_argument('--dry-run', action='store_true', help='only list the partitions that would be archived')
+
+    def handle(self, *args, **kwargs):
+        finished_before = datetime.now(timezone.utc) - timedelta(days=kwargs['days'])
+        with transaction.atomic(using='default'), repository.cursor() as cursor:
+            if not is_partitioned(cursor):
+                raise CommandError("lossdata isn't partitioned, run partition_lossdata first")
+
+            for name in archivable_partitions(cursor, finished_before):
+                if kwargs['dry_run']:
+                    self.stdout.write(f"would archive {name}")
+                elif kwargs['drop']:
+                    cursor.execute(f"DROP TABLE {name}")
+                    self.stdout.write(f"dropped {name}")
+                else:
+                    cursor.execute(f"ALTER TABLE lossdata DETACH PARTITION {name}")
+                    self.stdout.write(f"detached {name}")
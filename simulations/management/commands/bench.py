@@ -0,0 +1,153 @@
+import json
+import random
+import statistics
+import subprocess
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from uuid import uuid4
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from simulations import repository
+
+
+class Command(BaseCommand):
+    help = ('Seeds a synthetic dataset and drives the API of a running server with concurrent clients, '
+            'reporting the latency percentiles and throughput of each endpoint as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000', help='base url of the running server')
+        parser.add_argument('--machines', type=int, default=10, help='number of machines to seed')
+        parser.add_argument('--simulations', type=int, default=1000, help='number of simulations to seed')
+        parser.add_argument('--points', type=int, default=1000, help='loss points per seeded simulation')
+        parser.add_argument('--requests', type=int, default=500, help='requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=10, help='number of concurrent clients')
+        parser.add_argument('--seed', type=int, default=0, help='random seed, for picking the same simulations')
+        parser.add_argument('--output', help='file to write the JSON report to, as well as stdout')
+        parser.add_argument('--keep', action='store_true', help="don't delete the seeded data at the end")
+
+    def handle(self, *args, **kwargs):
+        # names are limited to 20 characters for machines, 30 for simulations
+        run = uuid4().hex[:8]
+        self.base_url = kwargs['url'].rstrip('/')
+        self.random = random.Random(kwargs['seed'])
+
+        started = time.perf_counter()
+        simulation_ids = self.seed(run, kwargs['machines'], kwargs['simulations'], kwargs['points'])
+        seed_seconds = time.perf_counter() - started
+        self.stderr.write(f"seeded {len(simulation_ids)} simulations in {seed_seconds:.1f}s")
+
+        new_simulations = iter(range(kwargs['requests']))
+        seconds = iter(range(kwargs['points'] + 1, kwargs['points'] + 1 + kwargs['requests']))
+        scenarios = {
+            "GET /api/simulations": lambda: self.request("/api/simulations"),
+            "GET /api/simulations?limit=100": lambda: self.request("/api/simulations?limit=100"),
+            "GET /api/simulations/{id}/graph": lambda: self.request(
+                f"/api/simulations/{self.random.choice(simulation_ids)}/graph"),
+            "POST /api/lossdata/add": lambda: self.request("/api/lossdata/add", {
+                "simulation_id": self.random.choice(simulation_ids),
+                "seconds": next(seconds), "loss": round(self.random.random(), 5)}),
+            "POST /api/simulations/add": lambda: self.request("/api/simulations/add", {
+                "name": f"bench-{run}-new-{next(new_simulations)}", "state": "pending"}),
+        }
+
+        report = {
+            "date": datetime.now(timezone.utc).isoformat(),
+            "commit": self.git_commit(),
+            "url": self.base_url,
+            "dataset": {"machines": kwargs['machines'], "simulations": kwargs['simulations'],
+                        "points": kwargs['points'], "seed_seconds": round(seed_seconds, 2)},
+            "concurrency": kwargs['concurrency'],
+            "endpoints": {},
+        }
+        try:
+            for name, send in scenarios.items():
+                self.stderr.write(f"running {name}")
+                report["endpoints"][name] = self.run_scenario(send, kwargs['requests'], kwargs['concurrency'])
+        finally:
+            if not kwargs['keep']:
+                self.cleanup(run)
+
+        output = json.dumps(report, indent=2)
+        self.stdout.write(output)
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as file:
+                file.write(output)
+
+    def seed(self, run, machines, simulations, points):
+        """
+        Insert the dataset with set based SQL
+        :return: the ids of the seeded simulations
+        """
+        with transaction.atomic(), repository.cursor() as cursor:
+            cursor.execute("""INSERT INTO machine (name, location)
+                              SELECT 'bench-' || %s || '-' || i, 'https://bench-' || i || '.example.com'
+                              FROM generate_series(1, %s) i""", [run, machines])
+            cursor.execute("""INSERT INTO simulation (name, state, machine_id, date_updated)
+                              SELECT 'bench-' || %s || '-' || i,
+                                     (ARRAY['pending', 'running', 'finished'])[1 + i %% 3],
+                                     (SELECT id FROM machine WHERE name = 'bench-' || %s || '-' || (1 + i %% %s)),
+                                     NOW()
+                              FROM generate_series(1, %s) i
+                              RETURNING id""", [run, run, machines, simulations])
+            simulation_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute("""INSERT INTO lossdata (seconds, loss, simulation_id)
+                              SELECT s * 10, round((1.0 / s + random() / 100)::numeric, 5), simulation_id
+                              FROM unnest(%s::int[]) simulation_id, generate_series(1, %s) s""",
+                           [simulation_ids, points])
+        return simulation_ids
+
+    def cleanup(self, run):
+        pattern = f"bench-{run}-%"
+        with transaction.atomic(), repository.cursor() as cursor:
+            cursor.execute("""DELETE FROM lossdata WHERE simulation_id IN
+                              (SELECT id FROM simulation WHERE name LIKE %s)""", [pattern])
+            cursor.execute("DELETE FROM simulation WHERE name LIKE %s", [pattern])
+            cursor.execute("DELETE FROM machine WHERE name LIKE %s", [pattern])
+
+    def request(self, path, data=None):
+        """
+        Send one request, reading the whole response
+        :return: the latency in seconds and whether it succeeded
+        """
+        body = json.dumps(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body,
+                                         headers={"Content-Type": "application/json"})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+            ok = True
+        except urllib.error.URLError:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    def run_scenario(self, send, requests, concurrency):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda _: send(), range(requests)))
+        elapsed = time.perf_counter() - start
+
+        latencies = sorted(latency for latency, ok in results if ok)
+        summary = {"requests": requests,
+                   "errors": sum(1 for latency, ok in results if not ok),
+                   "seconds": round(elapsed, 3),
+                   "requests_per_second": round(requests / elapsed, 1)}
+        if len(latencies) > 1:
+            percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+            summary.update({"p50_ms": round(percentiles[49] * 1000, 2),
+                            "p95_ms": round(percentiles[94] * 1000, 2),
+                            "p99_ms": round(percentiles[98] * 1000, 2),
+                            "max_ms": round(latencies[-1] * 1000, 2)})
+        return summary
+
+    def git_commit(self):
+        try:
+            return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                  text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
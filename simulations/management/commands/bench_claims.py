@@ -0,0 +1,85 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+
+from simulations import repository
+from simulations.cache import invalidate_machines
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the claims of pending simulations by concurrent workers (each with its own '
+            'connection), reporting the claims per second for each number of workers as JSON. '
+            'The simulations are seeded for a machine of their own and deleted afterwards')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--simulations', type=int, default=5000, help='pending simulations claimed per run')
+        parser.add_argument('--workers', default='1,2,4,8,16', help='comma separated numbers of concurrent workers')
+        parser.add_argument('--count', type=int, default=1, help='simulations claimed at a time by a worker')
+
+    def handle(self, *args, **kwargs):
+        # names are limited to 20 characters for machines, 30 for simulations
+        run = uuid4().hex[:8]
+        machine_name = f"claims-{run}"
+        simulation_count = kwargs['simulations']
+        report = {"simulations": simulation_count, "count": kwargs['count'], "runs": []}
+        try:
+            self.seed(run, machine_name, simulation_count)
+            for workers in [int(workers) for workers in kwargs['workers'].split(',')]:
+                # the same pending simulations for every run
+                with repository.cursor() as cursor:
+                    cursor.execute("""UPDATE simulation SET state = 'pending'
+                                      WHERE machine_id = (SELECT id FROM machine WHERE name = %s)""", [machine_name])
+                self.stderr.write(f"running {workers} workers")
+                report["runs"].append(self.run_workers(machine_name, workers, kwargs['count'], simulation_count))
+        finally:
+            self.cleanup(run, machine_name)
+
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def seed(self, run, machine_name, simulation_count):
+        with transaction.atomic(), repository.cursor() as cursor:
+            cursor.execute("INSERT INTO machine (name, location) VALUES (%s, 'bench') RETURNING id", [machine_name])
+            machine_id = cursor.fetchone()[0]
+            # assigned to the benchmark's machine, so that the other pending simulations aren't claimed
+            cursor.execute("""INSERT INTO simulation (name, state, machine_id, date_created)
+                              SELECT 'claims-' || %s || '-' || i, 'pending', %s, NOW() + i * interval '1 microsecond'
+                              FROM generate_series(1, %s) i""", [run, machine_id, simulation_count])
+        invalidate_machines()
+
+    def cleanup(self, run, machine_name):
+        with transaction.atomic(), repository.cursor() as cursor:
+            cursor.execute("DELETE FROM simulation WHERE name LIKE %s", [f"claims-{run}-%"])
+            cursor.execute("DELETE FROM machine WHERE name = %s", [machine_name])
+        invalidate_machines()
+
+    def run_workers(self, machine_name, workers, count, simulation_count):
+        def worker(_):
+            """:return: the ids claimed, until there are none left"""
+            claimed = []
+            try:
+                while True:
+                    rows = repository.claim_simulations(machine_name, count, assigned_only=True)
+                    if not rows:
+                        return claimed
+                    claimed += [row.id for row in rows]
+            finally:
+                # the connection of this thread
+                connections.close_all()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            claimed = list(executor.map(worker, range(workers)))
+        elapsed = time.perf_counter() - start
+
+        ids = [simulation_id for worker_ids in claimed for simulation_id in worker_ids]
+        return {"workers": workers,
+                "claimed": len(ids),
+                # a simulation claimed twice, or one left pending, would be a bug
+                "duplicates": len(ids) - len(set(ids)),
+                "missed": simulation_count - len(set(ids)),
+                "seconds": round(elapsed, 3),
+                "claims_per_second": round(len(ids) / elapsed, 1)}
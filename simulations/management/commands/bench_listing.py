@@ -0,0 +1,135 @@
+import json
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime, timezone
+from decimal import Decimal
+from operator import itemgetter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+from django.urls import reverse
+from ninja.responses import NinjaJSONEncoder
+
+from simulations import repository
+from simulations.api import SearchSortFilter, simulation_json_query, simulation_list_query
+from simulations.responses import SimulationResponse, json_chunks, json_encoder, simulation_builder
+
+# the rows of the simulation list query, as the repository returns them
+SimulationRow = namedtuple("SimulationRow", ["id", "name", "state", "date_created", "date_updated", "machine_id",
+                                             "point_count", "min_loss", "final_loss", "last_seconds"])
+
+
+# the simulations seeded for --database, rolled back afterwards
+SEED_SIMULATIONS_SQL = """
+    WITH seeded AS (
+        INSERT INTO simulation (name, state, machine_id, date_created, date_updated)
+        SELECT 'bench-listing-' || i, 'finished', NULL, NOW() - i * interval '1 second', NOW()
+        FROM generate_series(1, %s) i
+        RETURNING id
+    )
+    INSERT INTO simulation_stats (simulation_id, point_count, min_loss, final_loss, last_seconds)
+    SELECT id, 1000, 0.01, 0.012, 10000 FROM seeded"""
+
+
+def measure(build, rows, repeat):
+    """
+    :return: the best time of the runs of build() with the rows per second, and the peak of the memory
+        allocated by python during another run (tracemalloc slows the code down, so it isn't timed)
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        build()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+
+    tracemalloc.start()
+    try:
+        build()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": round(best, 4), "rows_per_second": round(rows / best), "peak_memory_bytes": peak}
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks building the /api/simulations response from rows, '
+            'the old way (reverse() and pydantic validation for every row) against the response builder. '
+            'With --database, seeds the simulations in the database (rolled back afterwards) and benchmarks '
+            'the whole listing, from the query to the JSON text, with the response builder '
+            'against the JSON made by postgres (JSON_FROM_DATABASE)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='number of simulation rows')
+        parser.add_argument('--repeat', type=int, default=3, help='runs of each path, the best one is kept')
+        parser.add_argument('--database', action='store_true',
+                            help='list simulations seeded in the database rather than rows made in python')
+
+    def handle(self, *args, **kwargs):
+        # any host get_host() accepts will do
+        hosts = [host for host in settings.ALLOWED_HOSTS if "*" not in host and not host.startswith(".")]
+        host = hosts[0] if hosts else "localhost"
+        request = RequestFactory().get("/api/simulations", HTTP_HOST=host)
+        if kwargs['database']:
+            report = self.database_listing(request, kwargs['rows'], kwargs['repeat'])
+        else:
+            report = self.built_listing(request, kwargs['rows'], kwargs['repeat'])
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def built_listing(self, request, row_count, repeat):
+        now = datetime.now(timezone.utc)
+        rows = [SimulationRow(i, f"simulation-{i}", "finished", now, now, i % 10 + 1,
+                              1000, Decimal("0.01000"), Decimal("0.01200"), 10000)
+                for i in range(1, row_count + 1)]
+
+        def per_row_reverse_and_validation():
+            # what the endpoint did before: reverse() for every row, then
+            # django-ninja validated every row against SimulationResponse before rendering
+            results = []
+            for row in rows:
+                result = row._asdict()
+                url = reverse("api-1.0.0:simulation_detail", kwargs={"simulation_id": result['id']})
+                result.update({"link": f"{request.scheme}://{request.get_host()}{url}"})
+                results.append(result)
+            validated = [SimulationResponse.model_validate(result).model_dump() for result in results]
+            return json.dumps(validated, cls=NinjaJSONEncoder)
+
+        def response_builder():
+            build_simulation = simulation_builder(request)
+            chunks, content_type = json_chunks(request, [[build_simulation(row) for row in rows]])
+            return "".join(chunks)
+
+        report = {"rows": len(rows)}
+        for name, build in [("per_row_reverse_and_validation", per_row_reverse_and_validation),
+                            ("response_builder", response_builder)]:
+            report[name] = measure(build, len(rows), repeat)
+        return report
+
+    def database_listing(self, request, row_count, repeat):
+        filters = SearchSortFilter(sort="-created")
+
+        def listing(query, transform, encode):
+            # the way the endpoint streams the list, a chunk at a time
+            sql, placeholder_vars, sort, limit = query
+            cur = repository.open_streaming_cursor(sql, placeholder_vars)
+            chunks, content_type = json_chunks(request, repository.fetch_batches(cur, transform=transform), encode)
+            return sum(len(chunk) for chunk in chunks)
+
+        def response_builder():
+            return listing(simulation_list_query(filters), simulation_builder(request), json_encoder.encode)
+
+        def json_from_database():
+            return listing(simulation_json_query(request, filters), itemgetter(0), str)
+
+        with transaction.atomic():
+            with repository.cursor() as cur:
+                cur.execute(SEED_SIMULATIONS_SQL, (row_count,))
+            rows = repository.fetch_value("SELECT count(*) FROM simulation")
+            report = {"rows": rows}
+            for name, build in [("response_builder", response_builder), ("json_from_database", json_from_database)]:
+                report[name] = measure(build, rows, repeat)
+            transaction.set_rollback(True)
+        return report
@@ -0,0 +1,39 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from ninja.responses import NinjaJSONEncoder
+
+from simulations import repository
+from simulations.api import MAX_CLAIM, claimed_simulations
+
+
+class Command(BaseCommand):
+    help = ('Claims the next pending simulations for a machine, which become running on it, '
+            'and writes them as JSON lines. Any number of workers can run it at the same time, '
+            'they never get the same simulation')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--machine', required=True, help='name of the machine the simulations will run on')
+        parser.add_argument('--count', type=int, default=1, help=f'number of simulations to claim (up to {MAX_CLAIM})')
+        parser.add_argument('--assigned-only', action='store_true',
+                            help='only the simulations created for this machine, not the ones for any machine')
+        parser.add_argument('--wait', type=float,
+                            help='if there are none pending, try again every this many seconds until there are')
+
+    def handle(self, *args, **kwargs):
+        if not 1 <= kwargs['count'] <= MAX_CLAIM:
+            raise CommandError(f'--count must be between 1 and {MAX_CLAIM}')
+        if not repository.machine_exists(kwargs['machine']):
+            raise CommandError(f"machine {kwargs['machine']} not found")
+
+        while True:
+            rows = repository.claim_simulations(kwargs['machine'], kwargs['count'], kwargs['assigned_only'])
+            if rows or not kwargs['wait']:
+                break
+            time.sleep(kwargs['wait'])
+
+        for simulation in claimed_simulations(rows):
+            self.stdout.write(json.dumps(simulation, cls=NinjaJSONEncoder))
+        if not rows:
+            self.stderr.write('no pending simulations')
@@ -1,39 +1,74 @@
-import json
-from django.core.management.base import BaseCommand
+import time
+
+import psycopg2
+from django.core.management.base import BaseCommand, CommandError
 from django.apps import apps
-from simulations.api import CreateMachineSchema, add_machine
+from django.db import transaction
+from simulations import repository
+from simulations.bulk_load import DEFAULT_BATCH_SIZE, FORMATS, file_format, load
+from simulations.cache import invalidate_graph, invalidate_machines
+
+# a progress line is written every time this many more records are validated
+PROGRESS_EVERY = 100000
 
 
 class Command(BaseCommand):
-    help = 'Loads the machine database table from fixtures'
+    help = ('Loads the machine database table from fixtures, or loads large files of machines, simulations '
+            'and loss data (JSON arrays, NDJSON or CSV) with COPY, in one transaction. '
+            'Simulations refer to their machine by name and loss data to its simulation by id or name, '
+            'machines and simulations whose name already exists are skipped')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--machines', help='file of machines (name, location)')
+        parser.add_argument('--simulations',
+                            help='file of simulations (name, state, machine_name, date_created, date_updated)')
+        parser.add_argument('--lossdata',
+                            help='file of loss data points (seconds, loss, simulation_id or simulation_name)')
+        parser.add_argument('--format', choices=FORMATS,
+                            help='format of the files, by default given by their extension (.json, .ndjson, .csv)')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help='number of records validated at a time')
 
     def handle(self, *args, **kwargs):
 
         self.stdout.write(self.style.SUCCESS('About to load tables'))
-        app_config = apps.get_app_config('simulations')
-
-        # Build the path to the fixture file
-        fixture_path = app_config.path + '/fixtures/machines.json'
-        self.stdout.write(
-            self.style.SUCCESS('Loading fixture: {}'.format(fixture_path))
-        )
-
-        with open(fixture_path, 'r') as file:
-            # Load the JSON data into a Python dictionary
-            machine_list_json = json.load(file)
-
-            # As we are not using Django models and SQL directly, I will
-            # load the fixtures via the endpoint function to get some data
-            # validation
-            for machine_json in machine_list_json:
-                machine_data = CreateMachineSchema(**machine_json)
-                resp = add_machine(None, data=machine_data)
-                try:
-                    # a successful response won't have a status code
-                    if resp.status_code > 400:
-                        self.stdout.write(
-                            self.style.SUCCESS('Problem loading fixture')
-                        )
-                except Exception:
-                    pass
+        files = [(name, kwargs[name]) for name in ('machines', 'simulations', 'lossdata') if kwargs[name]]
+        if not files:
+            app_config = apps.get_app_config('simulations')
+            # Build the path to the fixture file
+            files = [('machines', app_config.path + '/fixtures/machines.json')]
+
+        simulation_ids = []
+        try:
+            # the machines and simulations are loaded first, so that the next files can refer to them
+            with transaction.atomic(using='default'), repository.cursor() as cursor:
+                for dataset_name, path in files:
+                    simulation_ids += self.load_file(cursor, dataset_name, path, kwargs)
+        except (OSError, ValueError, psycopg2.Error) as e:
+            raise CommandError(f'Problem loading fixture: {e}')
+
+        invalidate_machines()
+        for simulation_id in simulation_ids:
+            invalidate_graph(simulation_id)
         self.stdout.write(self.style.SUCCESS('Fixture loaded successfully!'))
+
+    def load_file(self, cursor, dataset_name, path, kwargs):
+        self.stdout.write(self.style.SUCCESS('Loading fixture: {}'.format(path)))
+        records_format = file_format(path, kwargs['format'])
+        reported = 0
+
+        def progress(count):
+            nonlocal reported
+            if count - reported >= PROGRESS_EVERY:
+                self.stdout.write(f'{dataset_name}: {count} records validated')
+                reported = count
+
+        start = time.perf_counter()
+        with open(path, 'r', newline='') as file:
+            records, inserted, simulation_ids = load(cursor, dataset_name, file, records_format,
+                                                     kwargs['batch_size'], progress)
+        elapsed = time.perf_counter() - start
+        skipped = f' ({records - inserted} already existed)' if inserted < records else ''
+        self.stdout.write(f'{dataset_name}: {records} records read, {inserted} inserted{skipped} '
+                          f'in {elapsed:.1f}s ({records / elapsed if elapsed else 0:.0f} records/s)')
+        return simulation_ids
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from simulations import repository
+from simulations.partitions import DEFAULT_PARTITION, convert_to_partitioned, create_partitions, is_partitioned
+
+
+class Command(BaseCommand):
+    help = ('Converts the lossdata table to the partitioned layout (by ranges of simulation id), '
+            'or once it is, creates the partitions for the next simulations. Run it regularly, '
+            'e.g. from cron, so the points of new simulations never go to the default partition')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=settings.LOSSDATA_PARTITION_SIZE,
+                            help='number of simulations per partition')
+        parser.add_argument('--ahead', type=int, default=2,
+                            help='number of empty partitions to keep after the last simulation')
+
+    def handle(self, *args, **kwargs):
+        size, ahead = kwargs['size'], kwargs['ahead']
+        with transaction.atomic(using='default'), repository.cursor() as cursor:
+            # copying a big table takes longer than the DB_STATEMENT_TIMEOUT of the web requests
+            cursor.execute("SET LOCAL statement_timeout = 0")
+            if not is_partitioned(cursor):
+                self.stdout.write("converting lossdata to a partitioned table, it is locked until this is done")
+                created = convert_to_partitioned(cursor, size, ahead)
+            else:
+                cursor.execute("SELECT COALESCE(max(id), 0) AS last_id FROM simulation")
+                created = create_partitions(cursor, cursor.fetchone()[0] + 1 + ahead * size, size)
+
+            cursor.execute(f"SELECT count(*) FROM {DEFAULT_PARTITION}")
+            in_default = cursor.fetchone()[0]
+
+        for name in created:
+            self.stdout.write(f"created partition {name}")
+        if in_default:
+            self.stdout.write(self.style.WARNING(f"{in_default} points are in the default partition, "
+                                                 f"use a bigger --ahead"))
+        self.stdout.write(self.style.SUCCESS("lossdata is partitioned"))
@@ -1,16 +1,72 @@
-from django.core.management.base import BaseCommand
-from simulations.create_tables import ddl
-from django.db import connections
+from django.core.management.base import BaseCommand, CommandError
+from simulations import repository
+from simulations.create_tables import migrations, schema_version_ddl
+from django.db import transaction
+from psycopg2 import DatabaseError
+
+# arbitrary key for the postgres advisory lock, so that two deployments can't upgrade at the same time
+MIGRATION_LOCK_ID = 7201
 
 
 class Command(BaseCommand):
-    help = 'Creates the database tables'
+    help = 'Creates the database tables, or upgrades them to the latest schema version'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--list', action='store_true',
+                            help='Show the applied and pending schema versions without changing anything')
 
     def handle(self, *args, **kwargs):
 
+        if kwargs['list']:
+            applied = self.applied_versions()
+            for version, description, sql in migrations:
+                status = "applied" if version in applied else "pending"
+                self.stdout.write(f"{version:>4}  {status:<8} {description}")
+            return
+
         self.stdout.write(self.style.SUCCESS('About to create tables'))
-        conn = connections['default']
-        cursor = conn.cursor()
-        result = cursor.execute(ddl)
+        failed = None
+        with transaction.atomic(using='default'), repository.cursor() as cursor:
+            # building indexes on big tables can take longer than the DB_STATEMENT_TIMEOUT of the web requests
+            cursor.execute("SET LOCAL statement_timeout = 0")
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [MIGRATION_LOCK_ID])
+            cursor.execute("SELECT to_regclass('schema_version') IS NULL AS unversioned, "
+                           "to_regclass('simulation') IS NOT NULL AS tables_exist")
+            unversioned, tables_exist = cursor.fetchone()
+            cursor.execute(schema_version_ddl)
+            if unversioned and tables_exist:
+                # created by setup_database before the schema was versioned,
+                # so the first version is already there
+                version, description, sql = migrations[0]
+                cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                               [version, description])
+                self.stdout.write(f"existing tables found, recorded as version {version}")
 
+            applied = self.applied_versions()
+            for version, description, sql in migrations:
+                if version in applied:
+                    continue
+                # a savepoint per version, so that the versions before one that fails are kept
+                try:
+                    with transaction.atomic(using='default'):
+                        cursor.execute(sql)
+                        cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                                       [version, description])
+                except DatabaseError as e:
+                    failed = (version, e)
+                    break
+                self.stdout.write(f"applied schema version {version}: {description}")
+
+        if failed:
+            version, error = failed
+            raise CommandError(f"schema version {version} failed, it and the later versions are still pending: "
+                               f"{error}")
         self.stdout.write("created database tables")
+
+    def applied_versions(self):
+        with repository.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+            if not cursor.fetchone()[0]:
+                return set()
+            cursor.execute("SELECT version FROM schema_version")
+            return {row[0] for row in cursor.fetchall()}
@@ -0,0 +1,130 @@
+"""
+Optional partitioned layout of the lossdata table, for very long histories.
+See the partition_lossdata and archive_lossdata commands.
+
+lossdata is partitioned by ranges of simulation_id (LOSSDATA_PARTITION_SIZE simulations
+per partition), so all the points of a simulation are in one partition, and a partition
+only holds simulations created around the same time, which can be archived together once
+they are all finished. A default partition catches the points of simulations beyond the
+last partition until partition_lossdata creates the partitions for them.
+The graph queries use the (simulation_id, seconds) index of the partition of their simulation,
+and a BRIN index on (simulation_id, seconds) keeps the scans of windows of seconds cheap.
+"""
+import re
+
+# the bound of a range partition, as given by pg_get_expr()
+PARTITION_BOUND = re.compile(r"FROM \((\d+)\) TO \((\d+)\)")
+
+DEFAULT_PARTITION = "lossdata_default"
+
+
+def is_partitioned(cursor):
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+                   "WHERE partrelid = 'lossdata'::regclass) AS partitioned")
+    return cursor.fetchone()[0]
+
+
+def range_partitions(cursor):
+    """
+    :return: the (name, first simulation id, end simulation id) of the range partitions of lossdata, in order
+    """
+    cursor.execute("""SELECT child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound
+                      FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                      WHERE pg_inherits.inhparent = 'lossdata'::regclass""")
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = PARTITION_BOUND.search(bound)
+        if match:
+            partitions.append((name, int(match[1]), int(match[2])))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_partitions(cursor, up_to, size):
+    """
+    Create the partitions following the last one until they cover the simulation ids below up_to.
+    The points of these simulations that were put in the default partition are moved into them.
+    :return: the names of the new partitions
+    """
+    partitions = range_partitions(cursor)
+    start = partitions[-1][2] if partitions else 0
+    created = []
+    while start < up_to:
+        end = start + size
+        name = f"lossdata_{start}_{end}"
+        # the rows are moved between the partitions directly, so the triggers of lossdata don't see them
+        cursor.execute(f"CREATE TABLE {name} (LIKE lossdata INCLUDING DEFAULTS)")
+        cursor.execute(f"""WITH moved AS (DELETE FROM {DEFAULT_PARTITION}
+                                          WHERE simulation_id >= %s AND simulation_id < %s RETURNING *)
+                           INSERT INTO {name} SELECT * FROM moved""", [start, end])
+        cursor.execute(f"ALTER TABLE lossdata ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", [start, end])
+        created.append(name)
+        start = end
+    return created
+
+
+def convert_to_partitioned(cursor, size, ahead):
+    """
+    Replace the lossdata table by a partitioned one with the same rows, indexes and triggers.
+    Has to run in a transaction, lossdata is locked until it is committed.
+    :param ahead: number of empty partitions to create after the last simulation
+    :return: the names of the partitions created
+    """
+    cursor.execute("LOCK TABLE lossdata IN ACCESS EXCLUSIVE MODE")
+    cursor.execute("""SELECT pg_get_triggerdef(oid) AS definition FROM pg_trigger
+                      WHERE tgrelid = 'lossdata'::regclass AND NOT tgisinternal""")
+    triggers = [row[0] for row in cursor.fetchall()]
+
+    cursor.execute("ALTER TABLE lossdata RENAME TO lossdata_unpartitioned")
+    cursor.execute("ALTER INDEX lossdata_pkey RENAME TO lossdata_unpartitioned_pkey")
+    cursor.execute("ALTER INDEX IF EXISTS lossdata_simulation_seconds_idx "
+                   "RENAME TO lossdata_unpartitioned_simulation_seconds_idx")
+    # the primary key of a partitioned table has to include the partition key
+    cursor.execute("""
+        CREATE TABLE lossdata (
+            id integer NOT NULL DEFAULT nextval('lossdata_id_seq'),
+            seconds integer NOT NULL,
+            loss numeric(10, 5) NOT NULL,
+            simulation_id INT NOT NULL,
+            PRIMARY KEY (simulation_id, id),
+            FOREIGN KEY (simulation_id) REFERENCES simulation(id)
+        ) PARTITION BY RANGE (simulation_id)""")
+    cursor.execute("ALTER SEQUENCE lossdata_id_seq OWNED BY lossdata.id")
+    cursor.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF lossdata DEFAULT")
+    cursor.execute("CREATE INDEX lossdata_simulation_seconds_idx ON lossdata (simulation_id, seconds, id)")
+    cursor.execute("CREATE INDEX lossdata_simulation_seconds_brin_idx ON lossdata USING brin (simulation_id, seconds)")
+
+    cursor.execute("SELECT COALESCE(max(id), 0) AS last_id FROM simulation")
+    created = create_partitions(cursor, cursor.fetchone()[0] + 1 + ahead * size, size)
+
+    # in the order of the graphs, so the BRIN ranges are tight.
+    # The triggers are only added afterwards, the simulation_stats are already up to date
+    cursor.execute("""INSERT INTO lossdata (id, seconds, loss, simulation_id)
+                      SELECT id, seconds, loss, simulation_id FROM lossdata_unpartitioned
+                      ORDER BY simulation_id, seconds""")
+    for trigger in triggers:
+        # read before the rename, so they are on the new lossdata
+        cursor.execute(trigger)
+    cursor.execute("DROP TABLE lossdata_unpartitioned")
+    cursor.execute("ANALYZE lossdata")
+    return created
+
+
+def archivable_partitions(cursor, finished_before):
+    """
+    :return: the names of the partitions whose simulations are all finished and weren't updated
+        since finished_before. The last partition (which the next ones follow on from)
+        and partitions that can still get new simulations are kept.
+    """
+    cursor.execute("SELECT COALESCE(max(id), 0) AS last_id FROM simulation")
+    last_id = cursor.fetchone()[0]
+    archivable = []
+    for name, start, end in range_partitions(cursor)[:-1]:
+        if end - 1 > last_id:
+            break
+        cursor.execute("""SELECT NOT EXISTS (
+                              SELECT 1 FROM simulation WHERE id >= %s AND id < %s
+                              AND (state <> 'finished' OR COALESCE(date_updated, date_created) >= %s)
+                          ) AS archivable""", [start, end, finished_before])
+        if cursor.fetchone()[0]:
+            archivable.append(name)
+    return archivable
@@ -0,0 +1,417 @@
+"""
+Data access for the machine, simulation and lossdata tables, shared by the endpoints
+of simulations.api and the management commands.
+
+Everything goes through cursor(), which gets the connection, times the queries
+(see simulations.instrumentation) and returns the rows as namedtuples, which psycopg2
+builds much faster than the dictionaries of RealDictCursor.
+The queries run on every request are sent as prepared statements (a PREPARE the first
+time they are used on a connection, then only an EXECUTE with the values), so postgres
+doesn't parse and plan them every time. They are turned off with DB_PGBOUNCER, as a
+transaction pooler may run every transaction on a different server connection.
+"""
+import hashlib
+import io
+import weakref
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.db import OperationalError, connections
+from psycopg2.extras import NamedTupleCursor
+
+from simulations import routing
+from simulations.instrumentation import track_cursor
+
+# number of rows fetched from the server side cursor (and serialised) at a time when streaming
+STREAM_BATCH_SIZE = 2000
+
+# the columns of the rows returned for machines and simulations, in that order.
+# They are listed rather than using SELECT *, as the result of a prepared statement can't change
+MACHINE_COLUMNS = "id, name, location"
+SIMULATION_COLUMNS = ("simulation.id, simulation.name, state, date_created, date_updated, machine_id, "
+                      "COALESCE(point_count, 0) AS point_count, min_loss, final_loss, last_seconds")
+# the simulations with the summary of their loss data (simulations without any have no simulation_stats row)
+SIMULATION_TABLES = "simulation LEFT JOIN simulation_stats ON simulation_stats.simulation_id = simulation.id"
+
+
+def json_timestamp(column):
+    """
+    :return: the SQL of the timestamp as a JSON string formatted like django's JSON encoder does
+        (UTC with a Z, the milliseconds only if there is a fraction of a second), NULL if it is NULL
+    """
+    return (f"""to_char({column} AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS') """
+            f"""|| CASE WHEN mod(extract(microseconds FROM {column})::int, 1000000) = 0 THEN '' """
+            f"""ELSE to_char({column} AT TIME ZONE 'UTC', '.MS') END || 'Z'""")
+
+
+# The simulations of the list as JSON text made by postgres (see settings.JSON_FROM_DATABASE), the same
+# objects as responses.simulation_builder() makes, the two placeholders are the text before and after
+# the id in the detail link. The columns after it are the ones the keyset cursors are made from
+SIMULATION_JSON_COLUMNS = f"""json_build_object(
+        'id', simulation.id, 'name', name, 'state', state,
+        'date_created', {json_timestamp("date_created")}, 'date_updated', {json_timestamp("date_updated")},
+        'machine_id', machine_id, 'point_count', COALESCE(point_count, 0),
+        'min_loss', min_loss::text, 'final_loss', final_loss::text, 'last_seconds', last_seconds,
+        'link', %s || simulation.id || %s
+    )::text AS json, simulation.id, name, date_created, date_updated"""
+
+# the machine list as one JSON array made by postgres
+MACHINES_JSON_SQL = """SELECT COALESCE(json_agg(json_build_object('id', id, 'name', name, 'location', location)
+                                                ORDER BY id), '[]')::text
+                       FROM machine"""
+
+SIMULATION_DETAIL_SQL = f"""SELECT {SIMULATION_COLUMNS}, machine.name AS machine_name, machine.location AS machine_location
+                            FROM {SIMULATION_TABLES} LEFT JOIN machine ON machine.id = simulation.machine_id
+                            WHERE simulation.id = %s"""
+
+# the state a simulation can go to from each state
+STATE_TRANSITIONS = {
+    "pending": "running",
+    "running": "finished",
+}
+
+# Bulk creation: the simulations are given as arrays (name, state, machine name), one insert creates
+# the ones whose machine exists and whose name is free. A row per requested simulation, in order,
+# with the id if it was created
+ADD_SIMULATIONS_SQL = """
+    WITH requested AS (
+        SELECT * FROM unnest(%s::text[], %s::text[], %s::text[])
+            WITH ORDINALITY AS requested (name, state, machine_name, position)
+    ), created AS (
+        INSERT INTO simulation (name, state, machine_id, date_updated)
+        SELECT requested.name, requested.state, machine.id, NOW()
+        FROM requested LEFT JOIN machine ON machine.name = requested.machine_name
+        WHERE requested.machine_name IS NULL OR machine.id IS NOT NULL
+        ORDER BY requested.position
+        ON CONFLICT (name) DO NOTHING
+        RETURNING id, name
+    )
+    SELECT created.id, requested.machine_name IS NOT NULL AND machine.id IS NULL AS unknown_machine
+    FROM requested
+        LEFT JOIN created ON created.name = requested.name
+        LEFT JOIN machine ON machine.name = requested.machine_name
+    ORDER BY requested.position"""
+
+# A worker claims the oldest pending simulations that are for its machine or for any machine (or with
+# assigned_only only the ones for its machine), they become running on its machine. The rows locked by
+# the claims of other workers are skipped rather than waited for, so the workers don't queue behind each
+# other and never get the same simulation. A row per claimed simulation, none if the machine doesn't exist
+CLAIM_SIMULATIONS_SQL = """
+    WITH worker AS (
+        SELECT id FROM machine WHERE name = %s
+    ), claimed AS (
+        SELECT simulation.id FROM simulation CROSS JOIN worker
+        WHERE simulation.state = 'pending'
+            AND (simulation.machine_id = worker.id OR (simulation.machine_id IS NULL AND NOT %s))
+        ORDER BY simulation.date_created, simulation.id
+        LIMIT %s
+        FOR UPDATE OF simulation SKIP LOCKED
+    )
+    UPDATE simulation SET state = 'running', machine_id = worker.id
+    FROM claimed CROSS JOIN worker
+    WHERE simulation.id = claimed.id
+    RETURNING simulation.id, simulation.name, simulation.state, simulation.date_created,
+              simulation.date_updated, simulation.machine_id"""
+
+# Bulk state transitions: the changes are given as arrays (simulation id, new state, machine name),
+# one update applies the ones following STATE_TRANSITIONS (date_updated is set by its trigger).
+# A row per requested change, in order, with the state the simulation had and the new one if it changed
+TRANSITION_SIMULATIONS_SQL = f"""
+    WITH requested AS (
+        SELECT * FROM unnest(%s::int[], %s::text[], %s::text[])
+            WITH ORDINALITY AS requested (id, state, machine_name, position)
+    ), updated AS (
+        UPDATE simulation SET state = requested.state, machine_id = COALESCE(machine.id, simulation.machine_id)
+        FROM requested LEFT JOIN machine ON machine.name = requested.machine_name
+        WHERE simulation.id = requested.id
+            AND (simulation.state, requested.state) IN
+                ({", ".join(f"('{state}', '{next_state}')" for state, next_state in STATE_TRANSITIONS.items())})
+            AND (requested.machine_name IS NULL OR machine.id IS NOT NULL)
+        RETURNING simulation.id, simulation.state, simulation.machine_id, simulation.date_updated
+    )
+    -- the simulation table is read as it was before the update
+    SELECT simulation.state AS previous_state, updated.state, updated.machine_id, updated.date_updated,
+           requested.machine_name IS NOT NULL AND machine.id IS NULL AS unknown_machine
+    FROM requested
+        LEFT JOIN simulation ON simulation.id = requested.id
+        LEFT JOIN updated ON updated.id = requested.id
+        LEFT JOIN machine ON machine.name = requested.machine_name
+    ORDER BY requested.position"""
+
+# psycopg2 connection -> names of the statements prepared on it
+_prepared = weakref.WeakKeyDictionary()
+
+
+def get_connection():
+    """:return: the connection to the database of the request, see simulations.routing"""
+    alias = routing.database_alias()
+    conn = connections[alias]
+    try:
+        conn.ensure_connection()
+    except OperationalError as e:
+        if alias == routing.PRIMARY:
+            raise
+        conn = connections[routing.fall_back(alias, e)]
+        conn.ensure_connection()
+    return conn
+
+
+def use_prepared_statements(conn):
+    return not conn.settings_dict.get("DISABLE_SERVER_SIDE_CURSORS")
+
+
+def numbered_placeholders(sql):
+    """Turn the %s placeholders of a psycopg2 query into $1, $2... (and %% back into %)"""
+    parts = sql.split("%s")
+    numbered = "".join(part + (f"${number}" if number < len(parts) else "")
+                       for number, part in enumerate(parts, 1))
+    return numbered.replace("%%", "%")
+
+
+def cursor():
+    """
+    A cursor on the connection of the request (see get_connection()), returning namedtuples
+    """
+    return connection_cursor(get_connection())
+
+
+@contextmanager
+def connection_cursor(conn):
+    """
+    A cursor on this django connection, returning namedtuples
+    """
+    cur = track_cursor(conn.connection.cursor(cursor_factory=NamedTupleCursor))
+    try:
+        yield cur
+    except Exception:
+        # with autocommit off (and outside atomic(), which does its own) a failed
+        # statement leaves the transaction aborted until it is rolled back
+        if not conn.get_autocommit() and not conn.in_atomic_block:
+            conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def execute(conn, cur, sql, placeholder_vars=()):
+    """
+    Execute the query as a prepared statement, preparing it on this connection if needed
+    :param conn: the django connection of the cursor, whose settings say if statements can be prepared on it
+    """
+    if not use_prepared_statements(conn):
+        cur.execute(sql, placeholder_vars)
+        return
+
+    name = "origenai_" + hashlib.md5(sql.encode()).hexdigest()[:16]
+    prepared = _prepared.setdefault(cur.connection, set())
+    if name not in prepared:
+        # prepared statements aren't rolled back with the transaction, so this is only done once
+        cur.execute(f"PREPARE {name} AS {numbered_placeholders(sql)}")
+        prepared.add(name)
+    if placeholder_vars:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(placeholder_vars))})", placeholder_vars)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+
+def fetch_all(sql, placeholder_vars=()):
+    conn = get_connection()
+    with connection_cursor(conn) as cur:
+        execute(conn, cur, sql, placeholder_vars)
+        return cur.fetchall()
+
+
+def fetch_one(sql, placeholder_vars=()):
+    conn = get_connection()
+    with connection_cursor(conn) as cur:
+        execute(conn, cur, sql, placeholder_vars)
+        return cur.fetchone()
+
+
+def fetch_value(sql, placeholder_vars=()):
+    """:return: the first column of the first row, or None if there is no row"""
+    row = fetch_one(sql, placeholder_vars)
+    return row[0] if row is not None else None
+
+
+def open_streaming_cursor(sql, placeholder_vars):
+    """
+    Execute a query on a server side (named) cursor, so that rows are only sent
+    from the database when fetched rather than all at once.
+    The query is executed straight away so any SQL error is raised in the view.
+    A cursor can't be declared for a prepared statement, so these queries are sent as they are.
+    """
+    conn = get_connection()
+    if conn.settings_dict.get("DISABLE_SERVER_SIDE_CURSORS"):
+        # e.g. behind pgbouncer in transaction pooling mode
+        cur = track_cursor(conn.connection.cursor(cursor_factory=NamedTupleCursor))
+    else:
+        # outside a transaction the cursor has to be held, as in django's own chunked fetches
+        cur = track_cursor(conn.connection.cursor(name=f"origenai_{uuid4().hex}",
+                                                  cursor_factory=NamedTupleCursor,
+                                                  withhold=conn.get_autocommit()))
+    try:
+        cur.execute(sql, placeholder_vars)
+    except Exception:
+        cur.close()
+        raise
+    return cur
+
+
+class CursorBatches:
+    """
+    Iterator of lists of rows fetched from the cursor, closing it when done.
+    Unlike a generator, close() also closes the cursor if the iteration never started
+    (a HEAD request, a client gone before the first chunk), otherwise a held cursor
+    would stay open on the persistent connection with its rows.
+    :param transform: optional function applied to every row
+    """
+
+    def __init__(self, cur, transform=None):
+        self.cur = cur
+        self.transform = transform
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.cur.closed:
+            raise StopIteration
+        try:
+            rows = self.cur.fetchmany(STREAM_BATCH_SIZE)
+        except Exception:
+            self.close()
+            raise
+        if not rows:
+            self.close()
+            raise StopIteration
+        if self.transform:
+            rows = [self.transform(row) for row in rows]
+        return rows
+
+    def close(self):
+        if not self.cur.closed:
+            self.cur.close()
+
+
+def fetch_batches(cur, transform=None):
+    """:return: the CursorBatches of the rows of the cursor"""
+    return CursorBatches(cur, transform)
+
+
+class LineFile(io.TextIOBase):
+    """
+    Minimal read-only file object over an iterator of text lines (or chunks of lines),
+    so that COPY can pull the rows as they are produced instead of us building
+    the whole payload in memory first.
+    """
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = ""
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        remaining = len(self._buffer) - self._position
+        if size < 0 or remaining < size:
+            chunks = [self._buffer[self._position:]]
+            while size < 0 or remaining < size:
+                try:
+                    line = next(self._lines)
+                except StopIteration:
+                    break
+                chunks.append(line)
+                remaining += len(line)
+            self._buffer, self._position = "".join(chunks), 0
+        if size < 0:
+            size = remaining
+        # a chunk can be much larger than size, so it is read from rather than sliced at every read
+        data = self._buffer[self._position:self._position + size]
+        self._position += len(data)
+        return data
+
+
+# machines
+
+def list_machines():
+    return fetch_all(f"SELECT {MACHINE_COLUMNS} FROM machine ORDER BY id")
+
+
+def machines_json():
+    """:return: the machine list as JSON text"""
+    return fetch_value(MACHINES_JSON_SQL)
+
+
+def add_machine(name, location):
+    """:return: the id of the new machine"""
+    return fetch_value("INSERT INTO machine (name, location) VALUES (%s, %s) RETURNING id", (name, location))
+
+
+def update_machine(machine_id, name, location):
+    """:return: the id of the machine, or None if there is no such machine"""
+    return fetch_value("UPDATE machine SET name = %s, location = %s WHERE id = %s RETURNING id",
+                       (name, location, machine_id))
+
+
+# simulations
+
+def simulation_state(simulation_id):
+    """:return: the state of the simulation, or None if there is no such simulation"""
+    return fetch_value("SELECT state FROM simulation WHERE id = %s", (simulation_id,))
+
+
+def add_simulation(name, state, machine_name=None):
+    """:return: the id of the new simulation, on the machine with that name if there is one"""
+    return fetch_value("""INSERT INTO simulation (name, state, machine_id, date_updated)
+                          VALUES (%s, %s, (SELECT id FROM machine WHERE name = %s), NOW())
+                          RETURNING id""", (name, state, machine_name))
+
+
+def add_simulations(simulations):
+    """
+    :param simulations: the (name, state, machine name) of the simulations to create, with different names
+    :return: an (id, unknown_machine) row for each simulation, id is None if it wasn't created
+    """
+    return fetch_all(ADD_SIMULATIONS_SQL, [list(column) for column in zip(*simulations)] or [[], [], []])
+
+
+def transition_simulations(transitions):
+    """
+    :param transitions: the (simulation id, new state, machine name) of the changes, for different simulations
+    :return: a (previous_state, state, machine_id, date_updated, unknown_machine) row for each change,
+        state is None if it wasn't made, previous_state is None if there is no such simulation
+    """
+    return fetch_all(TRANSITION_SIMULATIONS_SQL, [list(column) for column in zip(*transitions)] or [[], [], []])
+
+
+def claim_simulations(machine_name, count=1, assigned_only=False):
+    """
+    Claim pending simulations for the machine, see CLAIM_SIMULATIONS_SQL
+    :return: the (id, name, state, date_created, date_updated, machine_id) rows of the claimed simulations,
+        in no particular order, none if there are none to claim or no such machine
+    """
+    return fetch_all(CLAIM_SIMULATIONS_SQL, (machine_name, assigned_only, count))
+
+
+def machine_exists(name):
+    return fetch_value("SELECT EXISTS (SELECT 1 FROM machine WHERE name = %s)", (name,))
+
+
+# loss data
+
+def add_loss_point(simulation_id, seconds, loss):
+    """:return: the id of the new loss data point"""
+    return fetch_value("INSERT INTO lossdata (seconds, loss, simulation_id) VALUES (%s, %s, %s) RETURNING id",
+                       (seconds, loss, simulation_id))
+
+
+def copy_loss_points(csv_file):
+    """
+    Write the loss data points with a single COPY
+    :param csv_file: file object of "seconds,loss,simulation_id" CSV lines
+    """
+    with cursor() as cur:
+        cur.copy_expert("COPY lossdata (seconds, loss, simulation_id) FROM STDIN WITH (FORMAT csv)", csv_file)
@@ -0,0 +1,219 @@
+"""
+Building the responses of the raw SQL endpoints.
+
+The rows come straight from our own queries, so they are trusted and are turned
+into the response objects directly, rather than being validated again row by row
+through the pydantic schemas (which are still used for the API documentation).
+"""
+import struct
+import sys
+from array import array
+from datetime import datetime
+from decimal import Decimal
+from typing import List, Optional
+
+from django.http import StreamingHttpResponse
+from django.urls import reverse
+from ninja.responses import NinjaJSONEncoder
+from pydantic import BaseModel
+
+from simulations.instrumentation import current_stats, serialising
+
+# used to find where the id goes in the detail url, it can be any id
+LINK_PLACEHOLDER_ID = 1234567890
+
+# one encoder for all rows, rather than one per json.dumps() call
+json_encoder = NinjaJSONEncoder()
+
+
+class SimulationResponse(BaseModel):
+    id: int
+    name: str
+    state: str
+    date_created: datetime
+    date_updated: Optional[datetime]
+    machine_id: Optional[int]
+    # the summary of the loss data, from simulation_stats
+    point_count: int
+    min_loss: Optional[Decimal]
+    final_loss: Optional[Decimal]
+    last_seconds: Optional[int]
+    link: str   # this should use HTTPUrl, but it gives me an error
+
+
+class SimulationPage(BaseModel):
+    items: List[SimulationResponse]
+    limit: int
+    next: Optional[str]
+
+
+def detail_link_parts(request, url_name="api-1.0.0:simulation_detail"):
+    """
+    Resolve the simulation detail url once for the request
+    :return: the text before and after the simulation id in the full url
+    """
+    url = reverse(url_name, kwargs={"simulation_id": LINK_PLACEHOLDER_ID})
+    full_url = f"{request.scheme}://{request.get_host()}{url}"
+    prefix, suffix = full_url.split(str(LINK_PLACEHOLDER_ID))
+    return prefix, suffix
+
+
+def simulation_builder(request):
+    """
+    :return: a function turning a simulation row (with the repository's SIMULATION_COLUMNS,
+        in that order) into a SimulationResponse dictionary, with the clickable link to the simulation detail
+    """
+    prefix, suffix = detail_link_parts(request)
+
+    def build(row):
+        (simulation_id, name, state, date_created, date_updated, machine_id,
+         point_count, min_loss, final_loss, last_seconds) = row
+        return {
+            "id": simulation_id,
+            "name": name,
+            "state": state,
+            "date_created": date_created,
+            "date_updated": date_updated,
+            "machine_id": machine_id,
+            "point_count": point_count,
+            "min_loss": min_loss,
+            "final_loss": final_loss,
+            "last_seconds": last_seconds,
+            "link": f"{prefix}{simulation_id}{suffix}",
+        }
+    return build
+
+
+def loss_point(row):
+    """:return: the graph point of a (seconds, loss) row"""
+    seconds, loss = row
+    return {"seconds": seconds, "loss": loss}
+
+
+def _json_array_chunks(batches, stats, encode):
+    separator = "["
+    for rows in batches:
+        with serialising(stats):
+            chunk = separator + ",".join(encode(row) for row in rows)
+        yield chunk
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+
+def _ndjson_chunks(batches, stats, encode):
+    for rows in batches:
+        with serialising(stats):
+            chunk = "".join(encode(row) + "\n" for row in rows)
+        yield chunk
+
+
+async def _async_json_array_chunks(batches, stats, encode):
+    separator = "["
+    async for rows in batches:
+        with serialising(stats):
+            chunk = separator + ",".join(encode(row) for row in rows)
+        yield chunk
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+
+async def _async_ndjson_chunks(batches, stats, encode):
+    async for rows in batches:
+        with serialising(stats):
+            chunk = "".join(encode(row) + "\n" for row in rows)
+        yield chunk
+
+
+# the binary graph: this header (little-endian: magic, format version, reserved, number of points),
+# then the seconds as int32 and the losses as float32, both little-endian arrays of that many points
+BINARY_GRAPH_CONTENT_TYPE = "application/vnd.origenai.graph"
+BINARY_GRAPH_HEADER = struct.Struct("<4sHHI")
+BINARY_GRAPH_MAGIC = b"OGRF"
+BINARY_GRAPH_VERSION = 1
+
+
+def wants_binary_graph(request, filters):
+    return filters.format == "binary" or BINARY_GRAPH_CONTENT_TYPE in request.headers.get("Accept", "")
+
+
+def binary_graph(count, seconds, losses):
+    """
+    Build the binary graph from the big-endian arrays made by postgres (see binary_graph_query()),
+    only the byte order is changed, the points never become python objects
+    :param count: the number of points
+    :param seconds: the int4send() bytes of the seconds, None if there are no points
+    :param losses: the float4send() bytes of the losses, None if there are no points
+    """
+    seconds = array("i", bytes(seconds or b""))
+    losses = array("f", bytes(losses or b""))
+    if sys.byteorder == "little":
+        seconds.byteswap()
+        losses.byteswap()
+    return BINARY_GRAPH_HEADER.pack(BINARY_GRAPH_MAGIC, BINARY_GRAPH_VERSION, 0, count) + seconds.tobytes() + losses.tobytes()
+
+
+def wants_ndjson(request):
+    return "application/x-ndjson" in request.headers.get("Accept", "")
+
+
+def json_chunks(request, batches, encode=json_encoder.encode):
+    """
+    Serialise batches of rows as a JSON array, or as newline delimited JSON
+    if the client asks for application/x-ndjson
+    :param encode: the function serialising a row, `str` for rows that are already JSON text
+    :return: a generator of text chunks and the content type
+    """
+    # the generators run after the view returns, so they are given the request's stats now
+    stats = current_stats()
+    if wants_ndjson(request):
+        return _ndjson_chunks(batches, stats, encode), "application/x-ndjson"
+    return _json_array_chunks(batches, stats, encode), "application/json"
+
+
+def async_json_chunks(request, batches, encode=json_encoder.encode):
+    """
+    Same as json_chunks(), for an async generator of batches
+    """
+    stats = current_stats()
+    if wants_ndjson(request):
+        return _async_ndjson_chunks(batches, stats, encode), "application/x-ndjson"
+    return _async_json_array_chunks(batches, stats, encode), "application/json"
+
+
+class ClosingChunks:
+    """
+    The chunks of a streamed response, also closing the batches they are made of when the response is
+    closed: a generator that hasn't started doesn't run its finally, so it wouldn't close them
+    """
+
+    def __init__(self, chunks, batches):
+        self.chunks = chunks
+        self.batches = batches
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        self.chunks.close()
+        self.batches.close()
+
+
+def streaming_json_response(request, batches, encode=json_encoder.encode):
+    """
+    Stream batches of rows to the client, see json_chunks()
+    """
+    if hasattr(batches, "__aiter__"):
+        chunks, content_type = async_json_chunks(request, batches, encode)
+    else:
+        chunks, content_type = json_chunks(request, batches, encode)
+        if hasattr(batches, "close"):
+            chunks = ClosingChunks(chunks, batches)
+    return StreamingHttpResponse(chunks, content_type=content_type)
+
+
+def json_page(items, limit, next_cursor):
+    """
+    :param items: the JSON text of the items of the page
+    :return: the JSON text of a SimulationPage
+    """
+    return f'{{"items": [{",".join(items)}], "limit": {limit}, "next": {json_encoder.encode(next_cursor)}}}'
@@ -0,0 +1,84 @@
+"""
+Read/write splitting between the primary database ('default') and a read replica.
+
+The GET endpoints read from settings.DB_READ_ALIAS, the 'replica' database when one is
+configured (see DB_REPLICA_HOST in the settings), so that the dashboards reading lists and
+graphs don't compete with the ingestion of loss data for the primary. Everything else, and
+every request when there is no replica, uses the primary.
+
+The replica lags a little behind, so after a successful write a client gets a cookie and reads
+from the primary for settings.DB_READ_YOUR_WRITES seconds, and sees what it has just written.
+If the replica can't be connected to, the reads go to the primary (see repository.get_connection()
+and async_db.get_pool()).
+"""
+import logging
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = "default"
+
+# set after a write, the client reads from the primary while it is there
+STICKY_COOKIE = "origenai_primary"
+
+READ_METHODS = ("GET", "HEAD")
+
+_database_alias = ContextVar("origenai_database_alias", default=PRIMARY)
+
+
+def database_alias():
+    """:return: the alias of the database the queries of the request being handled go to"""
+    return _database_alias.get()
+
+
+def request_alias(request):
+    """:return: the alias of the database the request is sent to"""
+    if (settings.DB_READ_ALIAS != PRIMARY and request.method in READ_METHODS
+            and STICKY_COOKIE not in request.COOKIES):
+        return settings.DB_READ_ALIAS
+    return PRIMARY
+
+
+def fall_back(alias, error):
+    """:return: the primary, to use instead of the replica that can't be connected to"""
+    logger.warning(f"Can't connect to the {alias} database, reading from the primary: {error}")
+    return PRIMARY
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Sends the reads to the replica, and makes the clients that wrote stick to the primary for a while
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _database_alias.set(request_alias(request))
+        try:
+            return self.finish(request, self.get_response(request))
+        finally:
+            _database_alias.reset(token)
+
+    async def __acall__(self, request):
+        token = _database_alias.set(request_alias(request))
+        try:
+            return self.finish(request, await self.get_response(request))
+        finally:
+            _database_alias.reset(token)
+
+    def finish(self, request, response):
+        if (settings.DB_READ_ALIAS != PRIMARY and settings.DB_READ_YOUR_WRITES
+                and request.method not in READ_METHODS and response.status_code < 400):
+            response.set_cookie(STICKY_COOKIE, "1", max_age=settings.DB_READ_YOUR_WRITES,
+                                httponly=True, samesite="Lax")
+        return response
@@ -1,11 +1,39 @@
+import asyncio
+import io
 import json
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+from array import array
+from unittest import mock
 
 from django.apps import apps
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.test import RequestFactory, TestCase, TransactionTestCase
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import close_old_connections, connections, transaction
 
 from simulations.api import CreateLossData, add_loss_data, CreateMachineSchema, add_machine, CreateSimulationSchema, \
-    add_simulation, simulations
+    add_simulation, simulations, GraphFilter, SearchSortFilter, SimulationTransitionSchema, ComparisonFilter, \
+    DetailFilter, ClaimSchema
+from simulations import api_async, async_db, events, repository, routing
+from simulations.cache import MACHINES_CACHE_KEY, invalidate_machines
+from simulations.create_tables import migrations
+from simulations.management.commands.bench import Command as BenchCommand
+
+
+def read_binary_graph(body):
+    """:return: the (seconds, loss) points of a binary graph"""
+    magic, version, reserved, count = struct.unpack_from("<4sHHI", body)
+    assert (magic, version) == (b"OGRF", 1)
+    seconds = array("i", body[12:12 + 4 * count])
+    losses = array("f", body[12 + 4 * count:])
+    # the arrays are little-endian, as is the machine running the tests
+    return [(second, round(loss, 5)) for second, loss in zip(seconds, losses)]
 
 
 # Create your tests here.
@@ -21,6 +49,10 @@ class SimulationTestCase(TestCase):
         call_command('setup_database')
         call_command('load_fixtures')
 
+    def setUp(self):
+        # the database is rolled back after every test, so the cached responses have to go too
+        cache.clear()
+
     def test_api_hello(self):
         """
         Test the hello endpoint to make sure we can connect
@@ -31,6 +63,122 @@ class SimulationTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {"msg": "Hello World"})
 
+    def test_setup_database_is_versioned(self):
+        """Running setup_database again should only apply what is missing, i.e. nothing here"""
+        out = io.StringIO()
+        call_command('setup_database', stdout=out)
+        self.assertNotIn("applied schema version", out.getvalue())
+
+        with connections['default'].cursor() as cursor:
+            cursor.execute("SELECT version FROM schema_version ORDER BY version")
+            versions = [row[0] for row in cursor.fetchall()]
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'lossdata'")
+            indexes = [row[0] for row in cursor.fetchall()]
+        self.assertEqual(versions, [version for version, description, sql in migrations])
+        self.assertIn("lossdata_simulation_seconds_idx", indexes)
+
+    def test_setup_database_keeps_versions_before_a_failure(self):
+        """Without pg_trgm, the versions before 7 are applied and recorded, 7 stays pending"""
+        without_trgm = [(version, description, sql.replace("name = 'pg_trgm'", "name = 'pg_unavailable'"))
+                        for version, description, sql in migrations]
+        with connections['default'].cursor() as cursor:
+            cursor.execute("DELETE FROM schema_version WHERE version >= 6")
+            cursor.execute("DROP INDEX simulation_pending_idx")
+
+        with mock.patch("simulations.management.commands.setup_database.migrations", without_trgm):
+            with self.assertRaisesMessage(CommandError, "schema version 7 failed"):
+                call_command('setup_database', stdout=io.StringIO())
+
+        with connections['default'].cursor() as cursor:
+            cursor.execute("SELECT max(version) FROM schema_version")
+            self.assertEqual(cursor.fetchone()[0], 6)
+            cursor.execute("SELECT to_regclass('simulation_pending_idx') IS NOT NULL")
+            self.assertTrue(cursor.fetchone()[0])
+
+    def test_db_stats(self):
+        response = self.client.get("/api/db/stats")
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()
+        self.assertEqual(stats["mode"], "sync")
+        self.assertGreaterEqual(stats["connections_opened"], 1)
+        self.assertGreaterEqual(stats["server_connections"]["active"], 1)
+
+    def test_query_timing(self):
+        for i in range(3):
+            self.client.post("/api/simulations/add", {"name": f"timed-{i}", "state": "pending"},
+                             content_type="application/json")
+        # the first request prepares the statement on the connection, later ones only execute it
+        self.client.get("/api/simulations?limit=2")
+        response = self.client.get("/api/simulations?limit=2")
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response["Server-Timing"], r'^db;dur=[\d.]+;desc="1 queries, 3 rows", ser;dur=[\d.]+, total')
+
+        # streamed responses are recorded once the whole body is sent
+        count_line = 'origenai_sql_queries_count{method="GET",endpoint="api/simulations"} '
+
+        def recorded():
+            metrics = self.client.get("/api/metrics").content.decode()
+            self.assertIn("# TYPE origenai_sql_queries histogram", metrics)
+            return int(next(line for line in metrics.splitlines() if line.startswith(count_line)).split()[-1])
+
+        before = recorded()
+        response = self.client.get("/api/simulations")
+        self.assertEqual(recorded(), before)
+        self.streamed_json(response)
+        self.assertEqual(recorded(), before + 1)
+
+    def test_bench_seed_and_cleanup(self):
+        command = BenchCommand()
+        simulation_ids = command.seed("test", machines=2, simulations=5, points=10)
+        self.assertEqual(len(simulation_ids), 5)
+        with connections['default'].cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM lossdata WHERE simulation_id = ANY(%s)", [simulation_ids])
+            self.assertEqual(cursor.fetchone()[0], 50)
+
+            command.cleanup("test")
+            cursor.execute("SELECT count(*) FROM simulation WHERE name LIKE 'bench-test-%%'")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def write_file(self, name, content):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), name)
+        with open(path, "w") as file:
+            file.write(content)
+        return path
+
+    def test_load_fixtures_files(self):
+        machines = self.write_file("machines.ndjson", '{"name": "machine-1", "location": "already there"}\n'
+                                                      '{"name": "bulk-machine", "location": "somewhere, else"}\n')
+        simulations_file = self.write_file("simulations.csv", "name,state,machine_name,date_created\n"
+                                                             "bulk-1,running,bulk-machine,2024-03-19T18:11:10Z\n"
+                                                             "bulk-2,finished,,\n")
+        lossdata = self.write_file("lossdata.json", json.dumps(
+            [{"seconds": seconds, "loss": round(1 / seconds, 5), "simulation_name": "bulk-1"} for seconds in range(1, 101)]))
+
+        out = io.StringIO()
+        call_command("load_fixtures", machines=machines, simulations=simulations_file, lossdata=lossdata,
+                     batch_size=30, stdout=out)
+        self.assertIn("machines: 2 records read, 1 inserted (1 already existed)", out.getvalue())
+        self.assertIn("lossdata: 100 records read, 100 inserted", out.getvalue())
+
+        machine_names = [machine["name"] for machine in self.client.get("/api/machines").json()]
+        self.assertIn("bulk-machine", machine_names)
+        simulation_list = {simulation["name"]: simulation for simulation in
+                           self.streamed_json(self.client.get("/api/simulations"))}
+        self.assertEqual(simulation_list["bulk-1"]["point_count"], 100)
+        self.assertEqual(simulation_list["bulk-1"]["date_created"][:19], "2024-03-19T18:11:10")
+        self.assertIsNone(simulation_list["bulk-2"]["machine_id"])
+
+        # an invalid record (or an unknown simulation) rolls back the whole load
+        bad_lossdata = self.write_file("bad.ndjson", '{"seconds": 1, "loss": 0.5, "simulation_name": "bulk-2"}\n'
+                                                     '{"seconds": "two", "loss": 0.4, "simulation_name": "bulk-2"}\n')
+        with self.assertRaisesMessage(CommandError, "invalid lossdata record 2 (seconds)"):
+            call_command("load_fixtures", lossdata=bad_lossdata, stdout=io.StringIO())
+        unknown = self.write_file("unknown.csv", "seconds,loss,simulation_name\n1,0.5,bulk-2\n1,0.5,nope\n")
+        with self.assertRaisesMessage(CommandError, "loss data of unknown simulations: nope"):
+            call_command("load_fixtures", lossdata=unknown, stdout=io.StringIO())
+        self.assertEqual(repository.fetch_value("SELECT count(*) FROM lossdata WHERE simulation_id = %s",
+                                                (simulation_list["bulk-2"]["id"],)), 0)
+
     def test_list_machines(self):
         response = self.client.get('/api/machines')
         self.assertEqual(response.status_code, 200)
@@ -40,6 +188,27 @@ class SimulationTestCase(TestCase):
                              {'id': 4, 'name': 'machine-4', 'location': 'https://some-machine-4.in.the.cloud.aws.com'}]
         self.assertEqual(expected_response, response.json())
 
+    def test_list_machines_cached(self):
+        response = self.client.get('/api/machines')
+        etag = response["ETag"]
+
+        response = self.client.get('/api/machines', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # adding or changing a machine invalidates the list
+        self.client.post('/api/machines/add', {"name": "machine-5", "location": "somewhere"},
+                         content_type="application/json")
+        response = self.client.get('/api/machines', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[-1]["name"], "machine-5")
+
+        response = self.client.put(f'/api/machines/{response.json()[-1]["id"]}/change',
+                                   {"name": "machine-6", "location": "somewhere else"},
+                                   content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/api/machines')
+        self.assertEqual(response.json()[-1]["name"], "machine-6")
+
     def test_add_simulations(self):
         simulation_data = {"name": "my_first-simulation",
                            "machine_name": "machine-2",
@@ -52,6 +221,46 @@ class SimulationTestCase(TestCase):
                                     )
         print(response.status_code)
 
+    def test_bulk_simulations(self):
+        response = self.client.post("/api/simulations/bulk", [
+            {"name": "bulk-1", "state": "pending", "machine_name": "machine-1"},
+            {"name": "bulk-2", "state": "pending"},
+            {"name": "bulk-1", "state": "pending"},
+            {"name": "bulk-3", "state": "pending", "machine_name": "no-such-machine"},
+        ], content_type="application/json")
+        results = response.json()["results"]
+        self.assertEqual([result["OK"] for result in results], [True, True, False, False])
+        self.assertEqual(results[2]["error"], "name bulk-1 is repeated")
+        self.assertEqual(results[3]["error"], "machine no-such-machine not found")
+        first_id, second_id = results[0]["id"], results[1]["id"]
+
+        response = self.client.post("/api/simulations/bulk", [{"name": "bulk-2", "state": "pending"}],
+                                    content_type="application/json")
+        self.assertEqual(response.json()["results"][0]["error"], "simulation bulk-2 already exists")
+
+        response = self.client.put("/api/simulations/state", [
+            {"id": first_id, "state": "running"},
+            {"id": second_id, "state": "running", "machine_name": "machine-2"},
+            {"id": 999999, "state": "running"},
+        ], content_type="application/json")
+        results = response.json()["results"]
+        self.assertEqual([result["OK"] for result in results], [True, True, False])
+        self.assertEqual(results[1]["state"], "running")
+        self.assertEqual(results[1]["machine_id"], self.client.get(f"/api/simulations/{second_id}/detail").json()["machine_id"])
+        self.assertIsNotNone(results[1]["date_updated"])
+        self.assertEqual(results[2]["error"], "simulation 999999 not found")
+
+        response = self.client.put("/api/simulations/state", [
+            {"id": first_id, "state": "finished"},
+            {"id": second_id, "state": "pending"},
+            {"id": second_id, "state": "finished", "machine_name": "no-such-machine"},
+        ], content_type="application/json")
+        results = response.json()["results"]
+        self.assertEqual([result["OK"] for result in results], [True, False, False])
+        self.assertEqual(results[1]["error"], f"simulation {second_id} can't go from running to pending")
+        self.assertEqual(results[2]["error"], f"id {second_id} is repeated")
+        self.assertEqual(self.client.get(f"/api/simulations/{first_id}/detail").json()["state"], "finished")
+
     def test_add_simulation_validation(self):
         """Should test with some bad inputs to make sure the data validations works
             Also some duplicates on unique feilds
@@ -69,9 +278,180 @@ class SimulationTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         # check response data matches here
 
+    def test_get_simulations_ndjson(self):
+        self.load_simulations()
+
+        response = self.client.get('/api/simulations', {"sort": "name"}, HTTP_ACCEPT="application/x-ndjson")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        simulations = [json.loads(line) for line in lines]
+        self.assertEqual([s["name"] for s in simulations], ["my-simulation-1", "my-simulation-2", "my-simulation-3"])
+        self.assertTrue(simulations[0]["link"].endswith(f"/api/simulations/{simulations[0]['id']}/detail"))
+
+    def test_streaming_cursor_closed_without_iterating(self):
+        """a response that is never read (e.g. for a HEAD request) still closes its cursor"""
+        self.load_simulations()
+
+        def open_cursors():
+            with repository.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM pg_cursors WHERE name LIKE 'origenai%%'")
+                return cursor.fetchone()[0]
+
+        # closing the response would close the connection too (and its cursors), as the test client avoids
+        request_finished.disconnect(close_old_connections)
+        try:
+            response = simulations(RequestFactory().head('/api/simulations'), filters=SearchSortFilter())
+            self.assertEqual(open_cursors(), 1)
+            response.close()
+            self.assertEqual(open_cursors(), 0)
+        finally:
+            request_finished.connect(close_old_connections)
+
+    def test_json_from_database(self):
+        simulation_ids = self.load_simulations()
+        self.client.post(f"/api/simulations/{simulation_ids[0]}/lossdata/bulk",
+                         [{"seconds": 10, "loss": 0.8}, {"seconds": 20, "loss": 0.75}], content_type="application/json")
+        with connections['default'].cursor() as cursor:
+            # timestamps with and without milliseconds
+            cursor.execute("UPDATE simulation SET date_created = '2024-03-01 12:30:00+01', "
+                           "date_updated = '2024-03-02 08:00:00.123456+00' WHERE id = %s", [simulation_ids[1]])
+            cursor.execute("UPDATE simulation SET date_updated = NULL WHERE id = %s", [simulation_ids[2]])
+
+        urls = ["/api/simulations", "/api/simulations?sort=-updated&limit=2", "/api/simulations?sort=name&limit=10"]
+        expected = [self.client.get(url) for url in urls]
+        ndjson = b"".join(self.client.get(urls[0], HTTP_ACCEPT="application/x-ndjson").streaming_content)
+        machines = self.client.get("/api/machines").json()
+        next_page = self.client.get(f"/api/simulations?sort=-updated&limit=2&cursor={expected[1].json()['next']}")
+
+        with self.settings(JSON_FROM_DATABASE=True):
+            self.assertEqual(self.streamed_json(self.client.get(urls[0])), self.streamed_json(expected[0]))
+            for url, response in zip(urls[1:], expected[1:]):
+                self.assertEqual(self.client.get(url).json(), response.json())
+            # the same cursors
+            cursor = self.client.get(urls[1]).json()["next"]
+            self.assertEqual(self.client.get(f"{urls[1]}&cursor={cursor}").json(), next_page.json())
+
+            response = self.client.get(urls[0], HTTP_ACCEPT="application/x-ndjson")
+            self.assertEqual([json.loads(line) for line in b"".join(response.streaming_content).splitlines()],
+                             [json.loads(line) for line in ndjson.splitlines()])
+
+            invalidate_machines()
+            self.assertEqual(self.client.get("/api/machines").json(), machines)
+
+    def test_claim_simulations(self):
+        for name in ("worker-1", "worker-2"):
+            self.client.post('/api/machines/add', {"name": name, "location": "here"}, content_type="application/json")
+        for name, machine_name in (("for-anyone", None), ("for-worker-2", "worker-2"), ("for-worker-1", "worker-1"),
+                                   ("for-anyone-later", None)):
+            simulation = {"name": name, "state": "pending"}
+            if machine_name:
+                simulation["machine_name"] = machine_name
+            self.client.post('/api/simulations/add', simulation, content_type="application/json")
+
+        response = self.client.post('/api/simulations/claim', {"machine_name": "worker-1", "count": 2},
+                                    content_type="application/json")
+        claimed = response.json()["simulations"]
+        # the oldest first, not the ones for another machine
+        self.assertEqual([s["name"] for s in claimed], ["for-anyone", "for-worker-1"])
+        self.assertEqual({(s["state"], s["machine_id"]) for s in claimed}, {("running", claimed[1]["machine_id"])})
+
+        response = self.client.post('/api/simulations/claim', {"machine_name": "worker-2", "assigned_only": True},
+                                    content_type="application/json")
+        self.assertEqual([s["name"] for s in response.json()["simulations"]], ["for-worker-2"])
+
+        out = io.StringIO()
+        call_command('claim_simulations', machine="worker-2", count=5, stdout=out, stderr=io.StringIO())
+        self.assertEqual([json.loads(line)["name"] for line in out.getvalue().splitlines()], ["for-anyone-later"])
+
+        response = self.client.post('/api/simulations/claim', {"machine_name": "worker-1"},
+                                    content_type="application/json")
+        self.assertEqual(response.json(), {"OK": True, "simulations": []})
+        response = self.client.post('/api/simulations/claim', {"machine_name": "no-such-machine"},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 404)
+        with self.assertRaises(CommandError):
+            call_command('claim_simulations', machine="no-such-machine", stdout=io.StringIO())
+
+    def test_get_simulations_paginated(self):
+        self.load_simulations()
+        self.client.post('/api/simulations/add', {"name": "my-simulation-0", "state": "running"},
+                         content_type="application/json")
+
+        for sort, expected_names in [
+            ("name", ["my-simulation-0", "my-simulation-1", "my-simulation-2", "my-simulation-3"]),
+            ("-name", ["my-simulation-3", "my-simulation-2", "my-simulation-1", "my-simulation-0"]),
+            # created in the same transaction, so the id breaks the tie
+            ("-created", ["my-simulation-0", "my-simulation-3", "my-simulation-2", "my-simulation-1"]),
+            ("updated", ["my-simulation-1", "my-simulation-2", "my-simulation-3", "my-simulation-0"]),
+        ]:
+            names = []
+            params = {"sort": sort, "limit": 3}
+            while True:
+                response = self.client.get('/api/simulations', params)
+                self.assertEqual(response.status_code, 200)
+                page = response.json()
+                self.assertLessEqual(len(page["items"]), 3)
+                names += [simulation["name"] for simulation in page["items"]]
+                if not page["next"]:
+                    break
+                params["cursor"] = page["next"]
+            self.assertEqual(expected_names, names)
+
+        response = self.client.get('/api/simulations', {"state": "running", "limit": 10})
+        self.assertEqual([s["name"] for s in response.json()["items"]], ["my-simulation-0"])
+        self.assertIsNone(response.json()["next"])
+
+        # a cursor can't be reused with another sort order
+        response = self.client.get('/api/simulations', {"sort": "-name", "cursor": params["cursor"]})
+        self.assertEqual(response.status_code, 400)
+
     def test_simulation_filters(self):
         """make some calls to the simulations endpoint with the filters for sort and search added"""
-        pass
+        self.load_simulations()
+        self.client.post('/api/machines/add', {"name": "machine-9", "location": "there"},
+                         content_type="application/json")
+        for name in ("other-simulation", "my_simulation%"):
+            self.client.post('/api/simulations/add', {"name": name, "state": "running", "machine_name": "machine-9"},
+                             content_type="application/json")
+        with repository.cursor() as cursor:
+            cursor.execute("UPDATE simulation SET date_created = '2020-01-01' WHERE name = 'my-simulation-2'")
+
+        def names(params):
+            response = self.client.get('/api/simulations', params)
+            self.assertEqual(response.status_code, 200)
+            return [simulation["name"] for simulation in json.loads(b"".join(response.streaming_content))]
+
+        self.assertEqual(names({"search": "SIMULATION-", "sort": "-name"}),
+                         ["my-simulation-3", "my-simulation-2", "my-simulation-1"])
+        self.assertEqual(names({"search": "sim", "search_mode": "prefix"}), [])
+        # _ and % are searched for, not wildcards
+        self.assertEqual(names({"search": "my_", "search_mode": "prefix"}), ["my_simulation%"])
+        self.assertEqual(names({"search": "%", "sort": "name"}), ["my_simulation%"])
+        self.assertEqual(names({"machine": "machine-9", "sort": "name"}), ["my_simulation%", "other-simulation"])
+        self.assertEqual(names({"machine": "no-such-machine"}), [])
+        self.assertEqual(names({"created_to": "2021-01-01"}), ["my-simulation-2"])
+        self.assertEqual(names({"created_from": "2021-01-01", "updated_from": "2021-01-01T00:00:00Z",
+                                "search": "my", "state": "pending", "sort": "created"}),
+                         ["my-simulation-1", "my-simulation-3"])
+
+        # the filters are kept in the later pages
+        params = {"search": "simulation", "machine": "machine-1", "sort": "-name", "limit": 1}
+        paged = []
+        while True:
+            page = self.client.get('/api/simulations', params).json()
+            paged += [simulation["name"] for simulation in page["items"]]
+            if not page["next"]:
+                break
+            params["cursor"] = page["next"]
+        self.assertEqual(paged, ["my-simulation-3", "my-simulation-2", "my-simulation-1"])
+
+        with self.settings(JSON_FROM_DATABASE=True):
+            self.assertEqual(names({"search": "simulation-", "machine": "machine-1", "created_to": "2021-01-01"}),
+                             ["my-simulation-2"])
+
+        response = self.client.get('/api/simulations', {"created_from": "yesterday"})
+        self.assertEqual(response.status_code, 422)
 
     def test_update_simulation(self):
         """ Test that teh triggesr works (it did when I updated manually in postgres)"""
@@ -133,9 +513,296 @@ class SimulationTestCase(TestCase):
                              {'seconds': 170, 'loss': '0.55500'}, {'seconds': 180, 'loss': '0.54600'},
                              {'seconds': 190, 'loss': '0.55000'}]
 
-        actual_response = list(response.json())
+        actual_response = list(self.streamed_json(response))
         self.assertEqual(expected_response, actual_response)
 
+    def test_add_loss_data_bulk(self):
+        simulation_id = self.load_simulations()[0]
+
+        response = self.client.post(f"/api/simulations/{simulation_id}/lossdata/bulk",
+                                    [{"seconds": 10, "loss": 0.8}, {"seconds": 20, "loss": 0.7}],
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], 2)
+
+        ndjson = '{"seconds": 30, "loss": 0.65}\n{"seconds": 40, "loss": 0.61}\n'
+        response = self.client.post(f"/api/simulations/{simulation_id}/lossdata/bulk",
+                                    ndjson, content_type="application/x-ndjson")
+        self.assertEqual(response.json()["count"], 2)
+
+        response = self.client.post(f"/api/simulations/{simulation_id}/lossdata/bulk",
+                                    "seconds,loss\n50,0.615\n60,0.6\n", content_type="text/csv")
+        self.assertEqual(response.json()["count"], 2)
+
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph")
+        self.assertEqual([point["seconds"] for point in self.streamed_json(response)], [10, 20, 30, 40, 50, 60])
+
+    def test_add_loss_data_bulk_large_json(self):
+        """A JSON array is parsed as it is read, so it isn't limited to DATA_UPLOAD_MAX_MEMORY_SIZE"""
+        simulation_id = self.load_simulations()[0]
+        url = f"/api/simulations/{simulation_id}/lossdata/bulk"
+        # the reads split the items, numbers and the two bytes of the é
+        body = json.dumps([{"seconds": seconds, "loss": 0.5, "note": "é"} for seconds in range(100)], indent=1)
+
+        with self.settings(DATA_UPLOAD_MAX_MEMORY_SIZE=100), mock.patch("simulations.api.JSON_READ_SIZE", 7):
+            response = self.client.post(url, body, content_type="application/json")
+            self.assertEqual(response.json(), {"OK": True, "message": "created loss data", "count": 100})
+
+            for invalid in ('[{"seconds": 1000, "loss": 0.5} {"seconds": 1001, "loss": 0.5}]',
+                            '[{"seconds": 1000, "loss": 0.5}] []'):
+                response = self.client.post(url, invalid, content_type="application/json")
+                self.assertEqual(response.status_code, 400)
+
+        with connections['default'].cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM lossdata WHERE simulation_id = %s", [simulation_id])
+            self.assertEqual(cursor.fetchone()[0], 100)
+
+    def test_add_loss_data_bulk_is_atomic(self):
+        simulation_id = self.load_simulations()[0]
+
+        # the last point has too many digits, so nothing should be written
+        response = self.client.post(f"/api/simulations/{simulation_id}/lossdata/bulk",
+                                    [{"seconds": 10, "loss": 0.8}, {"seconds": 20, "loss": 123456.7}],
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph")
+        self.assertEqual(self.streamed_json(response), [])
+
+    def test_simulation_stats(self):
+        simulation_id = self.load_simulations()[0]
+        self.client.post(f"/api/simulations/{simulation_id}/lossdata/bulk",
+                         [{"seconds": 10, "loss": 0.8}, {"seconds": 30, "loss": 0.6}, {"seconds": 20, "loss": 0.5}],
+                         content_type="application/json")
+        self.client.post('/api/lossdata/add', {"seconds": 40, "loss": 0.55, "simulation_id": simulation_id},
+                         content_type="application/json")
+
+        expected_stats = {"point_count": 4, "min_loss": "0.50000", "final_loss": "0.55000", "last_seconds": 40}
+        response = self.client.get("/api/simulations?limit=100")
+        listed = {item["id"]: item for item in response.json()["items"]}
+        self.assertEqual({key: listed[simulation_id][key] for key in expected_stats}, expected_stats)
+        # the other simulations have no loss data
+        other = next(item for item in listed.values() if item["id"] != simulation_id)
+        self.assertEqual((other["point_count"], other["final_loss"]), (0, None))
+
+        response = self.client.get(f"/api/simulations/{simulation_id}/detail")
+        self.assertEqual(response.status_code, 200)
+        detail = response.json()
+        self.assertEqual({key: detail[key] for key in expected_stats}, expected_stats)
+
+        # deleted points are taken out of the summary
+        with connections['default'].cursor() as cursor:
+            cursor.execute("DELETE FROM lossdata WHERE simulation_id = %s AND seconds >= 30", [simulation_id])
+            cursor.execute("SELECT point_count, min_loss, final_loss, last_seconds FROM simulation_stats "
+                           "WHERE simulation_id = %s", [simulation_id])
+            self.assertEqual([str(value) for value in cursor.fetchone()], ["2", "0.50000", "0.50000", "20"])
+
+    def test_partition_and_archive_lossdata(self):
+        simulation_id = self.load_simulations()[0]
+        self.client.post(f"/api/simulations/{simulation_id}/lossdata/bulk",
+                         [{"seconds": 10, "loss": 0.8}, {"seconds": 20, "loss": 0.7}],
+                         content_type="application/json")
+
+        call_command('partition_lossdata', size=10, ahead=1, stdout=io.StringIO())
+        partition = f"lossdata_{simulation_id // 10 * 10}_{simulation_id // 10 * 10 + 10}"
+        with connections['default'].cursor() as cursor:
+            cursor.execute("SELECT tableoid::regclass::text, count(*) FROM lossdata GROUP BY 1")
+            self.assertEqual(cursor.fetchall(), [(partition, 2)])
+
+        # the triggers moved to the partitioned table
+        self.client.post('/api/lossdata/add', {"seconds": 30, "loss": 0.6, "simulation_id": simulation_id},
+                         content_type="application/json")
+        response = self.client.get(f"/api/simulations/{simulation_id}/detail")
+        self.assertEqual(response.json()["point_count"], 3)
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph")
+        self.assertEqual([point["seconds"] for point in self.streamed_json(response)], [10, 20, 30])
+
+        # once all its simulations are finished and a later simulation exists, the partition can be archived
+        with connections['default'].cursor() as cursor:
+            cursor.execute("UPDATE simulation SET state = 'finished'")
+            cursor.execute("SELECT setval('simulation_id_seq', %s)", [simulation_id + 20])
+        self.client.post('/api/simulations/add', {"name": "later-simulation", "state": "pending"},
+                         content_type="application/json")
+        out = io.StringIO()
+        call_command('archive_lossdata', days=0, stdout=out)
+        self.assertIn(f"detached {partition}", out.getvalue())
+
+        # finished, so not streamed
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph")
+        self.assertEqual(response.json(), [])
+        response = self.client.get(f"/api/simulations/{simulation_id}/detail")
+        self.assertEqual(response.json()["point_count"], 3)
+
+    def test_get_graph_downsampled(self):
+        simulation_id = self.load_loss_data()
+
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph?points=6")
+        self.assertEqual(response.status_code, 200)
+        # 3 buckets of consecutive points, keeping the lowest and highest loss of each
+        expected_response = [{'seconds': 10, 'loss': '0.80000'}, {'seconds': 70, 'loss': '0.58000'},
+                             {'seconds': 90, 'loss': '0.58000'}, {'seconds': 120, 'loss': '0.54000'},
+                             {'seconds': 170, 'loss': '0.55500'}, {'seconds': 180, 'loss': '0.54600'}]
+        self.assertEqual(expected_response, self.streamed_json(response))
+
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph?points=100&from=50&to=80")
+        self.assertEqual([point["seconds"] for point in self.streamed_json(response)], [50, 60, 70, 80])
+
+    def test_get_graph_binary(self):
+        simulation_id = self.load_loss_data()
+
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph?format=binary")
+        self.assertEqual(response["Content-Type"], "application/vnd.origenai.graph")
+        expected_points = [(point["seconds"], float(point["loss"]))
+                           for point in self.streamed_json(self.client.get(f"/api/simulations/{simulation_id}/graph"))]
+        self.assertEqual(read_binary_graph(response.content), expected_points)
+
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph?points=4&from=50",
+                                   HTTP_ACCEPT="application/vnd.origenai.graph")
+        self.assertEqual(len(read_binary_graph(response.content)), 4)
+
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph?format=binary&from=100000")
+        self.assertEqual(read_binary_graph(response.content), [])
+
+    def test_get_graph_incremental(self):
+        simulation_id = self.load_loss_data()
+        graph_url = f"/api/simulations/{simulation_id}/graph"
+
+        response = self.client.get(f"{graph_url}?after_seconds=160").json()
+        self.assertEqual([point["seconds"] for point in response["points"]], [170, 180, 190])
+        self.assertEqual((response["after_seconds"], response["more"]), (190, False))
+
+        response = self.client.get(f"{graph_url}?after_seconds=10&limit=2&from=0&to=100").json()
+        self.assertEqual([point["seconds"] for point in response["points"]], [20, 30])
+        self.assertEqual((response["after_seconds"], response["more"]), (30, True))
+
+        # nothing new: the cursor stays the same
+        response = self.client.get(f"{graph_url}?after_seconds=190").json()
+        self.assertEqual(response, {"points": [], "after_seconds": 190, "after_id": None, "more": False})
+
+        # points with the same seconds across a page boundary: the next page resumes after the id
+        self.client.post(f"/api/simulations/{simulation_id}/lossdata/bulk", "seconds,loss\n200,0.3\n200,0.2\n200,0.1\n",
+                         content_type="text/csv")
+        params = {"after_seconds": 190, "limit": 2}
+        losses = []
+        while True:
+            response = self.client.get(graph_url, params).json()
+            losses += [point["loss"] for point in response["points"]]
+            params.update(after_seconds=response["after_seconds"], after_id=response["after_id"])
+            if not response["more"]:
+                break
+        self.assertEqual(sorted(losses), ["0.10000", "0.20000", "0.30000"])
+        self.assertEqual(self.client.get(graph_url, params).json()["points"], [])
+
+        since_id = self.client.get(f"{graph_url}?since_id=0").json()["since_id"]
+        # a point added late, before the last one, is only seen with since_id
+        self.client.post("/api/lossdata/add", {"simulation_id": simulation_id, "seconds": 15, "loss": 0.75},
+                         content_type="application/json")
+        response = self.client.get(f"{graph_url}?since_id={since_id}").json()
+        self.assertEqual(response["points"], [{"seconds": 15, "loss": "0.75000"}])
+        self.assertGreater(response["since_id"], since_id)
+
+        response = self.client.get(f"{graph_url}?since_id=0&after_seconds=0")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(f"{graph_url}?after_id=1")
+        self.assertEqual(response.status_code, 400)
+
+    def test_compare_simulations(self):
+        simulation_ids = []
+        for name, losses in (("compared-1", [0.9, 0.7, 0.5, 0.4]), ("compared-2", [0.8, 0.6, 0.3])):
+            response = self.client.post('/api/simulations/add', {"name": name, "state": "running"},
+                                        content_type="application/json")
+            simulation_ids.append(response.json()['id'])
+            self.client.post(f"/api/simulations/{simulation_ids[-1]}/lossdata/bulk",
+                             [{"seconds": 10 * (i + 1), "loss": loss} for i, loss in enumerate(losses)],
+                             content_type="application/json")
+
+        query = "&".join(f"ids={simulation_id}" for simulation_id in simulation_ids)
+        response = self.client.get(f"/api/simulations/compare?{query}&bucket_seconds=20").json()
+        # ranked by final loss
+        self.assertEqual([(s["id"], s["final_loss"], s["rank"]) for s in response["simulations"]],
+                         [(simulation_ids[1], "0.30000", 1), (simulation_ids[0], "0.40000", 2)])
+        self.assertEqual(response["bucket_seconds"], 20)
+        # the average of each simulation in the bucket, then across them: 0.9 and 0.8, (0.7 + 0.5) / 2 and
+        # (0.6 + 0.3) / 2, then only the first simulation has a point at 40 seconds
+        self.assertEqual([(b["seconds"], b["simulations"], b["min"], b["max"], b["mean"], b["p50"])
+                          for b in response["buckets"]],
+                         [(0, 2, "0.80000", "0.90000", "0.85000", "0.85000"),
+                          (20, 2, "0.45000", "0.60000", "0.52500", "0.52500"),
+                          (40, 1, "0.40000", "0.40000", "0.40000", "0.40000")])
+
+        # by state, two buckets over the longest run
+        response = self.client.get("/api/simulations/compare?state=running&buckets=2&to=30").json()
+        self.assertEqual(len(response["simulations"]), 2)
+        self.assertEqual(response["bucket_seconds"], 20)
+        self.assertEqual([b["simulations"] for b in response["buckets"]], [2, 2])
+
+        response = self.client.get("/api/simulations/compare?state=finished").json()
+        self.assertEqual(response, {"simulations": [], "bucket_seconds": None, "buckets": []})
+
+    def test_simulation_detail_preview(self):
+        self.client.post('/api/machines/add', {"name": "detail-machine", "location": "here"}, content_type="application/json")
+        response = self.client.post('/api/simulations/add',
+                                    {"name": "detailed-simulation", "state": "running", "machine_name": "detail-machine"},
+                                    content_type="application/json")
+        simulation_id = response.json()['id']
+        self.client.post(f"/api/simulations/{simulation_id}/lossdata/bulk",
+                         [{"seconds": 10 * i, "loss": round(1 - i / 10, 5)} for i in range(1, 9)],
+                         content_type="application/json")
+        detail_url = f"/api/simulations/{simulation_id}/detail"
+
+        detail = self.client.get(detail_url).json()
+        self.assertEqual(detail["machine"], {"id": detail["machine_id"], "name": "detail-machine", "location": "here"})
+        self.assertEqual(detail["point_count"], 8)
+        self.assertNotIn("graph", detail)
+
+        # one query, once the statement is prepared on the connection
+        self.client.get(f"{detail_url}?preview=3")
+        response = self.client.get(f"{detail_url}?preview=3")
+        self.assertIn('desc="1 queries, 1 rows"', response["Server-Timing"])
+        detail = response.json()
+        self.assertEqual(detail["graph"], [{"seconds": 60, "loss": "0.40000"}, {"seconds": 70, "loss": "0.30000"},
+                                           {"seconds": 80, "loss": "0.20000"}])
+        self.assertEqual(detail["machine"]["name"], "detail-machine")
+
+        # the lowest and highest loss of two buckets of consecutive points
+        detail = self.client.get(f"{detail_url}?preview=4&preview_mode=downsampled").json()
+        self.assertEqual([point["seconds"] for point in detail["graph"]], [10, 40, 50, 80])
+
+        response = self.client.post('/api/simulations/add', {"name": "empty-simulation", "state": "pending"},
+                                    content_type="application/json")
+        detail = self.client.get(f"/api/simulations/{response.json()['id']}/detail?preview=3").json()
+        self.assertEqual((detail["machine"], detail["graph"]), (None, []))
+
+        self.assertEqual(self.client.get("/api/simulations/999999/detail?preview=3").status_code, 404)
+
+    def test_get_graph_finished_cached(self):
+        response = self.client.post('/api/simulations/add', {"name": "finished-simulation", "state": "finished"},
+                                    content_type="application/json")
+        simulation_id = response.json()['id']
+        self.client.post(f"/api/simulations/{simulation_id}/lossdata/bulk",
+                         [{"seconds": 10, "loss": 0.8}, {"seconds": 20, "loss": 0.7}],
+                         content_type="application/json")
+
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph")
+        self.assertEqual(len(response.json()), 2)
+        etag = response["ETag"]
+
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # a new point invalidates the cached graph
+        self.client.post('/api/lossdata/add', {"seconds": 30, "loss": 0.6, "simulation_id": simulation_id},
+                         content_type="application/json")
+        response = self.client.get(f"/api/simulations/{simulation_id}/graph", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 3)
+
+    #----------------------------------------------------
+    # -- helpers --
+    def streamed_json(self, response):
+        """The list endpoints stream their response, so it has to be joined up before decoding"""
+        return json.loads(b"".join(response.streaming_content))
+
     #----------------------------------------------------
     # -- methods to load data from fixtures for testing --
     # -- not the nicest code please don't judge too harshly
@@ -204,3 +871,232 @@ class SimulationTestCase(TestCase):
                 loss_data = CreateLossData(**loss_data_json)
                 resp = add_loss_data(None, data=loss_data)
         return sim_id
+
+
+class AsyncApiTestCase(TransactionTestCase):
+    """
+    The async endpoints use their own connection pool, which can't see the data of
+    a TestCase transaction, so these tests commit and empty the tables afterwards
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        call_command('setup_database')
+        cls.loop = asyncio.new_event_loop()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.run_until_complete(events.close_hub())
+        cls.loop.run_until_complete(async_db.close_pool())
+        cls.loop.close()
+        super().tearDownClass()
+
+    def tearDown(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute("TRUNCATE lossdata, simulation_stats, simulation, machine RESTART IDENTITY")
+        cache.clear()
+
+    def run_view(self, view, request, *args, **kwargs):
+        """Call an async view, and read its body if it streams, all on the same event loop"""
+        async def call():
+            response = await view(request, *args, **kwargs)
+            if getattr(response, "streaming", False):
+                body = b"".join([chunk async for chunk in response.streaming_content])
+                return json.loads(body)
+            return response
+        return self.loop.run_until_complete(call())
+
+    @contextmanager
+    def replica(self, **overrides):
+        """Read from a replica database alias, which is the test database unless overridden"""
+        connections.settings["replica"] = {**connections["default"].settings_dict, **overrides}
+        try:
+            with self.settings(DB_READ_ALIAS="replica"):
+                yield
+        finally:
+            self.loop.run_until_complete(async_db.close_pool("replica"))
+            connections["replica"].close()
+            del connections["replica"]
+            del connections.settings["replica"]
+
+    def test_replica_routing(self):
+        self.client.post("/api/simulations/add", {"name": "replicated", "state": "running"},
+                         content_type="application/json")
+
+        async def list_simulations(request):
+            return await api_async.simulations(request, filters=SearchSortFilter(limit=10))
+        async_middleware = routing.ReplicaRoutingMiddleware(list_simulations)
+        request = RequestFactory().get("/api/simulations")
+
+        # a replica that is down: the reads go to the primary
+        with self.replica(HOST="/nonexistent"):
+            response = self.client.get("/api/simulations?limit=10")
+            self.assertEqual([s["name"] for s in response.json()["items"]], ["replicated"])
+            response = self.loop.run_until_complete(async_middleware(request))
+            self.assertEqual([s["name"] for s in json.loads(response.content)["items"]], ["replicated"])
+
+        with self.replica():
+            response = self.client.get("/api/simulations?limit=10")
+            self.assertEqual([s["name"] for s in response.json()["items"]], ["replicated"])
+            self.assertIsNotNone(connections["replica"].connection)
+            self.loop.run_until_complete(async_middleware(request))
+            self.assertIn("replica", async_db._pools[self.loop])
+
+            # after a write, the client reads from the primary for a while
+            response = self.client.post("/api/simulations/add", {"name": "written", "state": "pending"},
+                                        content_type="application/json")
+            self.assertEqual(response.cookies[routing.STICKY_COOKIE]["max-age"], settings.DB_READ_YOUR_WRITES)
+            connections["replica"].close()
+            response = self.client.get("/api/simulations?limit=10")
+            self.assertEqual(len(response.json()["items"]), 2)
+            self.assertIsNone(connections["replica"].connection)
+
+        # a replica behind a transaction pooler: no prepared statements or server side cursors on it,
+        # whatever the primary's settings
+        self.client.cookies.pop(routing.STICKY_COOKIE)
+        with self.replica(DISABLE_SERVER_SIDE_CURSORS=True):
+            response = self.client.get("/api/simulations?limit=10")
+            self.assertEqual(len(response.json()["items"]), 2)
+            with connections["replica"].connection.cursor() as cursor:
+                cursor.execute("SELECT count(*) FROM pg_prepared_statements")
+                self.assertEqual(cursor.fetchone()[0], 0)
+
+            async def stream_simulations(request):
+                return await api_async.simulations(request, filters=SearchSortFilter())
+            self.assertEqual(len(self.run_view(routing.ReplicaRoutingMiddleware(stream_simulations), request)), 2)
+            alias, pool = self.loop.run_until_complete(async_db.routed_pool("replica"))
+            self.assertEqual(alias, "replica")
+
+        # without a replica everything goes to the primary, and there is no cookie
+        response = self.client.post("/api/simulations/add", {"name": "unreplicated", "state": "pending"},
+                                    content_type="application/json")
+        self.assertNotIn(routing.STICKY_COOKIE, response.cookies)
+
+    def test_claims_skip_locked_simulations(self):
+        self.client.post('/api/machines/add', {"name": "worker-1", "location": "here"}, content_type="application/json")
+        for name in ("first", "second"):
+            self.client.post('/api/simulations/add', {"name": name, "state": "pending"},
+                             content_type="application/json")
+
+        request = RequestFactory().post("/api/simulations/claim")
+        with transaction.atomic():
+            # a worker whose claim isn't committed yet has the first one locked
+            self.assertEqual([row.name for row in repository.claim_simulations("worker-1")], ["first"])
+            # another worker gets the next one rather than waiting
+            result = self.loop.run_until_complete(asyncio.wait_for(
+                api_async.claim_simulations(request, data=ClaimSchema(machine_name="worker-1", count=2)), 5))
+            self.assertEqual([s["name"] for s in result["simulations"]], ["second"])
+
+        result = self.run_view(api_async.claim_simulations, request, data=ClaimSchema(machine_name="worker-1"))
+        self.assertEqual(result["simulations"], [])
+
+    def test_async_endpoints(self):
+        factory = RequestFactory()
+        request = factory.get("/api/machines")
+
+        result = self.run_view(api_async.add_machine, request, data=CreateMachineSchema(name="machine-1", location="here"))
+        self.assertTrue(result["OK"])
+        response = self.run_view(api_async.machines, request)
+        self.assertEqual(json.loads(response.content)[0]["name"], "machine-1")
+        self.assertEqual(cache.get(MACHINES_CACHE_KEY)[1], response.content)
+        self.run_view(api_async.add_machine, request, data=CreateMachineSchema(name="machine-2", location="there"))
+        self.assertIsNone(cache.get(MACHINES_CACHE_KEY))
+
+        result = self.run_view(api_async.add_simulation, request, data=CreateSimulationSchema(
+            name="async-simulation", state="running", machine_name="machine-1"))
+        simulation_id = result["id"]
+
+        request = factory.post(f"/api/simulations/{simulation_id}/lossdata/bulk",
+                               "seconds,loss\n10,0.8\n20,0.7\n", content_type="text/csv")
+        result = self.run_view(api_async.add_loss_data_bulk, request, simulation_id)
+        self.assertEqual(result["count"], 2)
+
+        request = factory.get(f"/api/simulations/{simulation_id}/graph")
+        points = self.run_view(api_async.convergence_graph, request, simulation_id, filters=GraphFilter())
+        self.assertEqual(points, [{"seconds": 10, "loss": "0.80000"}, {"seconds": 20, "loss": "0.70000"}])
+        response = self.run_view(api_async.convergence_graph, request, simulation_id,
+                                 filters=GraphFilter(format="binary"))
+        self.assertEqual(read_binary_graph(response.content), [(10, 0.8), (20, 0.7)])
+
+        response = self.run_view(api_async.convergence_graph, request, simulation_id,
+                                 filters=GraphFilter(after_seconds=10))
+        self.assertEqual(json.loads(response.content),
+                         {"points": [{"seconds": 20, "loss": "0.70000"}], "after_seconds": 20, "after_id": 2,
+                          "more": False})
+
+        request = factory.get("/api/simulations")
+        simulations = self.run_view(api_async.simulations, request, filters=SearchSortFilter())
+        self.assertEqual([s["name"] for s in simulations], ["async-simulation"])
+        self.assertTrue(simulations[0]["link"].endswith(f"/api/simulations/{simulation_id}/detail"))
+
+        result = self.run_view(api_async.simulations, request, filters=SearchSortFilter(sort="-updated", limit=1))
+        self.assertEqual(json.loads(result.content)["items"][0]["id"], simulation_id)
+
+        result = self.run_view(api_async.add_simulations, request, data=[
+            CreateSimulationSchema(name="async-bulk", state="pending", machine_name="machine-1"),
+            CreateSimulationSchema(name="async-simulation", state="pending")])
+        self.assertEqual([item["OK"] for item in result["results"]], [True, False])
+        result = self.run_view(api_async.transition_simulations, request, data=[
+            SimulationTransitionSchema(id=result["results"][0]["id"], state="running"),
+            SimulationTransitionSchema(id=simulation_id, state="pending")])
+        self.assertEqual([item["OK"] for item in result["results"]], [True, False])
+        self.assertEqual(result["results"][0]["state"], "running")
+
+        response = self.run_view(api_async.compare_simulations, request,
+                                 filters=ComparisonFilter(ids=[simulation_id], bucket_seconds=100))
+        self.assertEqual(json.loads(response.content)["buckets"], [
+            {"seconds": 0, "simulations": 1, "mean": "0.75000", "min": "0.75000", "max": "0.75000",
+             "p10": "0.75000", "p25": "0.75000", "p50": "0.75000", "p75": "0.75000", "p90": "0.75000"}])
+
+        searched = self.run_view(api_async.simulations, request, filters=SearchSortFilter(
+            search="BULK", machine="machine-1", created_from="2020-01-01", sort="name"))
+        self.assertEqual([s["name"] for s in searched], ["async-bulk"])
+
+        listed = self.run_view(api_async.simulations, request, filters=SearchSortFilter())
+        with self.settings(JSON_FROM_DATABASE=True):
+            self.assertEqual(self.run_view(api_async.simulations, request, filters=SearchSortFilter()), listed)
+            response = self.run_view(api_async.simulations, request, filters=SearchSortFilter(limit=1))
+            self.assertEqual(json.loads(response.content)["items"], listed[:1])
+
+        detail = self.run_view(api_async.simulation_detail, request, simulation_id, filters=DetailFilter(preview=2))
+        self.assertEqual(detail["machine"]["name"], "machine-1")
+        self.assertEqual([(point["seconds"], str(point["loss"])) for point in detail["graph"]],
+                         [(10, "0.80000"), (20, "0.70000")])
+
+        stats = self.run_view(api_async.db_stats, request)
+        self.assertEqual(stats["pool"]["max_size"], settings.ASYNC_DB_POOL["MAX_SIZE"])
+
+    def test_simulation_events(self):
+        factory = RequestFactory()
+        request = factory.get("/api/simulations")
+        simulation_id = self.run_view(api_async.add_simulation, request, data=CreateSimulationSchema(
+            name="watched-simulation", state="running"))["id"]
+        self.run_view(api_async.add_loss_data, request, data=CreateLossData(
+            simulation_id=simulation_id, seconds=10, loss=0.8))
+
+        async def watch():
+            # reconnecting after the point at 10 seconds
+            request = factory.get(f"/api/simulations/{simulation_id}/events", HTTP_LAST_EVENT_ID="10")
+            response = await api_async.simulation_events(request, simulation_id)
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            stream = response.streaming_content
+            received = [await asyncio.wait_for(anext(stream), 5)]
+
+            pool = await api_async.get_pool()
+            await pool.execute("INSERT INTO lossdata (seconds, loss, simulation_id) VALUES (20, 0.7, $1)", simulation_id)
+            received.append(await asyncio.wait_for(anext(stream), 5))
+            await pool.copy_records_to_table("lossdata", records=[(30, 0.65, simulation_id), (40, 0.6, simulation_id)],
+                                             columns=["seconds", "loss", "simulation_id"])
+            received.append(await asyncio.wait_for(anext(stream), 5))
+            await pool.execute("UPDATE simulation SET state = 'finished' WHERE id = $1", simulation_id)
+            received += [chunk async for chunk in stream]
+            return received
+
+        received = [chunk.decode() for chunk in self.loop.run_until_complete(watch())]
+        self.assertEqual(received, [
+            'event: state\ndata: {"state": "running"}\n\n',
+            'event: lossdata\nid: 20\ndata: [{"seconds": 20, "loss": "0.70000"}]\n\n',
+            'event: lossdata\nid: 40\ndata: [{"seconds": 30, "loss": "0.65000"}, {"seconds": 40, "loss": "0.60000"}]\n\n',
+            'event: state\ndata: {"state": "finished"}\n\n',
+        ])